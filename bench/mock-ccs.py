@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+CCS 대역 mock 서버 (벤치마크 / 로컬 테스트용)
+=============================================
+thinking-wrapper.py가 호출하는 CCS 엔드포인트를 흉내 낸다.
+실제 프로바이더 없이 래퍼 자체가 더하는 지연/CPU를 재기 위한 것.
+
+- GET  /v1/models
+- POST /v1/chat/completions, /api/provider/codex/v1/chat/completions  → OpenAI SSE / JSON
+- POST /v1/messages, /api/provider/codex/v1/messages                  → Anthropic SSE / JSON
+- POST /v1/messages/count_tokens
+- GET/POST /mock/config  실행 중 설정 조회/변경 (벤치 시나리오 사이)
+- GET  /mock/stats       경로/모델별 요청 수, 주입한 에러 수
+
+토큰은 --tps 속도로 --tokens-per-chunk개씩 내보내고, 첫 바이트는 --ttft 뒤에 나간다.
+
+사용법:
+    python3 bench/mock-ccs.py --port 8317 --ttft 0.2 --tps 100 --output-tokens 300
+    python3 bench/mock-ccs.py --tool-calls 2 --error-rate 0.05
+    python3 bench/mock-ccs.py --error-models gpt-5.3-codex   # 이 모델만 항상 529 (fallback 확인)
+"""
+
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+import argparse
+
+# =====================================================================
+# 설정 (CLI 또는 POST /mock/config로 변경)
+# =====================================================================
+
+MOCK = {
+    "ttft": 0.2,               # 첫 바이트까지 (초)
+    "tps": 100.0,              # 초당 출력 토큰 (0이면 대기 없이)
+    "output_tokens": 300,      # 텍스트 출력 토큰 수
+    "thinking_tokens": 100,    # thinking 블록 토큰 수 (요청에 thinking이 있을 때만)
+    "tokens_per_chunk": 1,     # SSE 이벤트 하나에 담는 토큰 수
+    "token_chars": 4,          # 토큰당 글자 수
+    "tool_calls": 0,           # 응답마다 붙이는 tool call 수
+    "tool_args_chars": 200,    # tool call 인자 JSON 크기 (글자)
+    "error_rate": 0.0,         # 에러 주입 비율 (0~1)
+    "error_status": 529,       # 주입할 에러 상태 코드
+    "error_models": "",        # 항상 에러를 돌려줄 모델 (쉼표 구분, fallback 테스트용)
+}
+
+MODELS = [
+    "claude-opus-4-6-thinking", "claude-sonnet-4-6", "claude-sonnet-4-5-thinking", "claude-haiku-4-5",
+    "gpt-5-mini", "gpt-5.3-codex", "gemini-3-pro-preview",
+]
+
+_FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+_stats = Counter()
+
+app = FastAPI(title="CCS mock")
+
+
+# =====================================================================
+# 공통: 토큰 페이싱 / 본문 생성 / 에러 주입
+# =====================================================================
+
+def _text(tokens: int, offset: int = 0) -> str:
+    size = tokens * MOCK["token_chars"]
+    start = (offset * MOCK["token_chars"]) % len(_FILLER)
+    repeated = _FILLER * (size // len(_FILLER) + 2)
+    return repeated[start:start + size]
+
+
+async def _paced(tokens: int):
+    """tps 속도에 맞춰 (토큰 수, 지금까지 보낸 토큰 수)를 내보냄"""
+    per_token = 1 / MOCK["tps"] if MOCK["tps"] > 0 else 0
+    step = max(1, int(MOCK["tokens_per_chunk"]))
+    started = time.monotonic()
+    sent = 0
+    while sent < tokens:
+        n = min(step, tokens - sent)
+        delay = started + (sent + n) * per_token - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield n, sent
+        sent += n
+
+
+def _tool_args(i: int) -> str:
+    payload = {"path": f"/tmp/mock/{i}.txt", "content": ""}
+    payload["content"] = "x" * max(0, MOCK["tool_args_chars"] - len(json.dumps(payload)))
+    return json.dumps(payload)
+
+
+def _input_tokens(raw: bytes) -> int:
+    return max(1, len(raw) // MOCK["token_chars"])
+
+
+def _injected_error(anthropic: bool, model: str) -> JSONResponse | None:
+    if model not in filter(None, MOCK["error_models"].split(",")) and (
+            MOCK["error_rate"] <= 0 or random.random() >= MOCK["error_rate"]):
+        return None
+    _stats["errors_injected"] += 1
+    message = "mock injected error"
+    if anthropic:
+        content = {"type": "error", "error": {"type": "overloaded_error", "message": message}}
+    else:
+        content = {"error": {"message": message, "type": "server_error"}}
+    return JSONResponse(content=content, status_code=MOCK["error_status"], headers={"retry-after": "0"})
+
+
+def _sse(event: dict) -> bytes:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+def _chunks(text: str, size: int = 32):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+# =====================================================================
+# /v1/messages — Anthropic SSE
+# =====================================================================
+
+async def _anthropic_stream(model: str, input_tokens: int, thinking: bool):
+    await asyncio.sleep(MOCK["ttft"])
+    yield _sse({"type": "message_start", "message": {
+        "id": f"msg_mock_{random.getrandbits(48):x}", "type": "message", "role": "assistant", "model": model,
+        "content": [], "stop_reason": None, "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+    }})
+    yield _sse({"type": "ping"})
+    index = 0
+    if thinking and MOCK["thinking_tokens"]:
+        yield _sse({"type": "content_block_start", "index": index, "content_block": {"type": "thinking", "thinking": ""}})
+        async for n, sent in _paced(MOCK["thinking_tokens"]):
+            yield _sse({"type": "content_block_delta", "index": index,
+                        "delta": {"type": "thinking_delta", "thinking": _text(n, sent)}})
+        yield _sse({"type": "content_block_delta", "index": index,
+                    "delta": {"type": "signature_delta", "signature": "mock-signature"}})
+        yield _sse({"type": "content_block_stop", "index": index})
+        index += 1
+    yield _sse({"type": "content_block_start", "index": index, "content_block": {"type": "text", "text": ""}})
+    async for n, sent in _paced(MOCK["output_tokens"]):
+        yield _sse({"type": "content_block_delta", "index": index, "delta": {"type": "text_delta", "text": _text(n, sent)}})
+    yield _sse({"type": "content_block_stop", "index": index})
+    for i in range(MOCK["tool_calls"]):
+        index += 1
+        yield _sse({"type": "content_block_start", "index": index, "content_block": {
+            "type": "tool_use", "id": f"toolu_mock_{i}", "name": "write_file", "input": {}}})
+        for part in _chunks(_tool_args(i)):
+            yield _sse({"type": "content_block_delta", "index": index,
+                        "delta": {"type": "input_json_delta", "partial_json": part}})
+        yield _sse({"type": "content_block_stop", "index": index})
+    output_tokens = MOCK["output_tokens"] + (MOCK["thinking_tokens"] if thinking else 0)
+    yield _sse({"type": "message_delta", "delta": {"stop_reason": "tool_use" if MOCK["tool_calls"] else "end_turn"},
+                "usage": {"output_tokens": output_tokens}})
+    yield _sse({"type": "message_stop"})
+
+
+def _anthropic_message(model: str, input_tokens: int, thinking: bool) -> dict:
+    content = []
+    if thinking and MOCK["thinking_tokens"]:
+        content.append({"type": "thinking", "thinking": _text(MOCK["thinking_tokens"]), "signature": "mock-signature"})
+    content.append({"type": "text", "text": _text(MOCK["output_tokens"])})
+    for i in range(MOCK["tool_calls"]):
+        content.append({"type": "tool_use", "id": f"toolu_mock_{i}", "name": "write_file",
+                        "input": json.loads(_tool_args(i))})
+    return {
+        "id": f"msg_mock_{random.getrandbits(48):x}", "type": "message", "role": "assistant", "model": model,
+        "content": content, "stop_reason": "tool_use" if MOCK["tool_calls"] else "end_turn",
+        "usage": {"input_tokens": input_tokens,
+                  "output_tokens": MOCK["output_tokens"] + (MOCK["thinking_tokens"] if thinking else 0)},
+    }
+
+
+@app.post("/v1/messages/count_tokens")
+async def count_tokens(request: Request):
+    _stats["count_tokens"] += 1
+    return {"input_tokens": _input_tokens(await request.body())}
+
+
+@app.post("/v1/messages")
+@app.post("/api/provider/codex/v1/messages")
+async def messages(request: Request):
+    raw = await request.body()
+    body = json.loads(raw)
+    _stats[request.url.path] += 1
+    _stats[f"model:{body.get('model', '')}"] += 1
+    model = body.get("model", "")
+    error = _injected_error(anthropic=True, model=model)
+    if error:
+        return error
+    thinking = "thinking" in body
+    if body.get("stream"):
+        return StreamingResponse(_anthropic_stream(model, _input_tokens(raw), thinking), media_type="text/event-stream")
+    await asyncio.sleep(MOCK["ttft"] + (MOCK["output_tokens"] / MOCK["tps"] if MOCK["tps"] > 0 else 0))
+    return _anthropic_message(model, _input_tokens(raw), thinking)
+
+
+# =====================================================================
+# /v1/chat/completions — OpenAI SSE
+# =====================================================================
+
+async def _openai_stream(model: str, input_tokens: int):
+    completion_id = f"chatcmpl-mock-{random.getrandbits(48):x}"
+    created = int(time.time())
+
+    def chunk(delta: dict, finish_reason=None, usage=None) -> bytes:
+        payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                   "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        if usage is not None:
+            payload["choices"] = []
+            payload["usage"] = usage
+        return b"data: " + json.dumps(payload).encode() + b"\n\n"
+
+    await asyncio.sleep(MOCK["ttft"])
+    yield chunk({"role": "assistant", "content": ""})
+    async for n, sent in _paced(MOCK["output_tokens"]):
+        yield chunk({"content": _text(n, sent)})
+    for i in range(MOCK["tool_calls"]):
+        yield chunk({"tool_calls": [{"index": i, "id": f"call_mock_{i}", "type": "function",
+                                     "function": {"name": "write_file", "arguments": ""}}]})
+        for part in _chunks(_tool_args(i)):
+            yield chunk({"tool_calls": [{"index": i, "function": {"arguments": part}}]})
+    yield chunk({}, "tool_calls" if MOCK["tool_calls"] else "stop")
+    yield chunk({}, usage={"prompt_tokens": input_tokens, "completion_tokens": MOCK["output_tokens"],
+                           "total_tokens": input_tokens + MOCK["output_tokens"]})
+    yield b"data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+@app.post("/api/provider/codex/v1/chat/completions")
+async def chat_completions(request: Request):
+    raw = await request.body()
+    body = json.loads(raw)
+    _stats[request.url.path] += 1
+    _stats[f"model:{body.get('model', '')}"] += 1
+    model = body.get("model", "")
+    error = _injected_error(anthropic=False, model=model)
+    if error:
+        return error
+    if body.get("stream"):
+        return StreamingResponse(_openai_stream(model, _input_tokens(raw)), media_type="text/event-stream")
+    await asyncio.sleep(MOCK["ttft"] + (MOCK["output_tokens"] / MOCK["tps"] if MOCK["tps"] > 0 else 0))
+    message = {"role": "assistant", "content": _text(MOCK["output_tokens"])}
+    if MOCK["tool_calls"]:
+        message["tool_calls"] = [{"id": f"call_mock_{i}", "type": "function",
+                                  "function": {"name": "write_file", "arguments": _tool_args(i)}}
+                                 for i in range(MOCK["tool_calls"])]
+    return {
+        "id": f"chatcmpl-mock-{random.getrandbits(48):x}", "object": "chat.completion", "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if MOCK["tool_calls"] else "stop"}],
+        "usage": {"prompt_tokens": _input_tokens(raw), "completion_tokens": MOCK["output_tokens"]},
+    }
+
+
+# =====================================================================
+# /v1/models, /mock/*
+# =====================================================================
+
+@app.get("/v1/models")
+async def list_models():
+    _stats["/v1/models"] += 1
+    return {"object": "list", "data": [{"id": m, "object": "model", "owned_by": "mock"} for m in MODELS]}
+
+
+@app.get("/mock/config")
+async def get_config():
+    return MOCK
+
+
+@app.post("/mock/config")
+async def set_config(request: Request):
+    """{"ttft": 0.5, "tps": 50, ...} — 알려진 키만 바꾼다"""
+    updates = await request.json()
+    unknown = sorted(set(updates) - set(MOCK))
+    if unknown:
+        return JSONResponse(content={"error": f"unknown keys: {unknown}"}, status_code=400)
+    for key, value in updates.items():
+        MOCK[key] = type(MOCK[key])(value)
+    return MOCK
+
+
+@app.get("/mock/stats")
+async def stats():
+    return dict(_stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CCS mock (benchmark stand-in)")
+    parser.add_argument("--port", type=int, default=8317)
+    parser.add_argument("--host", default="127.0.0.1")
+    for key, value in MOCK.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+    for key in MOCK:
+        MOCK[key] = getattr(args, key)
+
+    print(f"🧪 CCS mock on {args.host}:{args.port}")
+    print(f"   ttft={MOCK['ttft']}s tps={MOCK['tps']} output={MOCK['output_tokens']} "
+          f"tools={MOCK['tool_calls']} error_rate={MOCK['error_rate']}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
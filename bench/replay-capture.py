@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+캡처 재생 (부하 테스트)
+=======================
+thinking-wrapper.py --capture로 기록한 트래픽(gzip JSONL)을 래퍼에 다시 보낸다.
+원래 간격(또는 --speed 배속)과 동시성을 그대로 재현하고, 업스트림은 기록된 응답을
+같은 타이밍으로 돌려주는 stub(또는 mock-ccs.py)으로 대신해 래퍼 변경 전/후 지연을 비교한다.
+
+측정 항목 (엔드포인트/라우트별):
+- 재생 TTFT·전체 지연 p50/p90/p99, 에러/상태 코드 분포
+- 캡처 당시 래퍼 TTFT·전체 지연과 래퍼가 더한 TTFT (first_byte − upstream_first_byte)
+- 예정 시각 대비 전송 지연 (재생 클라이언트가 밀렸는지 확인)
+- 래퍼 프로세스 CPU 시간 / 요청, RSS (시작/최대)
+
+결과는 JSON (--out 파일 또는 stdout). --compare로 기준 결과와 비교해
+재생 지연이나 CPU/request가 tolerance 이상 나빠지면 exit 1.
+
+사용법:
+    # 기록된 응답 stub + 래퍼를 임시 포트로 띄워 원래 속도로 재생
+    python3 bench/replay-capture.py ~/.ccs-wrapper/capture/ --spawn --out before.json
+    # 2배속, 요청마다 3배로 부풀려서, 동시 요청 최대 32
+    python3 bench/replay-capture.py traffic.jsonl.gz --spawn --speed 2 --multiply 3 -c 32
+    # 업스트림은 mock-ccs.py, 간격 무시하고 최대 속도로
+    python3 bench/replay-capture.py traffic.jsonl.gz --spawn --stub mock --speed 0 -c 16
+    # 변경 후 비교
+    python3 bench/replay-capture.py ~/.ccs-wrapper/capture/ --spawn --compare before.json
+    # 이미 떠 있는 래퍼 대상 (업스트림은 직접 준비)
+    python3 bench/replay-capture.py traffic.jsonl.gz --wrapper http://127.0.0.1:8318
+"""
+
+import asyncio
+import gzip
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+import httpx
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WRAPPER_SCRIPT = os.path.join(ROOT, "thinking-wrapper.py")
+MOCK_SCRIPT = os.path.join(ROOT, "bench", "mock-ccs.py")
+
+# 측정/프로세스 헬퍼는 bench-wrapper.py와 공유
+_spec = importlib.util.spec_from_file_location("bench_wrapper", os.path.join(ROOT, "bench", "bench-wrapper.py"))
+bench = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bench)
+
+# 재생 요청은 응답 캐시 / 동일 요청 합치기를 건너뛴다 (익명화된 본문은 서로 같아지기 쉽다)
+BYPASS_HEADERS = {"X-CCS-Cache": "bypass"}
+# stub이 프레임 사이에서 잠드는 최소 간격 (초). 더 짧은 간격의 프레임은 묶어서 보낸다
+STUB_MIN_SLEEP = 0.002
+
+
+# =====================================================================
+# 캡처 파일 읽기
+# =====================================================================
+
+def _capture_files(paths: list[str]) -> list[str]:
+    """파일/디렉터리 목록 → 캡처 파일 (디렉터리면 *.jsonl.gz 전부)"""
+    files = []
+    for path in paths:
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith((".jsonl.gz", ".jsonl"))))
+        else:
+            files.append(path)
+    return files
+
+
+def load_capture(paths: list[str], endpoints: list[str] | None = None, limit: int | None = None) -> list[dict]:
+    """캡처 레코드를 시각 순으로. 아직 쓰는 중인 파일(gzip 끝 없음)도 읽은 데까지 쓴다."""
+    records = []
+    for path in _capture_files(paths):
+        opener = gzip.open if path.endswith(".gz") else open
+        try:
+            with opener(path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if not endpoints or record.get("endpoint") in endpoints:
+                        records.append(record)
+        except EOFError:
+            bench._status(f"⚠️ {path}: truncated (still being written?) — using records read so far")
+        except OSError as e:
+            bench._status(f"⚠️ {path}: {e}")
+    records.sort(key=lambda r: r.get("t", 0))
+    return records[:limit] if limit else records
+
+
+# =====================================================================
+# 업스트림 stub: 기록된 응답을 기록된 타이밍으로 (--serve-stub, --spawn이 띄움)
+# =====================================================================
+
+def _fallback_response(path: str, model: str | None, stream: bool) -> tuple[int, dict, list]:
+    """기록된 응답이 없을 때 (다른 모델로 라우팅됐거나 내용이 생략된 경우): 최소 정상 응답"""
+    if path.endswith("/chat/completions"):
+        chunk = {"id": "chatcmpl-replay", "object": "chat.completion.chunk", "model": model,
+                 "choices": [{"index": 0, "delta": {"content": "ok"}, "finish_reason": "stop"}],
+                 "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}}
+        if stream:
+            return 200, {"content-type": "text/event-stream"}, [[0, f"data: {json.dumps(chunk)}\n\n"],
+                                                               [0, "data: [DONE]\n\n"]]
+        message = {**chunk, "object": "chat.completion",
+                   "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}]}
+        return 200, {"content-type": "application/json"}, [[0, json.dumps(message)]]
+    usage = {"input_tokens": 1, "output_tokens": 1}
+    if stream:
+        events = [
+            {"type": "message_start", "message": {"id": "msg_replay", "type": "message", "role": "assistant",
+                                                  "model": model, "content": [], "usage": usage}},
+            {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+            {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "ok"}},
+            {"type": "content_block_stop", "index": 0},
+            {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": usage},
+            {"type": "message_stop"},
+        ]
+        return 200, {"content-type": "text/event-stream"}, [
+            [0, f"event: {e['type']}\ndata: {json.dumps(e)}\n\n"] for e in events]
+    message = {"id": "msg_replay", "type": "message", "role": "assistant", "model": model,
+               "content": [{"type": "text", "text": "ok"}], "stop_reason": "end_turn", "usage": usage}
+    return 200, {"content-type": "application/json"}, [[0, json.dumps(message)]]
+
+
+def create_stub(records: list[dict], speed: float):
+    """기록된 업스트림 응답을 (경로, 모델)별로 돌아가며 재생하는 FastAPI 앱.
+    speed: 업스트림 타이밍 배속 (0이면 대기 없이)."""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+    by_key, by_path = defaultdict(list), defaultdict(list)
+    models = set()
+    for record in records:
+        for entry in record.get("upstream", []):
+            if entry.get("omitted") or not entry.get("frames"):
+                continue
+            by_key[(entry["path"], entry.get("model"), entry.get("stream"))].append(entry)
+            by_path[(entry["path"], entry.get("stream"))].append(entry)
+            models.add(entry.get("model"))
+    cycles = {key: itertools.cycle(entries) for key, entries in [*by_key.items(), *by_path.items()]}
+    stats = Counter()
+    app = FastAPI()
+
+    def delay(ms: float) -> float:
+        return ms / 1000 / speed if speed > 0 else 0.0
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": m, "object": "model"} for m in sorted(filter(None, models))]}
+
+    @app.get("/stub/stats")
+    async def stub_stats():
+        return dict(stats)
+
+    @app.post("/{path:path}")
+    async def replay(path: str, request: Request):
+        path = "/" + path
+        try:
+            body = await request.json()
+        except ValueError:
+            body = {}
+        model, stream = body.get("model"), bool(body.get("stream"))
+        if path.endswith("/count_tokens"):
+            stats["count_tokens"] += 1
+            return JSONResponse({"input_tokens": max(1, len(await request.body()) // 4)})
+        source = cycles.get((path, model, stream)) or cycles.get((path, stream))
+        if source is None:
+            stats["fallback"] += 1
+            status, headers, frames = _fallback_response(path, model, stream)
+            ttfb = 0.0
+        else:
+            stats["recorded"] += 1
+            entry = next(source)
+            status, headers, frames, ttfb = entry["status"], entry["headers"], entry["frames"], entry["ttfb_ms"]
+        await asyncio.sleep(delay(ttfb))
+        media_type = headers.get("content-type", "application/json")
+        extra = {k: v for k, v in headers.items() if k in ("retry-after",)}
+        if "text/event-stream" not in media_type:
+            last = frames[-1][0] if frames else ttfb
+            await asyncio.sleep(delay(max(0.0, last - ttfb)))
+            return Response("".join(text for _, text in frames), status_code=status,
+                            media_type=media_type, headers=extra)
+
+        async def body_iter():
+            # 기록 오프셋은 업스트림 전송 시각 기준. 이미 시각이 된 프레임은 한 번에 보낸다
+            # (프레임마다 sleep/send 하면 부하를 걸 때 stub이 먼저 CPU 병목이 된다)
+            started = time.perf_counter() - delay(ttfb)
+            batch = []
+            for offset, text in frames:
+                wait = delay(offset) - (time.perf_counter() - started)
+                if wait > STUB_MIN_SLEEP:
+                    if batch:
+                        yield "".join(batch).encode()
+                        batch = []
+                    await asyncio.sleep(wait)
+                batch.append(text)
+            if batch:
+                yield "".join(batch).encode()
+
+        return StreamingResponse(body_iter(), status_code=status, media_type=media_type, headers=extra)
+
+    return app
+
+
+# =====================================================================
+# 재생
+# =====================================================================
+
+async def _send(client: httpx.AsyncClient, base: str, record: dict, keep_cache: bool):
+    """레코드 하나 재전송 → (상태 코드, TTFT, 전체 지연). 연결 에러면 상태 None."""
+    auth = bench.ANTHROPIC_HEADERS if record["endpoint"] == "messages" else bench.OPENAI_HEADERS
+    headers = {**record.get("headers", {}), **auth, **({} if keep_cache else BYPASS_HEADERS)}
+    url = base + record["path"] + (f"?{record['query']}" if record.get("query") else "")
+    started = time.perf_counter()
+    first = None
+    try:
+        async with client.stream(record.get("method", "POST"), url, headers=headers, json=record["body"]) as r:
+            async for chunk in r.aiter_raw():
+                if first is None and chunk:
+                    first = time.perf_counter()
+            status = r.status_code
+    except httpx.HTTPError:
+        status = None
+    done = time.perf_counter()
+    return status, (first or done) - started, done - started
+
+
+def _group(record: dict) -> str:
+    return f"{record['endpoint']}/{record.get('route') or '-'}" + ("" if record.get("stream") else "/nonstream")
+
+
+async def replay(args, records: list[dict], pid: int | None) -> dict:
+    """기록된 간격(/speed)대로 예약 전송. concurrency > 0이면 동시 요청 수 제한 (초과분은 대기)."""
+    results = defaultdict(lambda: {"samples": [], "statuses": Counter(), "errors": 0})
+    lags = []
+    limit = asyncio.Semaphore(args.concurrency) if args.concurrency > 0 else None
+    connections = args.concurrency * 2 if args.concurrency > 0 else len(records) * args.multiply
+    limits = httpx.Limits(max_connections=max(connections, 16), max_keepalive_connections=max(connections, 16))
+    rss_peak = 0.0
+    origin = records[0].get("t", 0) if records else 0
+
+    async with httpx.AsyncClient(timeout=600, limits=limits) as client:
+        async def one(record: dict, due: float):
+            if limit is not None:
+                await limit.acquire()
+            try:
+                lags.append(max(0.0, time.perf_counter() - due))
+                status, ttft, total = await _send(client, args.wrapper, record, args.keep_cache)
+            finally:
+                if limit is not None:
+                    limit.release()
+            group = results[_group(record)]
+            group["statuses"][str(status)] += 1
+            if status == 200:
+                group["samples"].append((ttft, total))
+            else:
+                group["errors"] += 1
+
+        async def sampler():
+            nonlocal rss_peak
+            while True:
+                _, rss = await asyncio.to_thread(bench._proc_sample, pid)
+                rss_peak = max(rss_peak, rss or 0.0)
+                await asyncio.sleep(0.2)
+
+        cpu_start, rss_start = bench._proc_sample(pid)
+        watcher = asyncio.create_task(sampler()) if pid else None
+        started = time.perf_counter()
+        tasks = []
+        for record in records:
+            due = started + ((record.get("t", origin) - origin) / args.speed if args.speed > 0 else 0.0)
+            wait = due - time.perf_counter()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            tasks.extend(asyncio.create_task(one(record, due)) for _ in range(args.multiply))
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - started
+        if watcher is not None:
+            watcher.cancel()
+        cpu_end, rss_end = bench._proc_sample(pid)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    groups = {}
+    for name, group in sorted(results.items()):
+        recorded = [r for r in records if _group(r) == name and r.get("status") == 200]
+        marks = [r.get("marks", {}) for r in recorded]
+        first_bytes = [m["first_byte"] / 1000 for m in marks if m.get("first_byte") is not None]
+        ends = [m["end"] / 1000 for m in marks if m.get("end") is not None]
+        added = [(m["first_byte"] - m["upstream_first_byte"]) / 1000 for m in marks
+                 if m.get("first_byte") is not None and m.get("upstream_first_byte") is not None]
+        groups[name] = {
+            "replay": {"requests": len(group["samples"]), "errors": group["errors"],
+                       "statuses": dict(group["statuses"]), **bench._summary(group["samples"])},
+            "recorded": {
+                "requests": len(recorded),
+                "ttft_ms": {"p50": ms(bench._percentile(first_bytes, 0.5)),
+                            "p99": ms(bench._percentile(first_bytes, 0.99))},
+                "latency_ms": {"p50": ms(bench._percentile(ends, 0.5)), "p99": ms(bench._percentile(ends, 0.99))},
+                "proxy_ttft_ms": {"p50": ms(bench._percentile(added, 0.5)), "p99": ms(bench._percentile(added, 0.99))},
+            },
+        }
+
+    total = sum(g["replay"]["requests"] for g in groups.values())
+    result = {"requests": total, "errors": sum(g["replay"]["errors"] for g in groups.values()),
+              "wall_s": round(wall, 3), "rps": round(total / wall, 2) if wall else None,
+              "schedule_lag_ms": {"p50": ms(bench._percentile(lags, 0.5)), "p99": ms(bench._percentile(lags, 0.99)),
+                                  "max": ms(max(lags, default=None))},
+              "groups": groups}
+    if pid and cpu_start is not None and cpu_end is not None:
+        result["cpu_s"] = round(cpu_end - cpu_start, 4)
+        result["rss_mb"] = {"start": round(rss_start, 1), "peak": round(max(rss_peak, rss_end or 0), 1)}
+        if total:
+            result["cpu_ms_per_request"] = round(result["cpu_s"] / total * 1000, 3)
+    return result
+
+
+# =====================================================================
+# 기준 결과 비교
+# =====================================================================
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """기준 대비 나빠진 항목 목록 (그룹별 재생 TTFT/지연 p50/p99, 에러 수, CPU/request)"""
+    regressions = []
+    now_run, base_run = report["replay"], baseline.get("replay", {})
+    for name, entry in now_run["groups"].items():
+        base = base_run.get("groups", {}).get(name)
+        if not base:
+            continue
+        for metric in ("ttft_ms", "latency_ms"):
+            for q in ("p50", "p99"):
+                now, before = entry["replay"][metric][q], base["replay"][metric][q]
+                if now is not None and before is not None and \
+                        now > before + max(abs(before) * tolerance, bench.LATENCY_FLOOR_MS):
+                    regressions.append(f"{name} {metric}.{q}: {before} → {now}")
+        if entry["replay"]["errors"] > base["replay"]["errors"]:
+            regressions.append(f"{name} errors: {base['replay']['errors']} → {entry['replay']['errors']}")
+    now, before = now_run.get("cpu_ms_per_request"), base_run.get("cpu_ms_per_request")
+    if now is not None and before is not None and \
+            now > before + max(abs(before) * tolerance, bench.CPU_FLOOR_US / 1000 * 100):
+        regressions.append(f"cpu_ms_per_request: {before} → {now}")
+    return regressions
+
+
+# =====================================================================
+# --spawn: stub(또는 mock) + 래퍼를 임시 포트로 실행
+# =====================================================================
+
+def _spawn(args) -> list[subprocess.Popen]:
+    stub_port, wrapper_port = bench._free_port(), bench._free_port()
+    args.upstream = f"http://127.0.0.1:{stub_port}"
+    args.wrapper = f"http://127.0.0.1:{wrapper_port}"
+    log = open(args.spawn_log, "w") if args.spawn_log else subprocess.DEVNULL
+    if args.stub == "mock":
+        stub_cmd = [sys.executable, MOCK_SCRIPT, "--port", str(stub_port)]
+    else:
+        stub_cmd = [sys.executable, os.path.abspath(__file__), *args.capture, "--serve-stub",
+                    "--port", str(stub_port), "--upstream-speed", str(args.upstream_speed)]
+    stub = subprocess.Popen(stub_cmd, stdout=log, stderr=log)
+    wrapper = subprocess.Popen(
+        [sys.executable, WRAPPER_SCRIPT, "--host", "127.0.0.1", "--port", str(wrapper_port),
+         "--ccs-base", args.upstream, "--log-level", "warning", *args.wrapper_args.split()],
+        stdout=log, stderr=log,
+    )
+    args.wrapper_pid = wrapper.pid
+    return [stub, wrapper]
+
+
+async def _stub_stats(upstream: str) -> dict | None:
+    try:
+        async with httpx.AsyncClient(timeout=5) as client:
+            r = await client.get(f"{upstream}/stub/stats")
+            return r.json() if r.status_code == 200 else None
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+async def main(args) -> int:
+    records = load_capture(args.capture, args.endpoints, args.limit)
+    records = [r for r in records if r.get("body") is not None]
+    if not records:
+        bench._status("❌ No replayable records (body missing or filtered out)")
+        return 2
+    span = records[-1].get("t", 0) - records[0].get("t", 0)
+    bench._status(f"▶ {len(records)} records over {span:.1f}s × {args.multiply}"
+                  f" @ speed {args.speed or 'max'}, concurrency {args.concurrency or 'as recorded'}")
+
+    procs = _spawn(args) if args.spawn else []
+    try:
+        if procs:
+            await bench._wait_ready(f"{args.upstream}/v1/models", procs[0])
+            await bench._wait_ready(f"{args.wrapper}/health", procs[1])
+        pid = args.wrapper_pid or await bench._wrapper_pid(args.wrapper)
+        report = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "git": bench._git_rev(),
+                "capture": [os.path.abspath(os.path.expanduser(p)) for p in args.capture],
+                "records": len(records),
+                "anonymized": all(r.get("anonymized", True) for r in records),
+                "wrapper": args.wrapper,
+                "upstream": args.upstream if args.spawn else None,
+                "stub": args.stub if args.spawn else None,
+                "wrapper_pid": pid,
+                "speed": args.speed,
+                "upstream_speed": args.upstream_speed,
+                "concurrency": args.concurrency,
+                "multiply": args.multiply,
+            },
+        }
+        report["replay"] = await replay(args, records, pid)
+        if args.spawn and args.stub == "recorded":
+            report["meta"]["stub_stats"] = await _stub_stats(args.upstream)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    for name, entry in report["replay"]["groups"].items():
+        replayed, recorded = entry["replay"], entry["recorded"]
+        bench._status(f"   {name}: ttft p50={replayed['ttft_ms']['p50']}ms (recorded {recorded['ttft_ms']['p50']}ms)"
+                      f"  p99={replayed['ttft_ms']['p99']}ms  errors={replayed['errors']}")
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+        bench._status(f"📄 Results: {args.out}")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            bench._status(f"❌ {len(regressions)} regression(s) vs {args.compare}:")
+            for line in regressions:
+                bench._status(f"   {line}")
+            return 1
+        bench._status(f"✅ No regressions vs {args.compare} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+def serve_stub(args):
+    import uvicorn
+
+    records = load_capture(args.capture, args.endpoints, args.limit)
+    uvicorn.run(create_stub(records, args.upstream_speed), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured wrapper traffic")
+    parser.add_argument("capture", nargs="+", help="캡처 파일 또는 디렉터리 (회전된 파일 포함)")
+    parser.add_argument("--wrapper", default="http://127.0.0.1:8318")
+    parser.add_argument("--wrapper-pid", type=int, default=None, help="CPU/RSS 측정 대상 (기본: /health의 pid)")
+    parser.add_argument("--spawn", action="store_true", help="업스트림 stub + 래퍼를 임시 포트로 띄워서 재생")
+    parser.add_argument("--stub", choices=("recorded", "mock"), default="recorded",
+                        help="--spawn 업스트림: 기록된 응답 재생 또는 mock-ccs.py")
+    parser.add_argument("--spawn-log", default=None, help="--spawn 프로세스 출력 파일")
+    parser.add_argument("--wrapper-args", default="", help='--spawn 래퍼 추가 인자, 예: "--workers 2"')
+    parser.add_argument("--speed", type=float, default=1.0, help="요청 간격 배속 (2 = 두 배 빠르게, 0 = 간격 무시)")
+    parser.add_argument("--upstream-speed", type=float, default=1.0,
+                        help="stub 응답 타이밍 배속 (0 = 기다리지 않음)")
+    parser.add_argument("-c", "--concurrency", type=int, default=0,
+                        help="동시 요청 상한 (0 = 기록된 간격이 만드는 만큼, --speed 0이면 8)")
+    parser.add_argument("--multiply", type=int, default=1, help="레코드마다 보낼 요청 수 (부하 배수)")
+    parser.add_argument("--endpoints", default=None, type=lambda v: [s for s in v.split(",") if s],
+                        help="재생할 엔드포인트 (쉼표 구분: chat,messages)")
+    parser.add_argument("--limit", type=int, default=None, help="앞에서부터 N개 레코드만")
+    parser.add_argument("--keep-cache", action="store_true", help="응답 캐시/동일 요청 합치기를 건너뛰지 않음")
+    parser.add_argument("--out", default=None, help="결과 JSON 파일 (기본: stdout)")
+    parser.add_argument("--compare", default=None, help="기준 결과 JSON")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="회귀 판정 허용 비율")
+    parser.add_argument("--serve-stub", action="store_true", help="(내부) 기록된 응답 stub 서버로 실행")
+    parser.add_argument("--port", type=int, default=8317, help="--serve-stub 포트")
+    args = parser.parse_args()
+    if args.serve_stub:
+        serve_stub(args)
+        sys.exit(0)
+    if args.speed == 0 and args.concurrency == 0:
+        args.concurrency = 8
+    if args.multiply < 1:
+        parser.error("--multiply must be >= 1")
+    args.upstream = None
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,115 @@
+"""
+테스트 공통 fixture
+===================
+- tw: thinking-wrapper.py 모듈 (파일명에 '-'가 있어 importlib로 로드)
+- mock_ccs: bench/mock-ccs.py를 임시 포트로 띄운 업스트림 (세션 동안 하나)
+- mock: mock 설정 변경/통계 조회 헬퍼 (테스트가 끝나면 설정 복원)
+- wrapper: 래퍼 앱을 같은 프로세스의 uvicorn 스레드로 띄운 주소 (모듈 전역 설정을 테스트에서 바로 바꿀 수 있다)
+
+실행: python -m pytest -q
+"""
+
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+import uvicorn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WRAPPER_SCRIPT = os.path.join(ROOT, "thinking-wrapper.py")
+MOCK_SCRIPT = os.path.join(ROOT, "bench", "mock-ccs.py")
+
+# 테스트용 mock 기본값: 빠르게 끝나는 짧은 응답
+MOCK_DEFAULTS = {"ttft": 0.01, "tps": 0.0, "output_tokens": 20, "thinking_tokens": 10, "tool_calls": 0,
+                 "error_rate": 0.0, "error_status": 529, "error_models": ""}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_http(url: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url}: not ready after {timeout}s")
+
+
+@pytest.fixture(scope="session")
+def tw():
+    spec = importlib.util.spec_from_file_location("thinking_wrapper", WRAPPER_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.ROUTING_CONFIG = None  # 사용자 홈의 라우팅 설정을 읽지 않음
+    module.RETRY["backoff"] = 0.0  # mock 에러는 retry-after: 0 → 재시도 대기 없이
+    return module
+
+
+@pytest.fixture(scope="session")
+def mock_ccs():
+    port = _free_port()
+    args = [sys.executable, MOCK_SCRIPT, "--port", str(port)]
+    for key, value in MOCK_DEFAULTS.items():
+        args += [f"--{key.replace('_', '-')}", str(value)]
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        _wait_http(f"{base}/v1/models")
+        yield base
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+class MockControl:
+    def __init__(self, base: str):
+        self.base = base
+
+    def config(self, **updates) -> dict:
+        r = httpx.post(f"{self.base}/mock/config", json=updates, timeout=5)
+        r.raise_for_status()
+        return r.json()
+
+    def stats(self) -> dict:
+        return httpx.get(f"{self.base}/mock/stats", timeout=5).json()
+
+    def calls(self, path: str) -> int:
+        return self.stats().get(path, 0)
+
+
+@pytest.fixture
+def mock(mock_ccs):
+    control = MockControl(mock_ccs)
+    try:
+        yield control
+    finally:
+        control.config(**MOCK_DEFAULTS)
+
+
+@pytest.fixture(scope="session")
+def wrapper(tw, mock_ccs):
+    tw.CCS_BASE = mock_ccs
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(tw.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{port}"
+    try:
+        _wait_http(f"{base}/health")
+        yield base
+    finally:
+        server.should_exit = True
+        thread.join(10)
@@ -0,0 +1,96 @@
+"""동일 요청 합치기: 기본은 끔, 결정적 요청만 합치고 스트림 버퍼는 가장 느린 구독자까지만"""
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+
+def _messages(text: str, stream: bool = False, **extra) -> dict:
+    return {"model": "claude-sonnet-4-6", "max_tokens": 100, "stream": stream,
+            "messages": [{"role": "user", "content": text}], **extra}
+
+
+@pytest.fixture
+def coalesce(tw, monkeypatch):
+    monkeypatch.setitem(tw.COALESCE, "enabled", True)
+    monkeypatch.setattr(tw, "_coalesce_stats", dict.fromkeys(tw._coalesce_stats, 0))
+    return tw._coalesce_stats
+
+
+def _key(tw, body: dict | None, endpoint: str = "messages"):
+    request = SimpleNamespace(headers=httpx.Headers())
+    raw = json.dumps(body or {}).encode()
+    return tw._coalesce_key(endpoint, request, raw, tw._LazyBody(raw) if body is not None else None)
+
+
+def test_off_by_default(tw):
+    assert tw.COALESCE["enabled"] is False
+    assert _key(tw, _messages("hi", temperature=0)) is None
+
+
+def test_only_deterministic_requests(tw, coalesce):
+    assert _key(tw, _messages("hi", temperature=0)) is not None
+    assert _key(tw, _messages("hi", temperature=0.7)) is None
+    assert _key(tw, _messages("hi")) is None  # 미지정은 1.0
+    assert _key(tw, None, "count_tokens") is not None
+    assert coalesce["sampled"] == 2
+
+
+async def _send_all(wrapper: str, bodies: list[dict]) -> list[httpx.Response]:
+    async with httpx.AsyncClient(timeout=30) as client:
+        responses = await asyncio.gather(*(client.post(f"{wrapper}/v1/messages", json=b) for b in bodies))
+        for r in responses:
+            await r.aread()
+        return responses
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_concurrent_identical_requests_share_one_call(tw, wrapper, mock, coalesce, stream):
+    mock.config(ttft=0.3)
+    before = mock.calls("/v1/messages")
+    body = _messages(f"coalesce {stream}", stream=stream, temperature=0)
+    responses = asyncio.run(_send_all(wrapper, [body] * 3))
+    assert [r.status_code for r in responses] == [200] * 3
+    assert len({r.content for r in responses}) == 1
+    assert mock.calls("/v1/messages") - before == 1
+    assert coalesce["leaders"] == 1 and coalesce["followers"] == 2
+    assert tw._flights == {}
+
+
+def test_sampled_requests_are_not_merged(tw, wrapper, mock, coalesce):
+    mock.config(ttft=0.3)
+    before = mock.calls("/v1/messages")
+    responses = asyncio.run(_send_all(wrapper, [_messages("sampled", temperature=0.7)] * 3))
+    assert [r.status_code for r in responses] == [200] * 3
+    assert mock.calls("/v1/messages") - before == 3
+    assert coalesce["followers"] == 0
+
+
+def test_broadcast_trims_to_slowest_subscriber(tw):
+    async def run():
+        release = asyncio.Event()
+
+        async def source():
+            for i in range(3):
+                yield f"chunk {i}\n\n"
+            await release.wait()
+            yield "last\n\n"
+
+        detached = []
+        shared = tw._Broadcast(tw._SSEResponse(source()), on_detach=lambda: detached.append(True))
+        fast, slow = shared.join(), shared.join()
+        assert [await anext(fast) for _ in range(3)] == ["chunk 0\n\n", "chunk 1\n\n", "chunk 2\n\n"]
+        assert len(shared.chunks) == 3 and shared.base == 0  # slow는 아직 못 읽음
+        assert await anext(slow) == "chunk 0\n\n"
+        assert shared.base == 1 and len(shared.chunks) == 2 and detached == [True]
+        assert shared.join() is None  # 앞부분을 버렸으니 늦게 온 구독자는 받지 않는다
+        await slow.aclose()
+        assert shared.chunks == [] and shared.base == 3
+        release.set()
+        assert [c async for c in fast] == ["last\n\n"]
+        await shared._task
+
+    asyncio.run(run())
@@ -0,0 +1,110 @@
+"""컨텍스트 예산 축소 (_trim_history): 턴 단위로 자르고 user/assistant 교대와 tool_use/tool_result 짝을 지킨다"""
+
+import copy
+import json
+
+import pytest
+
+BIG = "x" * 4000
+RATIO = 4.0
+
+
+def _turn(n: int, tools: int = 1) -> list[dict]:
+    """user 질문 → (assistant tool_use → user tool_result) × tools → assistant 답"""
+    messages = [{"role": "user", "content": f"question {n}"}]
+    for t in range(tools):
+        tool_id = f"toolu_{n}_{t}"
+        messages.append({"role": "assistant", "content": [
+            {"type": "tool_use", "id": tool_id, "name": "read", "input": {"path": f"/f{n}"}}]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": tool_id, "content": BIG}]})
+    messages.append({"role": "assistant", "content": f"answer {n}"})
+    return messages
+
+
+def _conversation(turns: int = 6) -> list[dict]:
+    messages = [m for n in range(turns) for m in _turn(n)]
+    messages[0] = {"role": "user", "content": "task instruction"}
+    return messages
+
+
+def _assert_well_formed(messages: list[dict]):
+    roles = [m["role"] for m in messages]
+    assert roles[0] == "user"
+    assert all(a != b for a, b in zip(roles, roles[1:])), roles
+    for prev, msg in zip(messages, messages[1:]):
+        content = msg["content"] if isinstance(msg["content"], list) else []
+        results = {b["tool_use_id"] for b in content if b.get("type") == "tool_result"}
+        if results:
+            uses = {b["id"] for b in prev["content"] if isinstance(b, dict) and b.get("type") == "tool_use"}
+            assert results <= uses, (results, uses)
+
+
+@pytest.fixture
+def keep_recent(tw, monkeypatch):
+    monkeypatch.setitem(tw.CONTEXT_BUDGET, "keep_recent", 4)
+
+
+def test_stubs_old_tool_results_first(tw, keep_recent):
+    messages = _conversation()
+    original = copy.deepcopy(messages)
+    shared = list(messages)
+    saved = tw._trim_history(messages, 1, RATIO)
+    assert saved > 0 and len(messages) == len(original)
+    assert messages[2]["content"][0]["content"] == tw.TRIMMED_TOOL_RESULT
+    assert shared == original  # 공유된 메시지 dict는 바꾸지 않는다
+    _assert_well_formed(messages)
+
+
+def test_drops_whole_turns_and_merges_seam(tw, keep_recent):
+    messages = _conversation()
+    dropped = tw._context_stats["messages_dropped"]
+    tw._trim_history(messages, 1e9, RATIO)
+    _assert_well_formed(messages)
+    # 첫 지시는 남고, 그 뒤에 바로 이어진 user 턴과 하나로 합쳐진다
+    assert messages[0]["role"] == "user"
+    assert messages[0]["content"].startswith("task instruction\n\nquestion ")
+    assert messages[-3:] == _conversation()[-3:]  # 최근 메시지는 그대로 (첫 메시지는 합쳐진 턴 시작)
+    assert tw._context_stats["messages_dropped"] > dropped
+
+
+def test_tool_loop_in_recent_window_stays_paired(tw, monkeypatch):
+    monkeypatch.setitem(tw.CONTEXT_BUDGET, "keep_recent", 3)
+    messages = [{"role": "user", "content": "task"}, {"role": "assistant", "content": "ok"}]
+    messages += _turn(1, tools=3) + _turn(2, tools=3)
+    tw._trim_history(messages, 1e9, RATIO)
+    _assert_well_formed(messages)
+    assert messages[0]["content"] == "task\n\nquestion 2"
+
+
+def test_no_turn_boundary_keeps_messages(tw, keep_recent):
+    messages = [{"role": "user", "content": "task"}] + _turn(1, tools=4)[1:]
+    tw._trim_history(messages, 1e9, RATIO)
+    assert len(messages) == 10
+    _assert_well_formed(messages)
+
+
+def _thinking_body(tw, budget: int, requested: int):
+    body = {"model": "claude-opus-4-6", "max_tokens": requested,
+            "thinking": {"type": "enabled", "budget_tokens": budget},
+            "messages": [{"role": "user", "content": BIG * 4}]}
+    return tw._LazyBody(json.dumps(body).encode())
+
+
+@pytest.mark.parametrize("window, min_output, budget, expected", [
+    (10400, 4096, 6000, "clamped"),    # 출력 여유가 budget보다 작다 → budget = max_tokens − 1
+    (5850, 512, 4000, "disabled"),    # 거의 찬 윈도우: max_tokens ≤ 1024 → thinking 끔
+])
+def test_thinking_budget_below_fitted_max_tokens(tw, monkeypatch, window, min_output, budget, expected):
+    monkeypatch.setattr(tw, "CONTEXT_WINDOWS", {"default": window})
+    monkeypatch.setitem(tw.CONTEXT_BUDGET, "min_output", min_output)
+    body = _thinking_body(tw, budget, 8000)
+    max_tokens, trimmed, _ = tw._fit_context(body, "claude-opus-4-6", 8000, 32000)
+    assert trimmed is None and 0 < max_tokens < budget
+
+    tw._fit_thinking_budget(body, "claude-opus-4-6", max_tokens)
+    thinking = json.loads(body.encode()).get("thinking")
+    if expected == "clamped":
+        assert thinking["budget_tokens"] == max_tokens - 1 >= tw.THINKING_MIN_BUDGET
+    else:
+        assert max_tokens <= tw.THINKING_MIN_BUDGET and thinking is None
@@ -0,0 +1,51 @@
+"""OpenAI → Anthropic 메시지 변환 캐시: 캐시된 prefix 뒤의 메시지만 꺼내서 변환"""
+
+import json
+
+import pytest
+
+
+def _messages(turns: int) -> list[dict]:
+    messages = [{"role": "system", "content": "sys"}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"q{i}"})
+        messages.append({"role": "assistant", "content": f"a{i}"})
+    return messages
+
+
+def _lazy_items(tw, messages: list[dict]) -> list[tuple]:
+    """원본 텍스트만 있는 원소 (값은 호출할 때 디코딩)"""
+    return [(text, tw._LazyValue(text)) for text in (json.dumps(m) for m in messages)]
+
+
+@pytest.fixture
+def cache(tw, monkeypatch):
+    monkeypatch.setattr(tw, "_conversion_cache", tw._LRU(16))
+    monkeypatch.setattr(tw, "_conversion_stats", {"hits": 0, "misses": 0, "reused_msgs": 0, "converted_msgs": 0})
+    return tw
+
+
+def test_prefix_hit_decodes_only_new_messages(cache, monkeypatch):
+    tw = cache
+    decoded = []
+    loads = tw._loads
+    monkeypatch.setattr(tw, "_loads", lambda data: decoded.append(data) or loads(data))
+
+    first, system = tw._convert_messages(_lazy_items(tw, _messages(3)))
+    assert len(decoded) == 7 and system == "sys"
+
+    decoded.clear()
+    messages = _messages(3) + [{"role": "user", "content": "next"}]
+    merged, system = tw._convert_messages(_lazy_items(tw, messages))
+    assert decoded == [json.dumps(messages[-1])]
+    assert tw._conversion_stats["hits"] == 1 and tw._conversion_stats["reused_msgs"] == 7
+    assert system == "sys" and merged[:-1] == first and merged[-1]["content"] == "next"
+
+
+def test_lazy_body_items_match_plain_conversion(cache, monkeypatch):
+    tw = cache
+    monkeypatch.setattr(tw, "orjson", None)  # 원소 텍스트 해시 경로
+    raw = json.dumps({"model": "m", "messages": _messages(2)}, indent=1).encode()
+    via_body = tw._convert_messages(tw._LazyBody(raw).items("messages"))
+    via_values = tw._convert_messages([(None, tw._LazyValue(None, m)) for m in _messages(2)])
+    assert via_body == via_values
@@ -0,0 +1,55 @@
+"""클라이언트가 먼저 끊으면 업스트림 호출/스트림을 끊고 스케줄러 슬롯을 돌려준다"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+
+def _messages(text: str, stream: bool) -> dict:
+    return {"model": "claude-sonnet-4-6", "max_tokens": 100, "stream": stream,
+            "messages": [{"role": "user", "content": text}]}
+
+
+def _wait_for(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def limiter(tw, monkeypatch):
+    """passthrough 슬롯 1개 (끊긴 요청이 슬롯을 돌려주는지 보려고)"""
+    monkeypatch.setattr(tw._scheduler, "limiters", {})
+    monkeypatch.setattr(tw, "ROUTE_CONCURRENCY", {"passthrough": 1})
+    return lambda: tw._scheduler.limiters["route:passthrough"]
+
+
+def test_nonstream_disconnect_cancels_upstream(tw, wrapper, mock, limiter):
+    mock.config(ttft=1.5)
+    cancelled = tw._cancel_stats["nonstream_disconnects"]
+    with pytest.raises(httpx.ReadTimeout):
+        httpx.post(f"{wrapper}/v1/messages", json=_messages("leave early", False), timeout=0.3)
+    _wait_for(lambda: tw._cancel_stats["nonstream_disconnects"] == cancelled + 1)
+    _wait_for(lambda: limiter().active == 0)
+
+
+def test_stream_disconnect_closes_upstream(tw, wrapper, mock, limiter, monkeypatch):
+    mock.config(ttft=0.01, tps=20, output_tokens=200)  # 끝까지 읽으면 10초
+    monkeypatch.setattr(tw, "QUEUE_HOLD_STREAM", True)  # 스트림 끝까지 슬롯을 잡는 경우에도 반납되는지
+    disconnects = tw._cancel_stats["stream_disconnects"]
+
+    async def read_first_chunk():
+        async with httpx.AsyncClient(timeout=30) as client:
+            async with client.stream("POST", f"{wrapper}/v1/messages", json=_messages("stream away", True)) as r:
+                assert r.status_code == 200
+                async for _ in r.aiter_raw():
+                    return
+
+    started = time.monotonic()
+    asyncio.run(read_first_chunk())
+    _wait_for(lambda: tw._cancel_stats["stream_disconnects"] == disconnects + 1)
+    _wait_for(lambda: limiter().active == 0)
+    assert time.monotonic() - started < 5
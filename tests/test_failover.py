@@ -0,0 +1,77 @@
+"""재시도 후 fallback 체인: 업스트림 429/5xx만 다음 모델로, 래퍼 자체 거절은 그대로"""
+
+import httpx
+import pytest
+
+
+def _chat(model: str, text: str) -> dict:
+    return {"model": model, "stream": True, "messages": [{"role": "user", "content": text}]}
+
+
+def _messages(model: str, text: str) -> dict:
+    return {"model": model, "max_tokens": 100, "messages": [{"role": "user", "content": text}]}
+
+
+@pytest.fixture
+def chain(tw, monkeypatch):
+    monkeypatch.setitem(tw.RETRY, "attempts", 1)
+    monkeypatch.setattr(tw, "FALLBACK_CHAINS", {"gpt-5-mini": ["gemini-3-pro-preview", "claude-sonnet-4-6"]})
+    return tw.FALLBACK_CHAINS["gpt-5-mini"]
+
+
+def test_chat_falls_through_chain(tw, wrapper, mock, chain):
+    mock.config(error_models="gpt-5-mini,gemini-3-pro-preview")
+    before = mock.stats()
+    failovers = tw._resilience_stats["failovers"]
+    r = httpx.post(f"{wrapper}/v1/chat/completions", json=_chat("gpt-5-mini", "chain chat"), timeout=30)
+    after = mock.stats()
+    assert r.status_code == 200
+    assert '"model": "claude-sonnet-4-6"' in r.text
+    for model in ("gpt-5-mini", *chain):
+        assert after.get(f"model:{model}", 0) - before.get(f"model:{model}", 0) == 1
+    assert tw._resilience_stats["failovers"] - failovers == 2
+
+
+def test_messages_falls_over_once(wrapper, mock, chain):
+    mock.config(error_models="gpt-5-mini")
+    before = mock.stats()
+    r = httpx.post(f"{wrapper}/v1/messages", json=_messages("gpt-5-mini", "chain messages"), timeout=30)
+    after = mock.stats()
+    assert r.status_code == 200 and r.json()["model"] == "gemini-3-pro-preview"
+    assert after.get("model:claude-sonnet-4-6", 0) == before.get("model:claude-sonnet-4-6", 0)
+
+
+def test_exhausted_chain_returns_last_upstream_error(wrapper, mock, chain):
+    mock.config(error_models="gpt-5-mini,gemini-3-pro-preview,claude-sonnet-4-6")
+    r = httpx.post(f"{wrapper}/v1/messages", json=_messages("gpt-5-mini", "all down"), timeout=30)
+    assert r.status_code == 529
+    assert "X-CCS-Rejected" not in r.headers
+
+
+def test_non_failover_status_is_returned(wrapper, mock, chain):
+    mock.config(error_models="gpt-5-mini", error_status=400)
+    before = mock.stats()
+    r = httpx.post(f"{wrapper}/v1/messages", json=_messages("gpt-5-mini", "bad request"), timeout=30)
+    assert r.status_code == 400
+    assert mock.stats().get("model:gemini-3-pro-preview", 0) == before.get("model:gemini-3-pro-preview", 0)
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/v1/chat/completions", _chat("gpt-5-mini", "local reject chat")),
+    ("/v1/messages", _messages("gpt-5-mini", "local reject messages")),
+])
+def test_local_rejection_is_not_failed_over(tw, wrapper, mock, chain, monkeypatch, path, body):
+    # passthrough 슬롯 하나를 이미 쓰고 있고 대기열 없음 → 래퍼가 바로 429
+    monkeypatch.setattr(tw, "ROUTE_CONCURRENCY", {"passthrough": 1})
+    monkeypatch.setattr(tw, "QUEUE_MAX_WAITERS", 0)
+    limiter = tw._Limiter("route:passthrough", 1)
+    limiter.active = 1
+    monkeypatch.setattr(tw._scheduler, "limiters", {"route:passthrough": limiter})
+    before = mock.stats()
+    failovers = tw._resilience_stats["failovers"]
+
+    r = httpx.post(f"{wrapper}{path}", json=body, timeout=30)
+    assert r.status_code == 429
+    assert r.headers["X-CCS-Rejected"] == "queue-full"
+    assert tw._resilience_stats["failovers"] == failovers
+    assert mock.stats() == before  # 업스트림 호출 없음
@@ -0,0 +1,134 @@
+"""prompt cache breakpoint 배치: _LazyBody는 표시한 원소만 바꿔 끼우고 나머지 바이트는 그대로"""
+
+import asyncio
+import copy
+import json
+
+import pytest
+
+BIG = "lorem ipsum " * 500  # min_chars(4000)를 넘는 크기
+
+
+def _body() -> dict:
+    return {
+        "model": "claude-opus-4-6-thinking",
+        "max_tokens": 1000,
+        "tools": [{"name": "read", "description": BIG, "input_schema": {"type": "object"}},
+                  {"name": "write", "description": "w", "input_schema": {"type": "object"}}],
+        "system": "you are helpful",
+        "messages": [
+            {"role": "user", "content": BIG},
+            {"role": "assistant", "content": [{"type": "thinking", "thinking": "t"}, {"type": "text", "text": "ok"}]},
+            {"role": "user", "content": [{"type": "text", "text": "next"}]},
+            {"role": "assistant", "content": "sure"},
+            {"role": "user", "content": "again"},
+        ],
+    }
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def parser(request, tw, monkeypatch):
+    """orjson 유무 두 경로를 모두 돌린다"""
+    if request.param == "orjson":
+        if tw.orjson is None:
+            pytest.skip("orjson not installed")
+    else:
+        monkeypatch.setattr(tw, "orjson", None)
+    return request.param
+
+
+def test_lazy_matches_dict_planning(tw, parser, monkeypatch):
+    def no_full_parse(self):
+        raise AssertionError("full parse")
+
+    expected = _body()
+    placed_dict = tw._plan_cache_breakpoints(expected)
+
+    raw = json.dumps(_body(), indent=1).encode()  # 원본 서식이 남는지 보려고 공백 포함
+    body = tw._LazyBody(raw)
+    monkeypatch.setattr(tw._LazyBody, "json", no_full_parse)
+    placed_lazy = tw._plan_cache_breakpoints(body)
+    encoded = body.encode()
+
+    assert placed_lazy == placed_dict == 4
+    assert json.loads(encoded) == expected
+    if parser == "orjson":
+        return
+    # stdlib 경로: 바꾸지 않은 원소는 원본 텍스트 그대로
+    untouched = json.dumps(_body()["messages"][1], indent=1).replace("\n", "\n  ")
+    assert untouched.encode() in encoded
+
+
+def test_short_conversation_untouched(tw, parser):
+    raw = json.dumps({"model": "m", "messages": [{"role": "user", "content": "hi"}]}).encode()
+    body = tw._LazyBody(raw)
+    assert tw._plan_cache_breakpoints(body) == 0
+    assert body.encode() is raw
+
+
+def test_dict_planning_does_not_mutate_shared_lists(tw):
+    body = _body()
+    messages, tools = body["messages"], body["tools"]
+    before = copy.deepcopy(messages)
+    tw._plan_cache_breakpoints(body)
+    assert messages == before and "cache_control" not in tools[-1]
+    assert body["messages"][-1]["content"][0]["cache_control"] == {"type": "ephemeral"}
+
+
+def test_set_item_then_whole_value(tw, parser):
+    body = tw._LazyBody(b'{"messages": [{"a": 1}, {"b": 2}], "x": 1}')
+    body.set_item("messages", -1, {"b": 3})
+    assert body.size("messages") == 2
+    assert [lazy() for _, lazy in body.items("messages")] == [{"a": 1}, {"b": 3}]
+    assert json.loads(body.encode()) == {"messages": [{"a": 1}, {"b": 3}], "x": 1}
+    assert body.get("messages") == [{"a": 1}, {"b": 3}]  # 값 전체를 읽으면 전체 변경으로 승격
+    body["messages"] = []
+    assert json.loads(body.encode()) == {"messages": [], "x": 1}
+
+
+@pytest.mark.parametrize("raw", [b'{"messages": []}', b'{"messages": [ ] , "m": [1, [2], {"k": [3]}]}'])
+def test_scan_lists(tw, parser, raw):
+    body = tw._LazyBody(raw)
+    assert body.get("messages") == []
+    assert body.encode() is raw
+    assert json.loads(raw) == {k: body.get(k) for k in json.loads(raw)}
+
+
+def test_orjson_body_reencodes_only_when_changed(tw):
+    if tw.orjson is None:
+        pytest.skip("orjson not installed")
+    raw = json.dumps(_body(), indent=1).encode()
+    body = tw._LazyBody(raw)
+    assert body.get("model") == "claude-opus-4-6-thinking"
+    assert body.encode() is raw
+    body["max_tokens"] = 10
+    assert json.loads(body.encode())["max_tokens"] == 10
+
+
+@pytest.fixture
+def sent(tw, monkeypatch):
+    """_route_messages가 passthrough로 보내는 본문"""
+    bodies = []
+
+    async def capture(url, body, is_stream, route="passthrough", priority=0):
+        bodies.append(json.loads(body.encode()))
+
+    monkeypatch.setattr(tw, "_messages_passthrough", capture)
+    return bodies
+
+
+@pytest.mark.parametrize("model, placed", [("claude-sonnet-4-6", True), ("gpt-5-mini", False)])
+def test_passthrough_messages_get_breakpoints(tw, sent, model, placed):
+    body = {**_body(), "model": model}
+    asyncio.run(tw._route_messages(tw._LazyBody(json.dumps(body).encode()), model, False, 0))
+    assert ("cache_control" in json.dumps(sent[0])) is placed
+    if placed:
+        assert sent[0]["messages"][-1]["content"][0]["cache_control"] == {"type": "ephemeral"}
+
+
+def test_passthrough_keeps_client_markers(tw, sent):
+    body = _body()
+    body["model"] = "claude-sonnet-4-6"
+    body["system"] = [{"type": "text", "text": "sys", "cache_control": {"type": "ephemeral"}}]
+    asyncio.run(tw._route_messages(tw._LazyBody(json.dumps(body).encode()), body["model"], False, 0))
+    assert sent[0] == body
@@ -0,0 +1,74 @@
+"""응답 캐시: 키는 본문 전체 파싱 없이, 결정적 요청만 저장하고 같은 요청은 업스트림 없이 응답"""
+
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+
+def _messages(text: str, **extra) -> dict:
+    return {"model": "claude-sonnet-4-6", "max_tokens": 100, "temperature": 0,
+            "messages": [{"role": "user", "content": text}], **extra}
+
+
+def _key(tw, body: dict, headers: dict | None = None, raw: bytes | None = None) -> str | None:
+    request = SimpleNamespace(headers=httpx.Headers(headers or {}))
+    lazy = tw._LazyBody(raw if raw is not None else json.dumps(body).encode())
+    return tw._response_cache_key("messages", request, lazy, lazy.get("model"))
+
+
+@pytest.fixture
+def cache(tw, monkeypatch):
+    monkeypatch.setitem(tw.RESPONSE_CACHE, "enabled", True)
+    cache = tw._ResponseCache()
+    monkeypatch.setattr(tw, "_response_cache", cache)
+    return cache
+
+
+def test_key_without_full_parse(tw, cache, monkeypatch):
+    def no_full_parse(self):
+        raise AssertionError("full parse")
+
+    monkeypatch.setattr(tw._LazyBody, "json", no_full_parse)
+    base = _key(tw, _messages("hi"))
+    assert base is not None
+    # 응답과 무관한 필드 / 최상위 키 순서는 키에 영향 없음
+    assert _key(tw, _messages("hi", stream=True, metadata={"user_id": "u"})) == base
+    assert _key(tw, dict(reversed(list(_messages("hi").items())))) == base
+    assert _key(tw, _messages("hello")) != base
+    assert _key(tw, {**_messages("hi"), "model": "claude-opus-4-6"}) != base
+
+
+def test_changed_member_is_part_of_key(tw, cache):
+    request = SimpleNamespace(headers=httpx.Headers())
+    aliased = tw._LazyBody(json.dumps({**_messages("hi"), "model": "claude-haiku-4-5"}).encode())
+    aliased["model"] = "claude-sonnet-4-6"
+    assert tw._response_cache_key("messages", request, aliased, "claude-sonnet-4-6") == _key(tw, _messages("hi"))
+
+
+def test_not_cached(tw, cache):
+    assert _key(tw, {**_messages("hi"), "temperature": 0.7}) is None
+    assert _key(tw, {k: v for k, v in _messages("hi").items() if k != "temperature"}) is None
+    assert _key(tw, _messages("hi"), headers={"x-ccs-cache": "bypass"}) is None
+    assert cache.stats["bypass"] == 3
+
+
+def test_hit_and_miss(tw, wrapper, mock, cache):
+    body = _messages("cache e2e")
+    before = mock.calls("/v1/messages")
+    first = httpx.post(f"{wrapper}/v1/messages", json=body, timeout=30)
+    second = httpx.post(f"{wrapper}/v1/messages", json=body, timeout=30)
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json()
+    assert mock.calls("/v1/messages") - before == 1
+    assert cache.stats["misses"] == 1 and cache.stats["hits_memory"] == 1
+
+    # 스트리밍 요청도 같은 키 → 저장된 응답을 SSE로 재생
+    streamed = httpx.post(f"{wrapper}/v1/messages", json={**body, "stream": True}, timeout=30)
+    assert "event: message_stop" in streamed.text
+    assert mock.calls("/v1/messages") - before == 1
+
+    bypass = httpx.post(f"{wrapper}/v1/messages", json=body, headers={"X-CCS-Cache": "bypass"}, timeout=30)
+    assert bypass.status_code == 200
+    assert mock.calls("/v1/messages") - before == 2
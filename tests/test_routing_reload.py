@@ -0,0 +1,57 @@
+"""라우팅 설정 리로드: 올바른 파일은 새 테이블로 교체, 잘못된 파일은 거부하고 기존 테이블 유지"""
+
+import json
+
+import httpx
+import pytest
+
+
+@pytest.fixture
+def routing_file(tw, tmp_path, monkeypatch):
+    path = tmp_path / "routing.json"
+    monkeypatch.setattr(tw, "ROUTING_CONFIG", str(path))
+    monkeypatch.setattr(tw, "_routing", tw._routing)  # 테스트가 끝나면 원래 테이블로
+    monkeypatch.setattr(tw, "_routing_mtime", tw._routing_mtime)
+    monkeypatch.setattr(tw, "_routing_stats", {"reloads": 0, "errors": 0, "last_error": None})
+    return path
+
+
+def test_reload_applies_valid_file(tw, wrapper, mock, routing_file):
+    routing_file.write_text(json.dumps({"aliases": {"team-default": "claude-sonnet-4-6"},
+                                        "max_tokens": {"claude-sonnet-4-6": 50}}))
+    assert tw._load_routing("test") is True
+    assert tw._routing.source == str(routing_file)
+    assert tw._routing.alias("team-default") == "claude-sonnet-4-6"
+    assert tw._routing.resolve("claude-sonnet-4-6").max_tokens == 50
+    assert tw._routing_stats["reloads"] == 1
+
+    before = mock.stats()
+    body = {"model": "team-default", "max_tokens": 100, "messages": [{"role": "user", "content": "routed"}]}
+    assert httpx.post(f"{wrapper}/v1/messages", json=body, timeout=30).status_code == 200
+    after = mock.stats()
+    assert after.get("model:claude-sonnet-4-6", 0) - before.get("model:claude-sonnet-4-6", 0) == 1
+
+
+@pytest.mark.parametrize("content", [
+    "{not json",
+    json.dumps(["aliases"]),
+    json.dumps({"aliasses": {}}),
+    json.dumps({"effort_suffix": "^(.+)-("}),
+    json.dumps({"effort_suffix": "^(.+)$"}),
+    json.dumps({"thinking": {"claude-opus-4-6-thinking": {"effort": "high"}}}),
+    json.dumps({"max_tokens": {"m": "lots"}}),
+])
+def test_invalid_file_keeps_previous_table(tw, routing_file, content):
+    previous = tw._routing
+    routing_file.write_text(content)
+    assert tw._load_routing("test") is False
+    assert tw._routing is previous
+    assert tw._routing_stats["errors"] == 1 and tw._routing_stats["last_error"]
+    # 같은 파일을 다시 읽지 않도록 mtime은 기록된다
+    assert tw._routing_mtime == routing_file.stat().st_mtime_ns
+
+
+def test_missing_file_falls_back_to_builtin(tw, routing_file):
+    assert tw._load_routing("test") is True
+    assert tw._routing.source == "builtin" and tw._routing_mtime is None
+    assert tw._routing.aliases == {str(k): str(v) for k, v in tw.MODEL_ALIASES.items()}
@@ -0,0 +1,123 @@
+"""업스트림 동시 요청 제한: 우선순위 대기열, 대기 한도/타임아웃, 스트림 슬롯 반환 시점"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+
+def _messages(i: int, stream: bool = True) -> dict:
+    return {"model": "claude-sonnet-4-6", "max_tokens": 100, "stream": stream,
+            "messages": [{"role": "user", "content": f"request {i}"}]}
+
+
+@pytest.fixture
+def limits(tw, monkeypatch):
+    """라우트 상한 설정 (리미터는 처음 쓸 때 만들어지므로 테스트마다 새로)"""
+    monkeypatch.setattr(tw._scheduler, "limiters", {})
+
+    def apply(**route_limits):
+        monkeypatch.setattr(tw, "ROUTE_CONCURRENCY", dict(route_limits))
+    return apply
+
+
+def test_off_by_default(tw):
+    assert tw.ROUTE_CONCURRENCY == {} and tw.MODEL_CONCURRENCY == {}
+
+
+def test_parse_limits(tw):
+    assert tw._parse_limits("thinking=4, passthrough=16") == {"thinking": 4, "passthrough": 16}
+    assert tw._parse_limits("") == {}
+    for bad in ("thinking", "thinking=0", "=3", "a=x"):
+        with pytest.raises(Exception):
+            tw._parse_limits(bad)
+
+
+def test_priority_order(tw):
+    async def run():
+        limiter = tw._Limiter("t", 1)
+        await limiter.acquire(0)
+        order = []
+
+        async def waiter(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+            limiter.release()
+
+        tasks = [asyncio.create_task(waiter("background", 1)), asyncio.create_task(waiter("interactive", 0))]
+        await asyncio.sleep(0.01)
+        assert limiter.depth() == 2
+        limiter.release()
+        await asyncio.gather(*tasks)
+        assert limiter.active == 0
+        return order
+
+    assert asyncio.run(run()) == ["interactive", "background"]
+
+
+def test_queue_timeout(tw, monkeypatch):
+    monkeypatch.setattr(tw, "QUEUE_TIMEOUT", 0.05)
+
+    async def run():
+        limiter = tw._Limiter("t", 1)
+        await limiter.acquire(0)
+        with pytest.raises(tw._QueueFull):
+            await limiter.acquire(0)
+        limiter.release()
+        assert limiter.active == 0 and limiter.depth() == 0
+        return limiter.stats
+
+    stats = asyncio.run(run())
+    assert stats["timeouts"] == 1 and stats["queued"] == 1
+
+
+def test_queue_full_returns_429(tw, monkeypatch, limits):
+    monkeypatch.setattr(tw, "QUEUE_MAX_WAITERS", 1)
+    limits(passthrough=1)
+
+    async def run():
+        release, _ = await tw._scheduler.acquire("passthrough", "m", 0)
+        waiter = asyncio.create_task(tw._scheduler.acquire("passthrough", "m", 0))
+        await asyncio.sleep(0.01)
+        rejected_release, rejected = await tw._scheduler.acquire("passthrough", "m", 0)
+        release()
+        second_release, _ = await waiter
+        second_release()
+        return rejected_release, rejected
+
+    release, response = asyncio.run(run())
+    assert release is None
+    assert response.status_code == 429 and response.headers["retry-after"] == str(tw.QUEUE_RETRY_AFTER)
+    assert tw._scheduler.limiters["route:passthrough"].active == 0
+
+
+async def _stream_all(wrapper: str, count: int) -> list[int]:
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def one(i):
+            async with client.stream("POST", f"{wrapper}/v1/messages", json=_messages(i)) as r:
+                await r.aread()
+                return r.status_code
+        return await asyncio.gather(*(one(i) for i in range(count)))
+
+
+def test_stream_releases_slot_at_first_byte(tw, wrapper, mock, limits):
+    mock.config(ttft=0.05, tps=40, output_tokens=20)  # 스트림 하나 ~0.5초
+    limits(passthrough=1)
+    started = time.monotonic()
+    statuses = asyncio.run(_stream_all(wrapper, 3))
+    elapsed = time.monotonic() - started
+    assert statuses == [200, 200, 200]
+    assert elapsed < 1.2  # 끝까지 잡고 있었다면 3 × 0.5초 이상
+    limiter = tw._scheduler.limiters["route:passthrough"]
+    assert limiter.active == 0 and limiter.stats["acquired"] == 3
+
+
+def test_hold_stream_queues_until_end(tw, wrapper, mock, limits, monkeypatch):
+    mock.config(ttft=0.01, tps=40, output_tokens=20)
+    limits(passthrough=1)
+    monkeypatch.setattr(tw, "QUEUE_HOLD_STREAM", True)
+    monkeypatch.setattr(tw, "QUEUE_TIMEOUT", 0.1)
+    statuses = asyncio.run(_stream_all(wrapper, 2))
+    assert sorted(statuses) == [200, 429]
+    assert tw._scheduler.limiters["route:passthrough"].stats["timeouts"] == 1
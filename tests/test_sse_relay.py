@@ -0,0 +1,65 @@
+"""passthrough SSE 중계 (_relay_sse): 바이트는 그대로, usage는 완성된 프레임에서만"""
+
+import asyncio
+
+import httpx
+import pytest
+
+
+class _Chunks(httpx.AsyncByteStream):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def _relay(tw, chunks) -> bytes:
+    async def run():
+        response = httpx.Response(200, stream=_Chunks(chunks))
+        return b"".join([c async for c in tw._relay_sse(response, "passthrough", "m", b"event: error\n\n")])
+
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def recorded(tw, monkeypatch):
+    usages = []
+    monkeypatch.setattr(tw, "_record_usage", lambda route, model, usage: usages.append(usage))
+    return usages
+
+
+FRAMES = [
+    b'event: message_start\ndata: {"type":"message_start","message":{"usage":{"input_tokens":11}}}\n\n',
+    b'event: content_block_delta\ndata: {"type":"content_block_delta","delta":{"text":"hi"}}\n\n',
+    b'event: message_delta\ndata: {"type":"message_delta","usage":{"output_tokens":7}}\n\n',
+]
+
+
+@pytest.mark.parametrize("newline", [b"\n", b"\r\n"])
+def test_usage_from_frames_split_across_chunks(tw, recorded, newline):
+    raw = b"".join(FRAMES).replace(b"\n", newline)
+    chunks = [raw[i:i + 7] for i in range(0, len(raw), 7)]
+    assert _relay(tw, chunks) == raw  # 바이트는 손대지 않는다
+    assert recorded == [{"input_tokens": 11, "output_tokens": 7}]
+
+
+def test_openai_usage_chunk(tw, recorded):
+    raw = (b'data: {"choices":[{"delta":{"content":"a"}}]}\r\n\r\n'
+           b'data: {"choices":[],"usage":{"prompt_tokens":5,"completion_tokens":3}}\r\n\r\n'
+           b"data: [DONE]\r\n\r\n")
+    _relay(tw, [raw])
+    assert recorded == [{"prompt_tokens": 5, "completion_tokens": 3}]
+
+
+@pytest.mark.parametrize("buf, end", [
+    (b"", 0),
+    (b"data: x\n", 0),
+    (b"data: x\n\ndata: y", 9),
+    (b"data: x\r\n\r\ndata: y", 11),
+    (b"data: x\n\ndata: y\r\n\r\n", 20),
+    (b"data: x\r\n\n", 10),
+])
+def test_sse_frames_end(tw, buf, end):
+    assert tw._sse_frames_end(bytearray(buf)) == end
@@ -0,0 +1,55 @@
+"""로컬 토큰 추정 캐시: 원소 해시로 찾고, 새로 붙은 원소만 추정"""
+
+import json
+
+import pytest
+
+
+def _body(turns: int) -> dict:
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " * 50})
+        messages.append({"role": "assistant", "content": [{"type": "text", "text": f"answer {i} " * 50}]})
+    return {"model": "claude-sonnet-4-6", "system": "be brief", "messages": messages,
+            "tools": [{"name": "read", "description": "read a file", "input_schema": {"type": "object"}}]}
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def estimate(request, tw, monkeypatch):
+    if request.param == "orjson" and tw.orjson is None:
+        pytest.skip("orjson not installed")
+    if request.param == "stdlib":
+        monkeypatch.setattr(tw, "orjson", None)
+    monkeypatch.setattr(tw, "_token_cache", tw._LRU(64))
+    stats = {"cache_hits": 0, "cache_misses": 0}
+    monkeypatch.setattr(tw, "_count_tokens_stats", stats)
+    return lambda body: tw._prompt_estimate(tw._LazyBody(json.dumps(body).encode()), body["model"]), stats
+
+
+def test_repeat_history_hits_cache(estimate):
+    run, stats = estimate
+    first = run(_body(3))
+    assert stats == {"cache_hits": 0, "cache_misses": 8}  # 메시지 6 + system + tool
+
+    body = _body(3)
+    body["messages"].append({"role": "user", "content": "one more"})
+    second = run(body)
+    assert stats == {"cache_hits": 8, "cache_misses": 9}
+    assert second > first
+
+
+def test_convert_and_fit_share_element_hashes(tw, monkeypatch):
+    if tw.orjson is None:
+        pytest.skip("orjson not installed")
+    monkeypatch.setattr(tw, "_token_cache", tw._LRU(64))
+    body = {"model": "claude-opus-4-6-thinking",
+            "messages": [{"role": "user" if i % 2 == 0 else "assistant", "content": f"m{i}"} for i in range(5)]}
+    lazy_body = tw._LazyBody(json.dumps(body).encode())
+    dumped = []
+    dumps = tw._dumps
+    monkeypatch.setattr(tw, "_dumps", lambda obj: dumped.append(obj) or dumps(obj))
+
+    items = lazy_body.items("messages")
+    messages, _ = tw._convert_messages(items)
+    tw._fit_context(lazy_body, body["model"], 1000, 32000, messages, items)
+    assert len(dumped) == 5  # 메시지마다 한 번 (변환 해시 → 추정 캐시 키로 재사용)
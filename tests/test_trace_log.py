@@ -0,0 +1,36 @@
+"""--trace-log: 요청 trace는 로그 writer 스레드가 파일에 쓴다 (이벤트 루프에서 open/write 안 함)"""
+
+import builtins
+import json
+import threading
+import time
+
+import httpx
+
+
+def test_trace_written_by_logger_thread(tw, wrapper, mock, tmp_path, monkeypatch):
+    path = tmp_path / "trace.jsonl"
+    opened_on = []
+
+    def tracking_open(*args, **kwargs):
+        opened_on.append(threading.current_thread().name)
+        return builtins.open(*args, **kwargs)
+
+    monkeypatch.setattr(tw, "TRACE_LOG", str(path))
+    monkeypatch.setattr(tw, "open", tracking_open, raising=False)
+    body = {"model": "claude-sonnet-4-6", "max_tokens": 100, "messages": [{"role": "user", "content": "hi"}]}
+    try:
+        for _ in range(2):
+            r = httpx.post(f"{wrapper}/v1/messages", json=body, timeout=10)
+            assert r.status_code == 200
+        deadline = time.monotonic() + 5
+        while not (path.exists() and path.read_text().count("\n") >= 2):
+            assert time.monotonic() < deadline, "trace not written"
+            time.sleep(0.02)
+    finally:
+        tw._logger.close()
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [r["endpoint"] for r in records] == ["messages", "messages"]
+    assert all(r["status"] == 200 and r["spans"] for r in records)
+    assert opened_on == ["ccs-wrapper-log"]  # 파일은 한 번만, writer 스레드에서 연다
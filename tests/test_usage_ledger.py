@@ -0,0 +1,28 @@
+"""사용량 원장: 기본은 끔, --usage-db로 켜면 요청별 usage가 SQLite에 쌓인다"""
+
+import httpx
+import pytest
+
+
+@pytest.fixture
+def ledger(tw, tmp_path, monkeypatch):
+    monkeypatch.setattr(tw, "USAGE_DB", str(tmp_path / "usage.db"))
+    ledger = tw._UsageLedger()
+    monkeypatch.setattr(tw, "_usage_ledger", ledger)
+    yield ledger
+    ledger.close()
+
+
+def test_off_by_default(tw, wrapper):
+    assert tw.USAGE_DB is None
+    assert httpx.get(f"{wrapper}/usage", timeout=5).status_code == 404
+    tw._usage_ledger.add((0.0,) * len(tw._USAGE_COLUMNS))
+    assert tw._usage_ledger.stats["recorded"] == 0 and tw._usage_ledger._thread is None
+
+
+def test_records_when_enabled(tw, wrapper, ledger):
+    body = {"model": "claude-sonnet-4-6", "max_tokens": 100, "messages": [{"role": "user", "content": "ledger"}]}
+    assert httpx.post(f"{wrapper}/v1/messages", json=body, timeout=30).status_code == 200
+    ledger.close()  # 남은 행 기록
+    rows = ledger.query(["model"], None, None, None)
+    assert [(row["model"], row["requests"], row["output_tokens"]) for row in rows] == [("claude-sonnet-4-6", 1, 20)]
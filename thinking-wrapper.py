@@ -15,20 +15,113 @@ Usage:
     python3 thinking-wrapper.py [--port 8318]
 """
 
+import asyncio
+import atexit
+import cProfile
+import functools
+import gzip
+import hashlib
+import heapq
+import inspect
+import io
 import json
+import os
+import pstats
+import queue
+import random
 import time
+import uuid
+import zlib
 import httpx
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import uvicorn
 import argparse
 import re
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
 
-app = FastAPI(title="CCS Thinking + Effort Wrapper")
+try:
+    import orjson  # 선택: 있으면 큰 본문 파싱/직렬화에 사용
+except ImportError:
+    orjson = None
 
 CCS_BASE = "http://localhost:8317"
 CCS_API_KEY = "ccs-internal-managed"
 
+# CCS 연결 방식: Unix 도메인 소켓 경로 (None이면 TCP), HTTP/2 (h2 패키지 필요)
+CCS_UDS = None
+CCS_HTTP2 = False
+
+# 업스트림 커넥션 풀 (앱 수명 동안 하나의 httpx.AsyncClient 공유)
+UPSTREAM_MAX_CONNECTIONS = 100
+UPSTREAM_MAX_KEEPALIVE = 20
+UPSTREAM_KEEPALIVE_EXPIRY = 30.0
+UPSTREAM_CONNECT_TIMEOUT = 10.0
+
+# /v1/models 캐시: TTL 안에는 캐시 응답, STALE_TTL까지는 캐시 응답 + 백그라운드 갱신
+MODELS_TTL = 60
+MODELS_STALE_TTL = 600
+# 라우팅된 모델명을 모델 카탈로그로 미리 검증 (CCS에 없는 모델이면 업스트림 호출 없이 404)
+VALIDATE_MODELS = False
+
+# 업스트림 동시 요청 상한 (기본 끔): 라우트(프로바이더)별 + 모델별. 초과분은 우선순위 대기열에서 대기
+#   --route-concurrency thinking=4,codex-effort=4 / --model-concurrency gpt-5.3-codex=2 로 켠다
+ROUTE_CONCURRENCY = {}      # 예: {"thinking": 4, "codex-effort": 4, "passthrough": 16}
+MODEL_CONCURRENCY = {}      # 예: {"gpt-5.3-codex": 2}
+QUEUE_HOLD_STREAM = False   # False: 스트림은 업스트림 첫 바이트에서 슬롯 반환 (생성 중인 긴 스트림이 대기열을 막지 않음)
+QUEUE_MAX_WAITERS = 64      # 리미터별 대기열 길이 한도 (초과 시 즉시 429)
+QUEUE_TIMEOUT = 60          # 대기 한도 (초, 초과 시 429)
+QUEUE_RETRY_AFTER = 5       # 429 응답의 retry-after (초)
+
+PRIORITY_INTERACTIVE = 0    # 스트리밍 대화
+PRIORITY_BACKGROUND = 1     # Haiku 슬롯, 비스트리밍 호출
+
+# 업스트림 429/5xx 재시도 (클라이언트에 첫 바이트를 보내기 전에만)
+RETRY = {
+    "attempts": 3,             # 최초 요청 포함
+    "backoff": 0.5,            # 지수 backoff 시작값 (jitter 적용)
+    "max_backoff": 8.0,
+    "max_after": 20.0,         # retry-after가 이보다 길면 재시도하지 않고 fallback으로 넘김
+    "statuses": (429, 500, 502, 503, 504, 529),
+}
+
+# 재시도 후에도 실패하면 순서대로 다른 모델로 (응답 시작 전 에러만)
+FALLBACK_CHAINS = {
+    "gpt-5.3-codex-xhigh": ["gpt-5.3-codex-high", "claude-opus-4-6-thinking"],
+}
+FAILOVER_STATUSES = (429, 500, 502, 503, 504, 529)
+# 래퍼가 스스로 거절한 응답(대기열 가득/부하 차단)에 붙는 헤더. 이런 응답은 fallback하지 않고 그대로 반환
+REJECTED_HEADER = "X-CCS-Rejected"
+
+# 헤지 요청: 짧은 비스트리밍 호출이 라우트 최근 응답시간 percentile을 넘기면 같은 요청을 하나 더 보냄
+HEDGE = {
+    "enabled": False,
+    "percentile": 95,
+    "min_samples": 20,
+    "max_body": 64 * 1024,     # 이보다 큰 요청은 헤지하지 않음 (prefill 비용 2배)
+}
+
+# 라우트별 업스트림 타임아웃 (초)
+#   connect:    연결 수립
+#   first_byte: 요청 전송 → 첫 응답 바이트 (비스트리밍은 응답 전체를 기다리는 시간)
+#   idle:       스트리밍 청크 사이 최대 간격 (넘기면 업스트림을 끊고 클라이언트에 에러 이벤트)
+ROUTE_TIMEOUTS = {
+    "models":       {"connect": 5,  "first_byte": 10,  "idle": 10},
+    "count_tokens": {"connect": 5,  "first_byte": 30,  "idle": 30},
+    "thinking":     {"connect": 10, "first_byte": 300, "idle": 120},   # Anthropic은 ping을 보내므로 길게 멈추지 않는다
+    "codex-effort": {"connect": 10, "first_byte": 300, "idle": 300},   # reasoning 중에는 한동안 조용할 수 있다
+    "passthrough":  {"connect": 10, "first_byte": 300, "idle": 300},
+}
+
 # Claude thinking 모델: Anthropic Messages로 변환
 # ccs_model: CCS에 전달할 실제 모델명 (CCS는 -thinking 접미사를 모를 수 있음)
 THINKING_MODELS = {
@@ -58,207 +151,3103 @@ EFFORT_MAP = {
     "max": "max", "xhigh": "xhigh",
 }
 
+# 라우트별 업스트림 경로 (CCS_BASE 기준, chat = /v1/chat/completions로 들어온 요청, messages = /v1/messages)
+# thinking은 chat 요청도 Anthropic Messages로 변환해서 보낸다
+UPSTREAM_PATHS = {
+    "thinking":     {"chat": "/v1/messages", "messages": "/v1/messages"},
+    "codex-effort": {"chat": "/api/provider/codex/v1/chat/completions", "messages": "/api/provider/codex/v1/messages"},
+    "passthrough":  {"chat": "/v1/chat/completions", "messages": "/v1/messages"},
+}
+
+# thinking 외 모델의 max_tokens 상한 (요청 모델명 또는 effort 접미사를 뗀 모델명, 넘으면 낮춰서 전달)
+MODEL_MAX_TOKENS = {}
+
+# 라우팅 설정 파일 (JSON): 위 THINKING_MODELS/MODEL_ALIASES/EFFORT_SUFFIXES/UPSTREAM_PATHS/MODEL_MAX_TOKENS를
+# 섹션 단위로 덮어쓴다. 없으면 내장 기본값. 파일이 바뀌거나 SIGHUP을 받으면 다시 읽어 테이블을 통째로 교체
+ROUTING_CONFIG = os.path.expanduser("~/.ccs-wrapper/routing.json")
+ROUTING_POLL_INTERVAL = 2.0  # 파일 변경 확인 주기 (초, 0이면 SIGHUP으로만 리로드)
+ROUTING_MEMO_SIZE = 4096     # 모델명별 라우팅 결과 memo 최대 항목
+
 CCS_HEADERS = {
     "Authorization": f"Bearer {CCS_API_KEY}",
     "Content-Type": "application/json",
 }
 
+# SSE 응답 헤더 (클라이언트 방향)
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
 
-# Antigravity thinking 없는 Claude 모델 필터링 (단속 회피)
-# 이 패턴에 매칭되면서 -thinking 으로 끝나지 않는 모델을 제거
-_CLAUDE_MODEL_RE = re.compile(r"^(gemini-)?claude-")
+# 바이트 릴레이용 업스트림 요청 헤더: 압축되면 raw 바이트를 그대로 넘길 수 없다
+SSE_RELAY_HEADERS = {"Accept-Encoding": "identity"}
 
+# SSE 다운스트림 쓰기 합치기: 직전 전송 후 flush_interval 안에 이어서 나온 프레임은 모아서 한 번에 보낸다.
+# 띄엄띄엄 오는 토큰은 바로 나가고(추가 지연 없음), 몰려 나올 때만 최대 flush_interval만큼 묶인다.
+SSE_COALESCE = {
+    "enabled": True,
+    "flush_interval": 0.01,  # 초 (체감 지연 상한, 0이면 프레임마다 바로 전송)
+    "max_bytes": 16 * 1024,  # 모인 바이트가 이만큼이면 기다리지 않고 전송
+}
 
-def _should_hide_model(model_id: str) -> bool:
-    """Antigravity의 non-thinking Claude 모델을 숨긴다."""
-    if not _CLAUDE_MODEL_RE.match(model_id):
-        return False
-    # thinking 접미사가 있으면 유지
-    if model_id.endswith("-thinking"):
-        return False
-    return True
+# 로그: 이벤트 루프는 큐에 넣기만 하고 writer 스레드가 모아서 stdout에 쓴다
+LOG_LEVEL = "info"          # debug / info / warning / error (debug면 업스트림 에러 본문 일부도 출력)
+LOG_FORMAT = "text"         # "text" (이모지 한 줄) / "json" (JSONL 레코드)
+LOG_QUEUE_SIZE = 10000      # 초과분은 버리고 dropped로 센다
+LOG_BATCH = 256             # writer가 한 번에 쓰는 최대 레코드 수
+LOG_SAMPLE = {}             # 이벤트별 기록 비율, 예: {"request": 0.1, "usage": 0.5}
 
 
-@app.get("/v1/models")
-async def list_models():
-    """CCS 모델 목록에서 non-thinking Claude 모델 필터링 후 전달"""
-    async with httpx.AsyncClient(timeout=10) as client:
-        r = await client.get(
-            f"{CCS_BASE}/v1/models",
-            headers={"Authorization": f"Bearer {CCS_API_KEY}"},
-        )
-        data = r.json()
-        if "data" in data:
-            original_count = len(data["data"])
-            data["data"] = [
-                m for m in data["data"]
-                if not _should_hide_model(m.get("id", ""))
-            ]
-            hidden = original_count - len(data["data"])
-            if hidden:
-                print(f"🚫 Models: {hidden}개 non-thinking Claude 모델 숨김")
-        return JSONResponse(content=data, status_code=r.status_code)
+# =====================================================================
+# 로깅 (큐 + writer 스레드, 비차단)
+# =====================================================================
 
+_LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+_LOG_STOP = object()
 
-@app.post("/v1/chat/completions")
-async def chat_completions(request: Request):
-    body = await request.json()
-    model = body.get("model", "")
-    is_stream = body.get("stream", False)
 
-    print(f"📨 {model} stream={is_stream} msgs={len(body.get('messages',[]))} tools={len(body.get('tools',[]))}")
+class _AsyncLogger:
+    """print() 대체. 호출 쪽은 레코드를 큐에 넣기만 하므로 stdout이 파일/journald로 막혀도
+    이벤트 루프(SSE 스트림)는 멈추지 않는다. 큐가 가득 차면 레코드를 버리고 dropped를 센다.
+    요청 trace(--trace-log)도 같은 큐로 받아 writer 스레드가 TRACE_LOG 파일에 쓴다."""
 
-    # --- Route 1: Claude Thinking 모델 ---
-    if model in THINKING_MODELS:
-        return await _handle_thinking(body, model, is_stream)
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "sampled_out": 0, "batches": 0, "write_errors": 0,
+                      "traces": 0, "trace_errors": 0}
+        self._thread = None
+        self._trace_file = None  # writer 스레드만 연다/쓴다
 
-    # --- Route 2: Codex Effort 접미사 모델 ---
-    match = EFFORT_SUFFIXES.match(model)
-    if match:
-        base_model = match.group(1)
-        effort = match.group(2)
-        return await _handle_codex_effort(body, base_model, effort)
+    def enabled(self, level: str) -> bool:
+        return _LOG_LEVELS[level] >= _LOG_LEVELS.get(LOG_LEVEL, 20)
 
-    # --- Route 3: 일반 모델 passthrough (SSE stream) ---
-    return await _stream_passthrough(f"{CCS_BASE}/v1/chat/completions", body)
+    def log(self, level: str, event: str, msg: str, fields: dict):
+        if not self.enabled(level):
+            return
+        rate = LOG_SAMPLE.get(event)
+        if rate is not None and rate < 1 and random.random() >= rate:
+            self.stats["sampled_out"] += 1
+            return
+        ctx = _request_ctx.get()
+        record = (time.time(), level, event, msg, ctx.request_id if ctx is not None else None, fields)
+        self._put(record)
 
+    def trace(self, record: dict):
+        """요청 trace 레코드 하나 (직렬화와 파일 쓰기는 writer 스레드에서)"""
+        self._put(record)
 
-async def _stream_passthrough(url: str, body: dict):
-    """CCS의 SSE 스트리밍 응답을 그대로 Copilot에 전달"""
-    body["stream"] = True  # CCS에 스트리밍 강제
+    def _put(self, record):
+        if self._thread is None:
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+            self.stats["queued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
 
-    async def generate():
-        async with httpx.AsyncClient(timeout=300) as client:
-            async with client.stream(
-                "POST", url, json=body, headers=CCS_HEADERS,
-            ) as response:
-                async for line in response.aiter_lines():
-                    if line:
-                        yield line + "\n"
-                    else:
-                        yield "\n"
-
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
-    )
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="ccs-wrapper-log", daemon=True)
+        self._thread.start()
 
+    @staticmethod
+    def _format(record) -> str:
+        ts, level, event, msg, request_id, fields = record
+        if LOG_FORMAT != "json":
+            return msg + "\n"
+        out = {
+            "ts": datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": level,
+            "event": event,
+            "msg": msg,
+        }
+        if request_id:
+            out["request_id"] = request_id
+        out.update(fields)
+        return json.dumps(out, ensure_ascii=False, default=str) + "\n"
 
-async def _handle_codex_effort(body: dict, base_model: str, effort: str):
-    """Codex effort 모델: 접미사 파싱 → reasoning_effort 삽입 → SSE passthrough"""
-    body["model"] = base_model
-    body["reasoning_effort"] = effort
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _LOG_STOP
+            records = [r for r in batch if r is not _LOG_STOP and not isinstance(r, dict)]
+            traces = [r for r in batch if isinstance(r, dict)]
+            if records:
+                try:
+                    sys.stdout.write("".join(self._format(r) for r in records))
+                    sys.stdout.flush()
+                    self.stats["written"] += len(records)
+                except (OSError, ValueError):
+                    self.stats["write_errors"] += len(records)
+            if traces:
+                self._write_traces(traces)
+            self.stats["batches"] += 1
+            if stop:
+                if self._trace_file is not None:
+                    self._trace_file.close()
+                    self._trace_file = None
+                return
 
-    # VS Code Copilot이 보내는 불필요한 필드 제거
-    for key in ["n", "logprobs", "top_logprobs", "response_format"]:
-        body.pop(key, None)
+    def _write_traces(self, traces: list[dict]):
+        try:
+            if self._trace_file is None:
+                self._trace_file = open(TRACE_LOG, "a", encoding="utf-8")
+            self._trace_file.write("".join(json.dumps(t, ensure_ascii=False) + "\n" for t in traces))
+            self._trace_file.flush()
+            self.stats["traces"] += len(traces)
+        except (OSError, TypeError) as e:
+            if not self.stats["trace_errors"]:
+                self.log("error", "trace", f"⚠️ Trace log error: {e}", {})
+            self.stats["trace_errors"] += len(traces)
+
+    def close(self, timeout: float = 2.0):
+        """남은 레코드를 쓰고 writer 종료 (프로세스 종료 시)"""
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            self.queue.put(_LOG_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "pending": self.queue.qsize(), "level": LOG_LEVEL, "format": LOG_FORMAT}
+
+
+_logger = _AsyncLogger()
+atexit.register(_logger.close)
+
+
+def _log(level: str, event: str, msg: str, **fields):
+    """레벨/샘플링 확인 후 큐에 기록. text 형식은 msg, json 형식은 msg + fields."""
+    _logger.log(level, event, msg, fields)
+
+
+# =====================================================================
+# 업스트림 HTTP 클라이언트 (공유 커넥션 풀)
+# =====================================================================
 
-    print(f"🔧 Codex effort: {base_model} + {effort}")
-    return await _stream_passthrough(
-        f"{CCS_BASE}/api/provider/codex/v1/chat/completions", body
+_client: httpx.AsyncClient | None = None
+
+
+def _create_client() -> httpx.AsyncClient:
+    """CCS용 httpx.AsyncClient 생성 (풀 크기, keepalive, UDS/HTTP2 설정 반영)"""
+    http2 = CCS_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            _log("warning", "startup", "⚠️ HTTP/2 requested but 'h2' is not installed (pip install httpx[http2]) → HTTP/1.1")
+            http2 = False
+    limits = httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    transport = httpx.AsyncHTTPTransport(
+        uds=CCS_UDS, http2=http2, limits=limits,
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=_timeout("passthrough"),
     )
 
 
-async def _handle_thinking(body: dict, model: str, is_stream: bool):
-    """Claude thinking 모델: Anthropic Messages → OpenAI SSE 변환"""
-    config = THINKING_MODELS[model]
+def _upstream() -> httpx.AsyncClient:
+    """앱 수명 동안 공유하는 업스트림 클라이언트 (lifespan 밖에서 호출되면 지연 생성)"""
+    global _client
+    if _client is None:
+        _client = _create_client()
+    return _client
 
-    reasoning_effort = body.get("reasoning_effort", None)
-    effort = EFFORT_MAP.get(reasoning_effort, config["effort"])
 
-    messages = body.get("messages", [])
-    anthropic_messages = []
-    system_content = None
+def _route_timeouts(route: str) -> dict:
+    return ROUTE_TIMEOUTS.get(route) or ROUTE_TIMEOUTS["passthrough"]
 
-    for msg in messages:
-        role = msg.get("role", "user")
-        content = msg.get("content", "")
 
-        # content가 list인 경우 (multimodal) → text만 추출
-        if isinstance(content, list):
-            text_parts = [p.get("text", "") for p in content if p.get("type") == "text"]
-            content = "\n".join(text_parts) if text_parts else str(content)
+def _timeout(route: str, stream: bool = False) -> httpx.Timeout:
+    """httpx 타임아웃: 비스트리밍은 read=first_byte.
+    스트리밍은 read 제한 없음 → 응답 헤더는 _send_upstream, 청크 간격은 _idle_guard가 단계별로 제한"""
+    limits = _route_timeouts(route)
+    read = None if stream else limits["first_byte"]
+    return httpx.Timeout(read, connect=limits.get("connect", UPSTREAM_CONNECT_TIMEOUT))
 
-        if role == "system":
-            system_content = content if isinstance(content, str) else str(content)
-
-        elif role == "assistant":
-            # assistant + tool_calls → Anthropic content blocks
-            tool_calls_data = msg.get("tool_calls", [])
-            if tool_calls_data:
-                blocks = []
-                if content:
-                    blocks.append({"type": "text", "text": content})
-                for tc in tool_calls_data:
-                    func = tc.get("function", {})
-                    try:
-                        input_data = json.loads(func.get("arguments", "{}"))
-                    except json.JSONDecodeError:
-                        input_data = {"raw": func.get("arguments", "")}
-                    blocks.append({
-                        "type": "tool_use",
-                        "id": tc.get("id", f"call_{int(time.time())}"),
-                        "name": func.get("name", ""),
-                        "input": input_data,
-                    })
-                anthropic_messages.append({"role": "assistant", "content": blocks})
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _client
+    _client = _create_client()
+    if VALIDATE_MODELS:
+        _model_catalog._refresh()  # 검증용 카탈로그 미리 채움 (비동기)
+    publisher = asyncio.create_task(_publish_metrics_loop()) if _shared_state.enabled else None
+    # 라우팅 테이블: CLI 옵션(CCS_BASE/--routing-config)이 반영된 뒤 컴파일
+    await asyncio.to_thread(_load_routing, "startup")
+    routing_watcher = asyncio.create_task(_watch_routing_loop()) if ROUTING_CONFIG and ROUTING_POLL_INTERVAL > 0 else None
+    sighup = _install_routing_signal()
+    try:
+        yield
+    finally:
+        if routing_watcher is not None:
+            routing_watcher.cancel()
+        if sighup:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        if publisher is not None:
+            publisher.cancel()
+            await asyncio.to_thread(_shared_state.close)
+        await _client.aclose()
+        _client = None
+        # uvicorn은 종료 후 시그널을 다시 올려 atexit이 안 돌 수 있다 → 여기서 남은 기록을 비운다
+        await asyncio.to_thread(_usage_ledger.close)
+        await asyncio.to_thread(_capture.close)
+        await asyncio.to_thread(_logger.close)
+
+
+app = FastAPI(title="CCS Thinking + Effort Wrapper", lifespan=lifespan)
+
+
+# =====================================================================
+# 요청 본문: 최상위 키만 읽고 원본 바이트를 부분 치환해서 전달
+# =====================================================================
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WS = re.compile(r"[ \t\n\r]*")
+_DROP = object()
+
+
+def _loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _dumps(obj) -> bytes:
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class _LazyValue:
+    """리스트 원소 하나: 원본 JSON 텍스트 + 호출할 때 만드는 값.
+
+    digest()는 내용 해시 (원본 텍스트가 있으면 그걸, 없으면 값을 직렬화해서). 변환/토큰 추정 캐시는
+    이 해시로 먼저 찾고 놓쳤을 때만 값을 꺼낸다.
+    """
+
+    __slots__ = ("text", "_value", "_digest")
+
+    def __init__(self, text: str | None, value=_DROP):
+        self.text = text
+        self._value = value
+        self._digest = None
+
+    def __call__(self):
+        if self._value is _DROP:
+            self._value = _loads(self.text)
+        return self._value
+
+    def digest(self) -> bytes:
+        if self._digest is None:
+            data = self.text.encode("utf-8") if self.text is not None else _dumps(self._value)
+            self._digest = hashlib.blake2b(data, digest_size=16).digest()
+        return self._digest
+
+
+class _LazyBody:
+    """요청 JSON 본문을 원본 바이트로 들고 다니는 dict 비슷한 래퍼.
+
+    orjson이 있으면 본문을 orjson으로 한 번에 파싱한다 (C 파서라 값 위치만 찾는 파이썬 스캔보다 빠르다).
+    바꾸지 않았으면 encode()는 원본 바이트를 그대로, 바꿨으면 orjson으로 다시 직렬화한다.
+
+    orjson이 없으면 최상위 멤버와 리스트 원소의 위치를 기록하면서 stdlib 디코더로 값을 만든다
+    (만든 값은 버리지 않고 그대로 쓴다). 변경(__setitem__/pop/set_item)은 따로 기록했다가
+    encode()에서 바뀐 멤버/원소만 바꿔 끼우고, 나머지는 원본 바이트 그대로 업스트림에 간다.
+    전체 변환이 필요한 라우트(OpenAI → Anthropic)는 json()으로 dict를 받는다.
+    """
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._text = None
+        self._members = None  # [(key, member_start, value_start, value_end)]
+        self._values = {}
+        self._item_spans = {}    # 리스트 값: key → [(start, end)] 원소 위치
+        self._changes = {}
+        self._item_changes = {}  # key → {index: 새 원소}
+        self._parsed = None
+        self._dirty = False      # _parsed를 바꿨는지 (아니면 encode()는 원본 그대로)
+        if orjson is not None:
+            parsed = orjson.loads(raw)
+            if not isinstance(parsed, dict):
+                raise ValueError("request body must be a JSON object")
+            self._parsed = parsed
+
+    def _scan(self):
+        text = self.raw.decode("utf-8")
+        members = []
+        ws = _JSON_WS.match
+        i = ws(text, 0).end()
+        if text[i:i + 1] != "{":
+            raise ValueError("request body must be a JSON object")
+        i = ws(text, i + 1).end()
+        if text[i:i + 1] == "}":
+            self._text, self._members = text, members
+            return
+        while True:
+            if text[i:i + 1] != '"':
+                raise ValueError(f"invalid JSON object key at {i}")
+            member_start = i
+            key, i = json.decoder.scanstring(text, i + 1)
+            i = ws(text, i).end()
+            if text[i:i + 1] != ":":
+                raise ValueError(f"expected ':' at {i}")
+            value_start = ws(text, i + 1).end()
+            if text[value_start:value_start + 1] == "[":
+                value, i = self._scan_list(key, text, value_start)
             else:
-                anthropic_messages.append({"role": "assistant", "content": content})
-
-        elif role == "tool":
-            # tool result → Anthropic tool_result content block (user role)
-            tool_call_id = msg.get("tool_call_id", "")
-            result_content = content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
-            tool_result_block = {
-                "type": "tool_result",
-                "tool_use_id": tool_call_id,
-                "content": result_content,
-            }
-            # 이전 메시지가 user이고 content가 list면 합침
-            if anthropic_messages and anthropic_messages[-1]["role"] == "user" and isinstance(anthropic_messages[-1]["content"], list):
-                anthropic_messages[-1]["content"].append(tool_result_block)
+                value, i = _JSON_DECODER.raw_decode(text, value_start)
+            members.append((key, member_start, value_start, i))
+            self._values[key] = value
+            i = ws(text, i).end()
+            sep = text[i:i + 1]
+            if sep == ",":
+                i = ws(text, i + 1).end()
+            elif sep == "}":
+                break
             else:
-                anthropic_messages.append({"role": "user", "content": [tool_result_block]})
+                raise ValueError(f"expected ',' or '}}' at {i}")
+        self._text, self._members = text, members
 
-        elif role == "user":
-            anthropic_messages.append({"role": "user", "content": content})
+    def _scan_list(self, key: str, text: str, start: int) -> tuple[list, int]:
+        """리스트 값을 원소 단위로 디코딩하면서 원소 위치를 기록 (raw_decode 한 번과 같은 파싱량, 값은 보관)"""
+        ws = _JSON_WS.match
+        items, spans = [], []
+        i = ws(text, start + 1).end()
+        if text[i:i + 1] == "]":
+            self._item_spans[key] = spans
+            return items, i + 1
+        while True:
+            item, j = _JSON_DECODER.raw_decode(text, i)
+            items.append(item)
+            spans.append((i, j))
+            i = ws(text, j).end()
+            sep = text[i:i + 1]
+            if sep == "]":
+                self._item_spans[key] = spans
+                return items, i + 1
+            if sep != ",":
+                raise ValueError(f"expected ',' or ']' at {i}")
+            i = ws(text, i + 1).end()
 
-    if not anthropic_messages:
-        anthropic_messages = [{"role": "user", "content": "Hello"}]
+    def _spans(self) -> dict:
+        if self._members is None:
+            self._scan()
+        return {key: (vs, ve) for key, _, vs, ve in self._members}
+
+    def get(self, key: str, default=None):
+        if self._parsed is not None:
+            return self._parsed.get(key, default)
+        if key in self._item_changes:
+            self._promote(key)
+        if key in self._changes:
+            value = self._changes[key]
+            return default if value is _DROP else value
+        self._spans()
+        return self._values.get(key, default)
+
+    def _original_list(self, key: str) -> bool:
+        """원본 텍스트 그대로인 리스트 값인지 (원소 위치를 쓸 수 있는지)"""
+        if self._parsed is not None or key in self._changes:
+            return False
+        self._spans()
+        return key in self._item_spans
+
+    def size(self, key: str) -> int:
+        """리스트 값의 길이"""
+        if not self._original_list(key):
+            value = self.get(key)
+            return len(value) if isinstance(value, list) else 0
+        return len(self._item_spans[key])
+
+    def items(self, key: str) -> list[tuple[str | None, _LazyValue]]:
+        """리스트 값의 (원본 JSON 텍스트, _LazyValue) 목록. 변경/파싱된 값이면 텍스트는 None."""
+        if not self._original_list(key):
+            return [(None, _LazyValue(None, item)) for item in self.get(key) or []]
+        changed = self._item_changes.get(key, {})
+        values = self._values[key]
+        text = self._text
+        return [(None, _LazyValue(None, changed[index])) if index in changed
+                else (text[start:end], _LazyValue(text[start:end], values[index]))
+                for index, (start, end) in enumerate(self._item_spans[key])]
+
+    def item(self, key: str, index: int):
+        """리스트 값의 원소 하나 (set_item으로 바꾼 원소면 새 값)"""
+        if not self._original_list(key):
+            return self.get(key)[index]
+        spans = self._item_spans[key]
+        index %= len(spans)
+        changed = self._item_changes.get(key, {})
+        if index in changed:
+            return changed[index]
+        return self._values[key][index]
+
+    def item_length(self, key: str, index: int) -> int | None:
+        """원소의 원본 JSON 텍스트 길이 (크기 어림용). 바뀐 원소면 None."""
+        if not self._original_list(key) or index in self._item_changes.get(key, {}):
+            return None
+        start, end = self._item_spans[key][index]
+        return end - start
+
+    def set_item(self, key: str, index: int, value):
+        """리스트 원소 하나만 교체. encode()에서 그 원소만 다시 직렬화한다."""
+        if not self._original_list(key):
+            items = list(self.get(key))
+            items[index] = value
+            self[key] = items
+            return
+        index %= len(self._item_spans[key])
+        self._item_changes.setdefault(key, {})[index] = value
+
+    def _promote(self, key: str):
+        """원소 단위 변경 → 값 전체 변경 (값 전체를 읽거나 바꿀 때)"""
+        changed = self._item_changes.pop(key)
+        self._changes[key] = [changed[i] if i in changed else value for i, value in enumerate(self._values[key])]
+
+    def _list_text(self, key: str) -> str:
+        text = self._text
+        changed = self._item_changes[key]
+        return "[" + ",".join(
+            json.dumps(changed[i], ensure_ascii=False) if i in changed else text[s:e]
+            for i, (s, e) in enumerate(self._item_spans[key])
+        ) + "]"
 
-    # Anthropic: user/assistant 교대 필수 → 연속 같은 role 합침
-    merged = []
-    for msg in anthropic_messages:
-        if merged and merged[-1]["role"] == msg["role"]:
-            prev = merged[-1]["content"]
-            curr = msg["content"]
-            # 둘 다 string이면 합침
-            if isinstance(prev, str) and isinstance(curr, str):
-                merged[-1]["content"] = prev + "\n\n" + curr
-            # 둘 다 list면 extend
-            elif isinstance(prev, list) and isinstance(curr, list):
-                prev.extend(curr)
-            # 하나가 string, 하나가 list → list로 통합
-            elif isinstance(prev, str) and isinstance(curr, list):
-                merged[-1]["content"] = [{"type": "text", "text": prev}] + curr
-            elif isinstance(prev, list) and isinstance(curr, str):
-                prev.append({"type": "text", "text": curr})
+    def raw_value(self, key: str) -> str | None:
+        """최상위 값의 원본 JSON 텍스트 (변경/파싱된 값이면 None)"""
+        if self._parsed is not None or key in self._changes or key in self._item_changes:
+            return None
+        span = self._spans().get(key)
+        return self._text[span[0]:span[1]] if span else None
+
+    def lazy(self, key: str) -> _LazyValue:
+        """최상위 값 하나를 _LazyValue로 (원본 텍스트가 있으면 그 해시로 캐시를 찾는다)"""
+        return _LazyValue(self.raw_value(key), self.get(key))
+
+    def keys(self) -> list[str]:
+        """최상위 키 (변경 반영, 원본 순서 뒤에 새로 넣은 키)"""
+        if self._parsed is not None:
+            return list(self._parsed)
+        self._spans()
+        keys = [key for key, *_ in self._members if self._changes.get(key) is not _DROP]
+        existing = {m[0] for m in self._members}
+        return keys + [key for key, value in self._changes.items() if key not in existing and value is not _DROP]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._item_changes or self.get(key, _DROP) is not _DROP
+
+    def __getitem__(self, key: str):
+        value = self.get(key, _DROP)
+        if value is _DROP:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value):
+        if self._parsed is not None:
+            self._parsed[key] = value
+            self._dirty = True
         else:
-            merged.append(dict(msg))
-    anthropic_messages = merged
+            self._item_changes.pop(key, None)
+            self._changes[key] = value
 
-    max_tokens = (
-        body.get("max_tokens")
-        or body.get("max_completion_tokens")
-        or config["max_tokens"]
-    )
-    # Antigravity 200K context cap → max_tokens 제한
-    max_tokens = min(max_tokens, 16000)
+    def pop(self, key: str, default=None):
+        value = self.get(key, default)
+        if self._parsed is not None:
+            self._parsed.pop(key, None)
+            self._dirty = True
+        else:
+            self._changes[key] = _DROP
+        return value
+
+    def json(self) -> dict:
+        """전체 dict (변경 사항 반영). 이후 변경은 dict에 직접 적용된다."""
+        if self._parsed is None:
+            for key in list(self._item_changes):
+                self._promote(key)
+            self._spans()
+            parsed = dict(self._values)
+            for key, value in self._changes.items():
+                if value is _DROP:
+                    parsed.pop(key, None)
+                else:
+                    parsed[key] = value
+            self._parsed = parsed
+            self._changes = {}
+        self._dirty = True  # 받은 쪽이 dict를 직접 바꿀 수 있다
+        return self._parsed
+
+    def encode(self) -> bytes:
+        """업스트림으로 보낼 바이트. 바뀐 최상위 멤버만 다시 직렬화한다."""
+        if self._parsed is not None:
+            return _dumps(self._parsed) if self._dirty else self.raw
+        if not self._changes and not self._item_changes:
+            return self.raw
+        self._spans()
+        text = self._text
+        parts = []
+        for key, ms, vs, ve in self._members:
+            if key in self._item_changes:
+                parts.append(text[ms:vs] + self._list_text(key))
+            elif key not in self._changes:
+                parts.append(text[ms:ve])
+            elif self._changes[key] is not _DROP:
+                parts.append(text[ms:vs] + json.dumps(self._changes[key], ensure_ascii=False))
+        existing = {m[0] for m in self._members}
+        for key, value in self._changes.items():
+            if key not in existing and value is not _DROP:
+                parts.append(json.dumps(key) + ":" + json.dumps(value, ensure_ascii=False))
+        return ("{" + ",".join(parts) + "}").encode("utf-8")
+
+
+# =====================================================================
+# OpenAI → Anthropic 대화 변환 (prefix 캐시로 새로 붙은 메시지만 변환)
+# =====================================================================
+
+# 변환된 대화 prefix 캐시 크기 (세션 수 × 최근 턴 정도면 충분)
+CONVERSION_CACHE_SIZE = 256
+
+
+class _LRU:
+    """OrderedDict 기반 LRU (최대 항목 수 제한)"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+
+_conversion_cache = _LRU(CONVERSION_CACHE_SIZE)
+_conversion_stats = {"hits": 0, "misses": 0, "reused_msgs": 0, "converted_msgs": 0}
+
+
+def _convert_message(msg: dict) -> tuple[str, str | list | None]:
+    """OpenAI 메시지 하나 → (role, content). system이면 ("system", text)."""
+    role = msg.get("role", "user")
+    content = msg.get("content", "")
+
+    # content가 list인 경우 (multimodal) → text만 추출
+    if isinstance(content, list):
+        text_parts = [p.get("text", "") for p in content if p.get("type") == "text"]
+        content = "\n".join(text_parts) if text_parts else str(content)
+
+    if role == "system":
+        return "system", content if isinstance(content, str) else str(content)
+
+    if role == "assistant":
+        # assistant + tool_calls → Anthropic content blocks
+        tool_calls_data = msg.get("tool_calls", [])
+        if not tool_calls_data:
+            return "assistant", content
+        blocks = []
+        if content:
+            blocks.append({"type": "text", "text": content})
+        for tc in tool_calls_data:
+            func = tc.get("function", {})
+            try:
+                input_data = json.loads(func.get("arguments", "{}"))
+            except json.JSONDecodeError:
+                input_data = {"raw": func.get("arguments", "")}
+            blocks.append({
+                "type": "tool_use",
+                "id": tc.get("id", f"call_{int(time.time())}"),
+                "name": func.get("name", ""),
+                "input": input_data,
+            })
+        return "assistant", blocks
+
+    if role == "tool":
+        # tool result → Anthropic tool_result content block (user role)
+        result_content = content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+        return "user", [{
+            "type": "tool_result",
+            "tool_use_id": msg.get("tool_call_id", ""),
+            "content": result_content,
+        }]
+
+    if role == "user":
+        return "user", content
+    return role, None
+
+
+def _append_merged(merged: list, role: str, content):
+    """Anthropic: user/assistant 교대 필수 → 연속 같은 role 합침.
+
+    캐시된 prefix와 객체를 공유하므로 기존 메시지를 제자리에서 바꾸지 않고 새 dict로 교체한다.
+    """
+    if not merged or merged[-1]["role"] != role:
+        merged.append({"role": role, "content": content})
+        return
+    prev = merged[-1]["content"]
+    # 둘 다 string이면 합침
+    if isinstance(prev, str) and isinstance(content, str):
+        combined = prev + "\n\n" + content
+    # 둘 다 list면 이어붙임 (tool_result 연속 포함)
+    elif isinstance(prev, list) and isinstance(content, list):
+        combined = prev + content
+    # 하나가 string, 하나가 list → list로 통합
+    elif isinstance(prev, str):
+        combined = [{"type": "text", "text": prev}] + content
+    else:
+        combined = prev + [{"type": "text", "text": content}]
+    merged[-1] = {"role": role, "content": combined}
+
+
+def _convert_messages(items: list[tuple[str | None, _LazyValue]]) -> tuple[list, str | None]:
+    """OpenAI messages → (Anthropic messages, system). items는 _LazyBody.items("messages").
+
+    메시지 해시(_LazyValue.digest)를 이어 해싱한 rolling hash로 변환 결과를 캐시해서,
+    이전 턴까지의 prefix가 캐시에 있으면 새로 붙은 메시지만 꺼내 변환한다.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    prefix_keys = []
+    for _, lazy in items:
+        hasher.update(lazy.digest())
+        prefix_keys.append(hasher.digest())
+
+    start, merged, system_content = 0, [], None
+    for k in range(len(prefix_keys), 0, -1):
+        cached = _conversion_cache.get(prefix_keys[k - 1])
+        if cached is not None:
+            start = k
+            merged, system_content = list(cached[0]), cached[1]
+            break
+    if start:
+        _conversion_stats["hits"] += 1
+        _conversion_stats["reused_msgs"] += start
+    else:
+        _conversion_stats["misses"] += 1
+
+    for _, lazy in items[start:]:
+        role, content = _convert_message(lazy())
+        if role == "system":
+            system_content = content
+        elif content is not None:
+            _append_merged(merged, role, content)
+    _conversion_stats["converted_msgs"] += len(items) - start
+
+    if prefix_keys and start < len(prefix_keys):
+        _conversion_cache.put(prefix_keys[-1], (tuple(merged), system_content))
+    return merged, system_content
+
+
+# =====================================================================
+# Anthropic prompt cache: breakpoint 자동 배치 + 모델별 캐시 적중률
+# =====================================================================
+
+# system / tools / 최근 대화 prefix에 cache_control 마커를 넣는다.
+# 클라이언트가 이미 cache_control을 넣었으면 (Claude Code 등) 건드리지 않는다.
+PROMPT_CACHE = {
+    "enabled": True,
+    "max_breakpoints": 4,   # Anthropic 한도
+    "min_chars": 4000,      # 이보다 짧은 prefix는 캐시 최소 길이(~1024 토큰) 미만이라 생략
+}
+
+_EPHEMERAL = {"type": "ephemeral"}
+_UNCACHEABLE_BLOCKS = ("thinking", "redacted_thinking")
+
+# 모델별 usage 누적 (캐시 적중률 계산용)
+_cache_usage = {}
+
+
+def _content_chars(content) -> int:
+    """content(str 또는 block 목록)의 대략적인 글자 수"""
+    if isinstance(content, str):
+        return len(content)
+    total = 0
+    for block in content or []:
+        if not isinstance(block, dict):
+            continue
+        for key in ("text", "thinking", "content"):
+            value = block.get(key)
+            if isinstance(value, str):
+                total += len(value)
+            elif isinstance(value, list):
+                total += _content_chars(value)
+        if "input" in block:
+            total += len(str(block["input"]))
+    return total
+
+
+def _with_cache_control(content):
+    """마지막 캐시 가능 block에 cache_control을 붙인 새 content 반환 (원본은 그대로). 불가하면 None."""
+    if isinstance(content, str):
+        if not content:
+            return None
+        return [{"type": "text", "text": content, "cache_control": _EPHEMERAL}]
+    if not isinstance(content, list):
+        return None
+    for i in range(len(content) - 1, -1, -1):
+        block = content[i]
+        if isinstance(block, dict) and block.get("type") not in _UNCACHEABLE_BLOCKS:
+            return content[:i] + [{**block, "cache_control": _EPHEMERAL}] + content[i + 1:]
+    return None
+
+
+class _ParsedBody:
+    """dict 본문(OpenAI → Anthropic 변환 결과)에 _LazyBody의 원소 단위 API를 맞춘 것.
+    원소는 리스트를 복사해서 교체한다 (변환 캐시와 공유하는 리스트/dict는 수정하지 않음)."""
+
+    def __init__(self, body: dict):
+        self.body = body
+
+    def get(self, key: str, default=None):
+        return self.body.get(key, default)
+
+    def __setitem__(self, key: str, value):
+        self.body[key] = value
+
+    def raw_value(self, key: str) -> None:
+        return None
+
+    def size(self, key: str) -> int:
+        value = self.body.get(key)
+        return len(value) if isinstance(value, list) else 0
+
+    def item(self, key: str, index: int):
+        return self.body[key][index]
+
+    def item_length(self, key: str, index: int) -> None:
+        return None
+
+    def set_item(self, key: str, index: int, value):
+        items = list(self.body[key])
+        items[index] = value
+        self.body[key] = items
+
+
+def _plan_cache_breakpoints(body) -> int:
+    """Anthropic Messages 본문에 cache_control breakpoint 배치. 넣은 개수 반환.
+
+    우선순위: tools 끝 → system 끝 → 마지막 메시지 → 직전 user 메시지
+    (직전 턴에서 마지막이었던 prefix라 이번 턴에 cache read가 난다).
+    body가 _LazyBody면 표시할 원소만 set_item으로 바꾼다 (원소 위치가 있으면 크기는 원본 JSON 길이로
+    어림하고 encode()가 그 원소만 바꿔 끼운다). dict는 변환된 본문.
+    """
+    if not PROMPT_CACHE["enabled"]:
+        return 0
+    if isinstance(body, dict):
+        body = _ParsedBody(body)
+    budget = PROMPT_CACHE["max_breakpoints"]
+    min_chars = PROMPT_CACHE["min_chars"]
+    placed = 0
+    prefix_chars = 0
+
+    if body.size("tools") and budget > placed:
+        raw = body.raw_value("tools")
+        prefix_chars += len(raw) if raw is not None else sum(
+            len(t.get("description", "")) + len(str(t.get("input_schema", ""))) for t in body.get("tools"))
+        if prefix_chars >= min_chars:
+            body.set_item("tools", -1, {**body.item("tools", -1), "cache_control": _EPHEMERAL})
+            placed += 1
+
+    system = body.get("system")
+    if system and budget > placed:
+        prefix_chars += _content_chars(system)
+        if prefix_chars >= min_chars:
+            marked = _with_cache_control(system)
+            if marked is not None:
+                body["system"] = marked
+                placed += 1
+
+    count = body.size("messages")
+    if not count:
+        return placed
+    sizes = []
+    for i in range(count):
+        length = body.item_length("messages", i)
+        sizes.append(length if length is not None else _content_chars(body.item("messages", i).get("content")))
+    targets = [count - 1]
+    for i in range(count - 2, -1, -1):
+        if body.item("messages", i).get("role") == "user":
+            targets.append(i)
+            break
+    for i in targets:
+        if budget <= placed:
+            break
+        if prefix_chars + sum(sizes[:i + 1]) < min_chars:
+            continue
+        message = body.item("messages", i)
+        marked = _with_cache_control(message.get("content"))
+        if marked is not None:
+            body.set_item("messages", i, {**message, "content": marked})
+            placed += 1
+    return placed
+
+
+def _apply_cache_breakpoints(body: _LazyBody):
+    """/v1/messages 본문(thinking/passthrough)에 breakpoint 배치. 클라이언트가 직접 cache_control을 넣었으면 그대로 둔다."""
+    if not PROMPT_CACHE["enabled"] or b'"cache_control"' in body.raw:
+        return
+    breakpoints = _plan_cache_breakpoints(body)
+    if breakpoints:
+        _log("debug", "cache_breakpoints", f"   📌 Cache breakpoints: {breakpoints}", breakpoints=breakpoints)
+
+
+def _record_usage(route: str, model: str, usage: dict):
+    """응답 usage 누적 (모델별 prompt cache 적중률)"""
+    input_tokens = usage.get("input_tokens", usage.get("prompt_tokens", 0)) or 0
+    stats = _cache_usage.setdefault(model, {
+        "requests": 0, "input_tokens": 0, "output_tokens": 0,
+        "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0,
+    })
+    stats["requests"] += 1
+    stats["input_tokens"] += input_tokens
+    stats["output_tokens"] += usage.get("output_tokens", usage.get("completion_tokens", 0)) or 0
+    stats["cache_read_input_tokens"] += usage.get("cache_read_input_tokens", 0) or 0
+    stats["cache_creation_input_tokens"] += usage.get("cache_creation_input_tokens", 0) or 0
+    _record_token_metrics(route, model, usage)
+    _ledger_usage(route, model, usage)
+
+
+def _cache_hit_ratios() -> dict:
+    out = {}
+    for model, stats in _cache_usage.items():
+        prompt = stats["input_tokens"] + stats["cache_read_input_tokens"] + stats["cache_creation_input_tokens"]
+        out[model] = {**stats, "hit_ratio": round(stats["cache_read_input_tokens"] / prompt, 4) if prompt else 0.0}
+    return out
+
+
+# =====================================================================
+# 메트릭: /metrics (Prometheus text format) / 요청별 trace / 샘플링 프로파일러
+# =====================================================================
+
+# 요청별 구간 trace를 JSONL로 기록할 파일 (None이면 기록 안 함)
+TRACE_LOG = None            # 예: "/tmp/ccs-wrapper-trace.jsonl"
+# cProfile 샘플링: N번째 요청마다 프로파일 저장 (0이면 끔). POST /admin/profile로 다음 요청 몇 개만 켤 수도 있다
+PROFILE_EVERY = 0
+PROFILE_DIR = "/tmp/ccs-wrapper-profiles"
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# 히스토그램 bucket 경계 (초 / 초당 토큰)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+
+
+def _label_str(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    parts = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), collect=None):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.values = {}
+        self.collect = collect
+
+    def inc(self, labels: tuple = (), value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def export(self) -> list:
+        values = self.collect() if self.collect else self.values
+        return [[list(labels), value] for labels, value in values.items()]
+
+    def render(self, peers: list = ()) -> list[str]:
+        values = dict(self.collect() if self.collect else self.values)
+        for exported in peers:  # 다른 워커 스냅샷 합산
+            for labels, value in exported:
+                values[tuple(labels)] = values.get(tuple(labels), 0) + value
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_label_str(self.labelnames, labels)} {value}")
+        return lines
+
+
+class _Gauge:
+    """값을 직접 올리고 내리거나, collect 콜백으로 렌더링 시점에 계산"""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), collect=None):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.values = {}
+        self.collect = collect
+
+    def inc(self, labels: tuple = (), value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def dec(self, labels: tuple = (), value: float = 1):
+        self.inc(labels, -value)
+
+    export = _Counter.export
+
+    def render(self, peers: list = ()) -> list[str]:
+        values = dict(self.collect() if self.collect else self.values)
+        for exported in peers:
+            for labels, value in exported:
+                values[tuple(labels)] = values.get(tuple(labels), 0) + value
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_label_str(self.labelnames, labels)} {value}")
+        return lines
+
+
+class _Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.buckets = buckets
+        self.series = {}  # labels → [bucket counts..., sum, count]
+
+    def observe(self, labels: tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def export(self) -> list:
+        return [[list(labels), series] for labels, series in self.series.items()]
+
+    def render(self, peers: list = ()) -> list[str]:
+        merged = {labels: list(series) for labels, series in self.series.items()}
+        for exported in peers:
+            for labels, series in exported:
+                mine = merged.setdefault(tuple(labels), [0] * len(series))
+                for i, value in enumerate(series):
+                    mine[i] += value
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in merged.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_label_str(self.labelnames, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_label_str(self.labelnames, labels, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_label_str(self.labelnames, labels)} {round(series[-2], 6)}")
+            lines.append(f"{self.name}_count{_label_str(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+_RM = ("route", "model")
+_metrics = {
+    "requests": _Counter("ccs_wrapper_requests_total", "Requests by endpoint, route, model and status",
+                         ("endpoint", "route", "model", "status")),
+    "overhead": _Histogram("ccs_wrapper_proxy_overhead_seconds",
+                           "Request receipt to first upstream send (body read, parse, conversion, queue)", _RM),
+    "connect": _Histogram("ccs_wrapper_upstream_connect_seconds",
+                          "New upstream TCP/UDS connection setup (pooled requests are not observed)", ("route",)),
+    "upstream_ttfb": _Histogram("ccs_wrapper_upstream_ttfb_seconds",
+                                "Upstream send to first upstream body byte", _RM),
+    "ttfb": _Histogram("ccs_wrapper_ttfb_seconds", "Request receipt to first downstream byte", _RM),
+    "stream_duration": _Histogram("ccs_wrapper_stream_duration_seconds",
+                                  "First upstream byte to end of stream", _RM),
+    "duration": _Histogram("ccs_wrapper_request_duration_seconds", "Request receipt to response end", _RM),
+    "tokens_per_second": _Histogram("ccs_wrapper_output_tokens_per_second",
+                                    "Output tokens / stream duration", _RM, TOKENS_PER_SECOND_BUCKETS),
+    "tokens": _Counter("ccs_wrapper_tokens_total", "Tokens from upstream usage by type (input/output/cache_read/cache_creation)",
+                       ("route", "model", "type")),
+    "inflight": _Gauge("ccs_wrapper_inflight_streams", "SSE responses currently streaming", ("route",)),
+    "queue_active": _Gauge("ccs_wrapper_queue_active", "Upstream slots in use per limiter", ("limiter",),
+                           collect=lambda: {(k, ): l.active for k, l in _scheduler.limiters.items()}),
+    "log_records": _Counter("ccs_wrapper_log_records_total", "Log records by outcome (written/dropped/sampled_out/write_errors)",
+                            ("outcome",), collect=lambda: {
+                                (k,): _logger.stats[k] for k in ("written", "dropped", "sampled_out", "write_errors")}),
+    "response_cache": _Counter("ccs_wrapper_response_cache_total", "Response cache lookups by outcome",
+                               ("outcome",), collect=lambda: {
+                                   (k,): _response_cache.stats[k]
+                                   for k in ("hits_memory", "hits_disk", "misses", "bypass", "stores", "evictions")}),
+    "aborts": _Counter("ccs_wrapper_upstream_aborts_total",
+                       "Upstream calls cut short (client disconnect, first-byte or idle timeout)", ("reason",),
+                       collect=lambda: {(k,): v for k, v in _cancel_stats.items()}),
+    "queue_waiting": _Gauge("ccs_wrapper_queue_waiting", "Requests waiting for an upstream slot per limiter", ("limiter",),
+                            collect=lambda: {(k, ): l.depth() for k, l in _scheduler.limiters.items()}),
+}
+
+
+class _RequestContext:
+    """요청 하나의 라우트/모델과 구간별 시각. contextvar로 핸들러·스트림 제너레이터·업스트림 호출이 공유한다."""
+
+    def __init__(self, endpoint: str, request_id: str | None = None):
+        self.endpoint = endpoint
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.route = "unknown"
+        self.model = ""
+        self.requested_model = ""  # 클라이언트가 보낸 모델명 (별칭 치환 전)
+        self.started = time.perf_counter()
+        self.marks = {}
+        self.spans = []  # (name, start, duration)
+        self.output_tokens = None
+        self.streaming = False
+        self.finished = False
+        self.profiler = None
+        self.request = None  # 클라이언트 연결 끊김 감지용
+        self.capture = None  # 트래픽 캡처 중이면 요청 본문/업스트림 응답 기록
+
+    @contextmanager
+    def span(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, t0, time.perf_counter() - t0))
+
+    def mark(self, name: str):
+        """구간 시작/끝 시각 기록 (처음 한 번만: 재시도해도 첫 전송 기준)"""
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter()
+
+    def since(self, start: str | None, end: str) -> float | None:
+        t0 = self.started if start is None else self.marks.get(start)
+        t1 = self.marks.get(end)
+        if t0 is None or t1 is None:
+            return None
+        return t1 - t0
+
+
+_request_ctx: ContextVar[_RequestContext | None] = ContextVar("request_ctx", default=None)
+
+
+def _ctx_mark(name: str):
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        ctx.mark(name)
+
+
+def _span(name: str):
+    """현재 요청의 구간 span (요청 컨텍스트 밖이면 아무것도 안 함)"""
+    ctx = _request_ctx.get()
+    return ctx.span(name) if ctx is not None else nullcontext()
+
+
+def _ctx_requested(model: str):
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        ctx.requested_model = model
+
+
+def _ctx_route(route: str, model: str):
+    """라우팅 결정 기록 (fallback으로 다시 라우팅되면 덮어쓴다)"""
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        ctx.route, ctx.model = route, model
+        ctx.mark("routed")
+
+
+async def _trace_connect(event: str, info: dict):
+    """httpx trace 확장: 새 업스트림 연결 수립 시간 관측"""
+    ctx = _request_ctx.get()
+    if event in ("connection.connect_tcp.started", "connection.connect_unix_socket.started"):
+        if ctx is not None:
+            ctx.marks["_connect"] = time.perf_counter()
+    elif event in ("connection.connect_tcp.complete", "connection.connect_unix_socket.complete"):
+        if ctx is not None and "_connect" in ctx.marks:
+            started = ctx.marks.pop("_connect")
+            elapsed = time.perf_counter() - started
+            ctx.spans.append(("upstream_connect", started, elapsed))
+            _metrics["connect"].observe((ctx.route,), elapsed)
+
+
+_UPSTREAM_EXTENSIONS = {"trace": _trace_connect}
+
+
+def _finish_request(ctx: _RequestContext, status: int):
+    """응답이 끝난 시점에 요청 하나의 구간들을 히스토그램에 반영"""
+    if ctx.finished:
+        return
+    ctx.finished = True
+    ctx.mark("end")
+    ctx.mark("first_byte")  # 비스트리밍 응답은 본문 전체가 한 번에 나간다
+    labels = (ctx.route, ctx.model)
+    _metrics["requests"].inc((ctx.endpoint, ctx.route, ctx.model, str(status)))
+    _metrics["duration"].observe(labels, ctx.since(None, "end"))
+    for metric, start, end in (
+        ("overhead", None, "upstream_send"),
+        ("upstream_ttfb", "upstream_send", "upstream_first_byte"),
+        ("ttfb", None, "first_byte"),
+    ):
+        value = ctx.since(start, end)
+        if value is not None:
+            _metrics[metric].observe(labels, value)
+    streamed = ctx.since("upstream_first_byte", "end") if ctx.streaming else None
+    if streamed is not None:
+        _metrics["stream_duration"].observe(labels, streamed)
+        if ctx.output_tokens and streamed > 0:
+            _metrics["tokens_per_second"].observe(labels, ctx.output_tokens / streamed)
+    if ADAPTIVE["enabled"] and ctx.model and ctx.route in ("thinking", "codex-effort", "passthrough"):
+        _adaptive.observe(ctx.model, ctx.since("upstream_send", "upstream_first_byte"), status)
+    if ctx.profiler is not None:
+        _dump_profile(ctx)
+    if TRACE_LOG:
+        _write_trace(ctx, status)
+    if ctx.capture is not None:
+        _capture.add(ctx, status)
+
+
+def _write_trace(ctx: _RequestContext, status: int):
+    """요청 하나를 JSONL 한 줄로 기록 (시각은 요청 수신 기준 ms). 파일 쓰기는 로그 writer 스레드가 한다."""
+
+    def ms(t: float) -> float:
+        return round((t - ctx.started) * 1000, 3)
+
+    record = {
+        "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        "request_id": ctx.request_id,
+        "endpoint": ctx.endpoint,
+        "route": ctx.route,
+        "model": ctx.model,
+        "status": status,
+        "stream": ctx.streaming,
+        "duration_ms": ms(ctx.marks["end"]),
+        "output_tokens": ctx.output_tokens,
+        "spans": [{"name": name, "start_ms": ms(t0), "duration_ms": round(d * 1000, 3)}
+                  for name, t0, d in ctx.spans],
+        "marks": {name: ms(t) for name, t in ctx.marks.items() if not name.startswith("_")},
+    }
+    _logger.trace(record)
+
+
+_profile_state = {"seen": 0, "armed": 0, "active": False, "dumps": deque(maxlen=20)}
+
+
+def _maybe_profile(ctx: _RequestContext):
+    """PROFILE_EVERY번째 요청 또는 /admin/profile로 예약된 요청이면 cProfile 시작.
+
+    프로파일러는 스레드 전체를 보므로 같은 시간에 처리되는 다른 요청도 함께 잡힌다 (한 번에 하나만 실행).
+    """
+    state = _profile_state
+    state["seen"] += 1
+    wanted = state["armed"] > 0 or (PROFILE_EVERY and state["seen"] % PROFILE_EVERY == 0)
+    if not wanted or state["active"]:
+        return
+    if state["armed"] > 0:
+        state["armed"] -= 1
+    state["active"] = True
+    ctx.profiler = cProfile.Profile()
+    ctx.profiler.enable()
+
+
+def _dump_profile(ctx: _RequestContext):
+    ctx.profiler.disable()
+    _profile_state["active"] = False
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{int(time.time())}-{ctx.route}-{ctx.request_id}.prof")
+        ctx.profiler.dump_stats(path)
+    except OSError as e:
+        _log("error", "profile", f"⚠️ Profile dump error: {e}")
+        return
+    _profile_state["dumps"].append(path)
+    _log("info", "profile", f"🔬 Profile [{ctx.route}] {ctx.model}: {path}", path=path)
+
+
+def _profile_summary(path: str, limit: int = 30) -> str:
+    """저장된 프로파일에서 이 파일의 함수(변환/SSE 경로)만 누적 시간순으로"""
+    out = io.StringIO()
+    stats = pstats.Stats(path, stream=out)
+    stats.sort_stats("cumulative").print_stats(re.escape(os.path.basename(__file__)), limit)
+    return out.getvalue()
+
+
+def _record_token_metrics(route: str, model: str, usage: dict):
+    tokens = _metrics["tokens"]
+    for kind, keys in (
+        ("input", ("input_tokens", "prompt_tokens")),
+        ("output", ("output_tokens", "completion_tokens")),
+        ("cache_read", ("cache_read_input_tokens",)),
+        ("cache_creation", ("cache_creation_input_tokens",)),
+    ):
+        value = next((usage[k] for k in keys if usage.get(k)), 0)
+        if value:
+            tokens.inc((route, model, kind), value)
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        ctx.output_tokens = usage.get("output_tokens", usage.get("completion_tokens")) or None
+
+
+def _export_metrics() -> dict:
+    """공유용 스냅샷 (collect 콜백 값 포함)"""
+    return {key: metric.export() for key, metric in _metrics.items()}
+
+
+def _render_metrics(peers: list[dict] = ()) -> str:
+    """peers: 다른 워커들의 _export_metrics() 스냅샷 (--workers일 때 합산)"""
+    lines = []
+    for key, metric in _metrics.items():
+        lines.extend(metric.render([p[key] for p in peers if key in p]))
+    return "\n".join(lines) + "\n"
+
+
+# =====================================================================
+# 사용량 원장 (SQLite, 배치 기록) / /usage 집계
+# =====================================================================
+
+# 요청별 토큰 사용량을 남길 SQLite 파일 (기본 끔, --usage-db ~/.ccs-wrapper/usage.db 로 켠다)
+USAGE_DB = None
+USAGE_FLUSH_INTERVAL = 1.0  # writer가 모아서 쓰는 최대 간격 (초)
+USAGE_BATCH = 500
+USAGE_QUEUE_SIZE = 10000    # 초과분은 버리고 dropped로 센다
+
+_USAGE_STOP = object()
+_USAGE_COLUMNS = ("ts", "request_id", "endpoint", "route", "alias", "model", "stream", "input_tokens",
+                  "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+_USAGE_GROUPS = ("model", "alias", "route", "endpoint")
+_USAGE_BUCKETS = {"minute": "%Y-%m-%dT%H:%M", "hour": "%Y-%m-%dT%H:00", "day": "%Y-%m-%d"}
+
+
+class _UsageLedger:
+    """요청 경로에서는 행을 큐에 넣기만 하고, writer 스레드가 USAGE_FLUSH_INTERVAL마다 한 트랜잭션으로 기록"""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=USAGE_QUEUE_SIZE)
+        self.stats = {"recorded": 0, "written": 0, "dropped": 0, "batches": 0, "errors": 0}
+        self._thread = None
+
+    def add(self, row: tuple):
+        if not USAGE_DB:
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ccs-wrapper-usage", daemon=True)
+            self._thread.start()
+        try:
+            self.queue.put_nowait(row)
+            self.stats["recorded"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    @staticmethod
+    def _connect() -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(USAGE_DB) or ".", exist_ok=True)
+        conn = sqlite3.connect(USAGE_DB, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            "ts REAL NOT NULL, request_id TEXT, endpoint TEXT, route TEXT, alias TEXT, model TEXT, stream INTEGER, "
+            "input_tokens INTEGER, output_tokens INTEGER, "
+            "cache_read_input_tokens INTEGER, cache_creation_input_tokens INTEGER)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS usage_ts ON usage(ts)")
+        return conn
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except (OSError, sqlite3.Error) as e:
+            self.stats["errors"] += 1
+            _log("error", "usage", f"⚠️ Usage ledger disabled: {e}")
+            return
+        insert = f"INSERT INTO usage ({', '.join(_USAGE_COLUMNS)}) VALUES ({', '.join('?' * len(_USAGE_COLUMNS))})"
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + USAGE_FLUSH_INTERVAL
+            while len(batch) < USAGE_BATCH and batch[-1] is not _USAGE_STOP:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _USAGE_STOP
+            rows = [r for r in batch if r is not _USAGE_STOP]
+            if rows:
+                try:
+                    with conn:
+                        conn.executemany(insert, rows)
+                    self.stats["written"] += len(rows)
+                    self.stats["batches"] += 1
+                except sqlite3.Error as e:
+                    self.stats["errors"] += 1
+                    _log("error", "usage", f"⚠️ Usage ledger write error: {e}")
+            if stop:
+                conn.close()
+                return
+
+    def close(self, timeout: float = 5.0):
+        """남은 행을 기록하고 writer 종료 (프로세스 종료 시)"""
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            self.queue.put(_USAGE_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def query(self, group_by: list[str], bucket: str | None, since: float | None, until: float | None) -> list[dict]:
+        """그룹(모델/별칭 슬롯/라우트/엔드포인트) × 시간 bucket별 합계. 동기 함수라 스레드에서 호출."""
+        keys = [g for g in group_by if g in _USAGE_GROUPS]
+        select = list(keys)
+        if bucket:
+            select.insert(0, f"strftime('{_USAGE_BUCKETS[bucket]}', ts, 'unixepoch') AS bucket")
+        where, params = [], []
+        if since is not None:
+            where.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("ts < ?")
+            params.append(until)
+        group_cols = (["bucket"] if bucket else []) + keys
+        select += ["COUNT(*)", "SUM(input_tokens)", "SUM(output_tokens)",
+                   "SUM(cache_read_input_tokens)", "SUM(cache_creation_input_tokens)"]
+        sql = (
+            f"SELECT {', '.join(select)} FROM usage"
+            + (f" WHERE {' AND '.join(where)}" if where else "")
+            + (f" GROUP BY {', '.join(group_cols)} ORDER BY {', '.join(group_cols)}" if group_cols else "")
+        )
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        out = []
+        for row in rows:
+            labels = dict(zip(group_cols, row[:len(group_cols)]))
+            requests, inp, outp, cache_read, cache_creation = (v or 0 for v in row[len(group_cols):])
+            prompt = inp + cache_read + cache_creation
+            out.append({
+                **labels,
+                "requests": requests,
+                "input_tokens": inp,
+                "output_tokens": outp,
+                "cache_read_input_tokens": cache_read,
+                "cache_creation_input_tokens": cache_creation,
+                "cache_hit_ratio": round(cache_read / prompt, 4) if prompt else 0.0,
+            })
+        return out
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "pending": self.queue.qsize(), "db": USAGE_DB or None}
+
+
+_usage_ledger = _UsageLedger()
+atexit.register(_usage_ledger.close)
+
+
+def _ledger_usage(route: str, model: str, usage: dict):
+    ctx = _request_ctx.get()
+    _usage_ledger.add((
+        time.time(),
+        ctx.request_id if ctx is not None else None,
+        ctx.endpoint if ctx is not None else None,
+        route,
+        (ctx.requested_model or model) if ctx is not None else model,
+        model,
+        int(ctx.streaming) if ctx is not None else None,
+        usage.get("input_tokens", usage.get("prompt_tokens", 0)) or 0,
+        usage.get("output_tokens", usage.get("completion_tokens", 0)) or 0,
+        usage.get("cache_read_input_tokens", 0) or 0,
+        usage.get("cache_creation_input_tokens", 0) or 0,
+    ))
+
+
+# =====================================================================
+# 트래픽 캡처: 요청 본문/라우팅/업스트림 응답 프레임을 gzip JSONL로 (bench/replay-capture.py로 재생)
+# =====================================================================
+
+CAPTURE = {
+    "path": None,                    # 예: "~/.ccs-wrapper/capture/traffic.jsonl.gz" (None이면 끔, --capture)
+    "anonymize": True,               # 텍스트를 같은 길이의 x로 치환 (JSON 구조/크기/모델/파라미터는 유지)
+    "max_bytes": 64 * 1024 * 1024,   # 파일 하나의 최대 크기 (압축 후). 넘으면 회전
+    "keep": 5,                       # 회전된 파일 보관 개수 (traffic.1.jsonl.gz ...)
+    "max_body": 8 * 1024 * 1024,     # 이보다 큰 요청 본문/업스트림 응답은 내용 없이 크기만 기록
+    "level": 6,                      # gzip 압축 레벨
+    "queue_size": 1000,              # 초과분은 버리고 dropped로 센다
+}
+
+_CAPTURE_STOP = object()
+_CAPTURE_VERSION = 1
+# 익명화해도 그대로 두는 값 (라우팅/재생에 필요한 식별자·열거형)
+_CAPTURE_KEEP_KEYS = frozenset({
+    "model", "role", "type", "id", "tool_use_id", "name", "media_type", "object", "event",
+    "stop_reason", "stop_sequence", "finish_reason", "effort", "reasoning_effort", "tool_choice",
+})
+_CAPTURE_JSON_FRAGMENTS = ("partial_json", "arguments")  # 스트리밍되는 JSON 조각 (문자열 리터럴만 치환)
+_CAPTURE_HEADERS = ("content-type", "anthropic-version", "anthropic-beta")
+_WORD = re.compile(r"\w")
+
+
+def _scrub_text(text: str) -> str:
+    return _WORD.sub("x", text)
+
+
+def _scrub_fragment(text: str, state: list) -> str:
+    """JSON 조각에서 문자열 리터럴 안의 글자만 치환 (키/숫자/구두점 유지 → 이어 붙이면 여전히 유효한 JSON).
+    state = [문자열 안, 이스케이프 직후, \\u 뒤 남은 hex 자리] — 조각 경계를 넘어 이어진다."""
+    in_str, escaped, hold = state
+    out = []
+    for ch in text:
+        if not in_str:
+            in_str = ch == '"'
+        elif hold:
+            hold -= 1
+        elif escaped:
+            escaped = False
+            hold = 4 if ch == "u" else 0
+        elif ch == "\\":
+            escaped = True
+        elif ch == '"':
+            in_str = False
+        elif ch.isalnum() or ch == "_":
+            ch = "x"
+        out.append(ch)
+    state[:] = [in_str, escaped, hold]
+    return "".join(out)
+
+
+def _anonymize(value, key: str | None = None, fragments: dict | None = None, index=None):
+    """JSON 값 익명화: 키/구조/숫자/불리언과 _CAPTURE_KEEP_KEYS 값은 유지, 나머지 문자열은 같은 길이로 치환"""
+    if isinstance(value, dict):
+        index = value.get("index", index)
+        return {k: _anonymize(v, k, fragments, index) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_anonymize(v, key, fragments, index) for v in value]
+    if not isinstance(value, str) or key in _CAPTURE_KEEP_KEYS:
+        return value
+    if key in _CAPTURE_JSON_FRAGMENTS and fragments is not None:
+        return _scrub_fragment(value, fragments.setdefault((key, index), [False, False, 0]))
+    return _scrub_text(value)
+
+
+def _anonymize_frame(frame: str, fragments: dict) -> str:
+    """SSE 프레임 하나: data: 줄의 JSON만 익명화 (event:/빈 줄/[DONE]은 그대로)"""
+    lines = []
+    for line in frame.split("\n"):
+        if line.startswith("data:") and line[5:].strip() not in ("", "[DONE]"):
+            try:
+                line = "data: " + json.dumps(_anonymize(json.loads(line[5:]), fragments=fragments), ensure_ascii=False)
+            except ValueError:
+                line = "data: " + _scrub_text(line[5:].strip())
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class _CaptureStream(httpx.AsyncByteStream):
+    """업스트림 스트리밍 응답을 그대로 넘기면서 청크와 도착 시각을 캡처 항목에 모은다"""
+
+    def __init__(self, stream, entry: dict):
+        self.stream = stream
+        self.entry = entry
+
+    async def __aiter__(self):
+        chunks = self.entry["chunks"]
+        async for chunk in self.stream:
+            self.entry["bytes"] += len(chunk)
+            if self.entry["bytes"] <= CAPTURE["max_body"]:
+                chunks.append((time.perf_counter(), chunk))
+            yield chunk
+
+    async def aclose(self):
+        await self.stream.aclose()
+
+
+def _capture_upstream(url: str, content: bytes, r: httpx.Response, stream: bool, sent: float) -> httpx.Response:
+    """_send_upstream이 돌려주는 최종 업스트림 응답을 현재 요청의 캡처에 추가 (캡처 중이 아니면 그대로)"""
+    ctx = _request_ctx.get()
+    if ctx is None or ctx.capture is None:
+        return r
+    entry = {
+        "url": url, "content": content, "status": r.status_code, "stream": stream,
+        "headers": {k: r.headers[k] for k in ("content-type", "content-encoding", "retry-after") if k in r.headers},
+        "sent": sent, "headers_at": time.perf_counter(), "chunks": [], "bytes": 0,
+    }
+    ctx.capture["upstream"].append(entry)
+    if stream:
+        r.stream = _CaptureStream(r.stream, entry)
+    else:
+        entry["bytes"] = len(r.content)
+        if entry["bytes"] <= CAPTURE["max_body"]:
+            entry["chunks"].append((entry["headers_at"], r.content))
+    return r
+
+
+async def _capture_begin(ctx, request: Request):
+    """캡처 대상 요청: 본문을 미리 읽어 둔다 (starlette가 캐시하므로 핸들러가 다시 읽어도 같은 바이트)"""
+    ctx.capture = {
+        "wall": time.time(),
+        "method": request.method,
+        "path": request.url.path,
+        "query": str(request.query_params),
+        "headers": {k: request.headers[k] for k in _CAPTURE_HEADERS if k in request.headers},
+        "body": await request.body(),
+        "upstream": [],
+    }
+
+
+class _CaptureWriter:
+    """캡처 레코드 writer. 요청 경로에서는 원본 바이트를 큐에 넣기만 하고,
+    익명화/직렬화/압축/회전은 writer 스레드에서 한다 (레코드마다 한 줄, 배치마다 flush)."""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=CAPTURE["queue_size"])
+        self.stats = {"recorded": 0, "written": 0, "dropped": 0, "rotations": 0, "errors": 0}
+        self._thread = None
+        self._file = None
+
+    def path(self) -> str | None:
+        path = CAPTURE["path"]
+        if not path:
+            return None
+        path = os.path.expanduser(path)
+        if WORKERS > 1:
+            path = self._numbered(path, f"w{os.getpid()}")  # 워커마다 따로 (gzip 스트림이 섞이지 않게)
+        return path
+
+    @staticmethod
+    def _numbered(path: str, tag) -> str:
+        for ext in (".jsonl.gz", ".gz"):
+            if path.endswith(ext):
+                return f"{path[:-len(ext)]}.{tag}{ext}"
+        return f"{path}.{tag}"
+
+    def add(self, ctx, status: int):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ccs-wrapper-capture", daemon=True)
+            self._thread.start()
+        try:
+            self.queue.put_nowait((ctx, status))
+            self.stats["recorded"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _record(self, ctx, status: int) -> dict:
+        capture = ctx.capture
+        started = ctx.started
+
+        def ms(t: float | None) -> float | None:
+            return round((t - started) * 1000, 3) if t is not None else None
+
+        anonymize = CAPTURE["anonymize"]
+        raw = capture["body"]
+        body = None
+        if raw and len(raw) <= CAPTURE["max_body"]:
+            try:
+                body = json.loads(raw)
+            except ValueError:
+                body = None
+            else:
+                if anonymize:
+                    body = _anonymize(body)
+        upstream = []
+        for entry in capture["upstream"]:
+            frames, omitted = self._frames(entry, anonymize)
+            path = entry["url"][len(CCS_BASE):] if entry["url"].startswith(CCS_BASE) else entry["url"]
+            try:
+                model = _LazyBody(entry["content"]).get("model")  # 업스트림으로 보낸 모델 (라우팅 결과)
+            except ValueError:
+                model = None
+            upstream.append({
+                "path": path, "model": model, "status": entry["status"], "stream": entry["stream"],
+                "headers": entry["headers"], "sent_ms": ms(entry["sent"]),
+                "ttfb_ms": round((entry["headers_at"] - entry["sent"]) * 1000, 3),
+                "bytes": entry["bytes"], "omitted": omitted,
+                # [전송 후 ms, 프레임 텍스트]
+                "frames": [[round((t - entry["sent"]) * 1000, 3), text] for t, text in frames],
+            })
+        return {
+            "v": _CAPTURE_VERSION,
+            "ts": datetime.fromtimestamp(capture["wall"], timezone.utc).isoformat(timespec="milliseconds"),
+            "t": capture["wall"],
+            "request_id": ctx.request_id,
+            "endpoint": ctx.endpoint,
+            "method": capture["method"],
+            "path": capture["path"],
+            "query": capture["query"],
+            "headers": capture["headers"],
+            "body": body,
+            "body_bytes": len(raw or b""),
+            "anonymized": anonymize,
+            "requested_model": ctx.requested_model,
+            "route": ctx.route,
+            "model": ctx.model,
+            "status": status,
+            "stream": ctx.streaming,
+            "marks": {name: ms(t) for name, t in ctx.marks.items() if not name.startswith("_")},
+            "upstream": upstream,
+        }
+
+    @staticmethod
+    def _frames(entry: dict, anonymize: bool) -> tuple[list, bool]:
+        """청크 → (도착 시각, 프레임) 목록. 압축된 응답은 풀어서, SSE는 프레임 단위로 (익명화하면 프레임별로)."""
+        if entry["bytes"] > CAPTURE["max_body"]:
+            return [], True
+        encoding = entry["headers"].get("content-encoding", "identity").lower()
+        if encoding in ("gzip", "deflate"):
+            decoder = zlib.decompressobj(wbits=47 if encoding == "gzip" else zlib.MAX_WBITS)
+            chunks = [(t, decoder.decompress(c)) for t, c in entry["chunks"]]
+        elif encoding == "identity":
+            chunks = entry["chunks"]
+        else:
+            return [], True  # br/zstd 등: 재생 stub이 풀 수 없으니 내용은 남기지 않음
+        entry["headers"] = {k: v for k, v in entry["headers"].items() if k != "content-encoding"}
+        sse = "text/event-stream" in entry["headers"].get("content-type", "")
+        fragments = {}
+        if not sse:
+            data = b"".join(c for _, c in chunks).decode("utf-8", errors="replace")
+            if anonymize:
+                try:
+                    data = json.dumps(_anonymize(json.loads(data), fragments=fragments), ensure_ascii=False)
+                except ValueError:
+                    data = _scrub_text(data)
+            return ([(chunks[-1][0], data)] if chunks else []), False
+        frames, pending = [], ""
+        for t, chunk in chunks:
+            pending += chunk.decode("utf-8", errors="replace").replace("\r\n", "\n")
+            *complete, pending = pending.split("\n\n")
+            for frame in complete:
+                frames.append((t, (_anonymize_frame(frame, fragments) if anonymize else frame) + "\n\n"))
+        if pending.strip():
+            frames.append((chunks[-1][0], _anonymize_frame(pending, fragments) if anonymize else pending))
+        return frames, False
+
+    def _open(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        return gzip.open(path, "ab", compresslevel=CAPTURE["level"])  # 기존 파일이 있으면 gzip 멤버를 이어 붙임
+
+    def _rotate(self, path: str):
+        self._file.close()
+        for i in range(CAPTURE["keep"] - 1, 0, -1):
+            older = self._numbered(path, i)
+            if os.path.exists(older):
+                os.replace(older, self._numbered(path, i + 1))
+        if CAPTURE["keep"] > 0:
+            os.replace(path, self._numbered(path, 1))
+        else:
+            os.remove(path)
+        self.stats["rotations"] += 1
+        self._file = self._open(path)
+
+    def _run(self):
+        path = self.path()
+        try:
+            self._file = self._open(path)
+        except OSError as e:
+            self.stats["errors"] += 1
+            _log("error", "capture", f"⚠️ Capture disabled: {e}")
+            return
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not _CAPTURE_STOP:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is _CAPTURE_STOP:
+                    continue
+                try:
+                    line = json.dumps(self._record(*item), ensure_ascii=False) + "\n"
+                    self._file.write(line.encode("utf-8"))
+                    self.stats["written"] += 1
+                except (OSError, ValueError, TypeError, zlib.error) as e:
+                    self.stats["errors"] += 1
+                    _log("error", "capture", f"⚠️ Capture write error: {e}")
+            try:
+                self._file.flush()  # Z_SYNC_FLUSH: 실행 중에도 여기까지는 읽을 수 있다
+                if self._file.fileobj.tell() >= CAPTURE["max_bytes"]:
+                    self._rotate(path)
+            except OSError as e:
+                self.stats["errors"] += 1
+                _log("error", "capture", f"⚠️ Capture flush error: {e}")
+            if batch[-1] is _CAPTURE_STOP:
+                self._file.close()
+                return
+
+    def close(self, timeout: float = 5.0):
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            self.queue.put(_CAPTURE_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "pending": self.queue.qsize(), "path": self.path(), "anonymize": CAPTURE["anonymize"]}
+
+
+_capture = _CaptureWriter()
+atexit.register(_capture.close)
+
+
+# =====================================================================
+# 멀티 프로세스 (--workers): 워커 간 공유 상태 (SQLite)
+# =====================================================================
+
+# --workers N이면 워커마다 이벤트 루프가 따로 돈다. 워커 로컬 캐시/카운터 중
+# 정확해야 하는 것만 공유 SQLite 파일에 둔다:
+#   - 모델 카탈로그: TTL 안에 다른 워커가 받아온 목록을 그대로 사용 (업스트림 호출은 TTL당 대략 한 번)
+#   - 동시 요청 슬롯: 라우트/모델 상한을 전체 워커 합계로 적용
+#   - 메트릭: 워커마다 주기적으로 스냅샷을 올리고 /metrics가 합쳐서 렌더링
+# 사용량 원장은 원래 WAL 모드 SQLite라 그대로 공유된다.
+WORKERS = 1
+SHARED_STATE_DB = None         # 워커 간 공유 상태 파일 (None이면 워커 1개 = 공유 안 함)
+SHARED_METRICS_INTERVAL = 2.0  # 워커가 메트릭 스냅샷을 올리는 간격 (초)
+SHARED_SLOT_POLL = 0.02        # 다른 워커가 슬롯을 다 쓰고 있을 때 재확인 간격 (초)
+
+_OPTIONS_ENV = "CCS_WRAPPER_OPTIONS"  # __main__ → 워커 프로세스로 CLI 옵션 전달
+
+
+class _SharedState:
+    """워커 간 공유 SQLite. 한 연결을 락으로 보호해 이벤트 루프/스레드 어디서든 짧게 호출한다."""
+
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+        self.stats = {"slot_waits": 0, "catalog_hits": 0, "metrics_published": 0, "pruned": 0, "errors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(SHARED_STATE_DB)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(SHARED_STATE_DB, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS slots (name TEXT, pid INTEGER, active INTEGER, "
+                         "PRIMARY KEY (name, pid))")
+            conn.execute("CREATE TABLE IF NOT EXISTS metrics (pid INTEGER PRIMARY KEY, data TEXT, updated REAL)")
+            # 같은 pid로 재시작한 워커가 남긴 행 정리
+            conn.execute("DELETE FROM slots WHERE pid = ?", (os.getpid(),))
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> tuple[dict, float] | None:
+        with self._lock:
+            row = self._db().execute("SELECT value, updated FROM kv WHERE key = ?", (key,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def put(self, key: str, value: dict):
+        with self._lock:
+            self._db().execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+
+    def try_slot(self, name: str, capacity: int) -> bool:
+        """전체 워커 합계가 capacity 미만이면 이 워커 몫을 하나 늘리고 True"""
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                (active,) = conn.execute("SELECT COALESCE(SUM(active), 0) FROM slots WHERE name = ?",
+                                         (name,)).fetchone()
+                ok = active < capacity
+                if ok:
+                    conn.execute("INSERT INTO slots VALUES (?, ?, 1) ON CONFLICT (name, pid) "
+                                 "DO UPDATE SET active = active + 1", (name, os.getpid()))
+            finally:
+                conn.execute("COMMIT")
+        return ok
+
+    def release_slot(self, name: str):
+        with self._lock:
+            self._db().execute("UPDATE slots SET active = active - 1 WHERE name = ? AND pid = ? AND active > 0",
+                               (name, os.getpid()))
+
+    def prune(self):
+        """죽은 워커(재시작 전)가 쥐고 있던 슬롯과 메트릭 스냅샷 제거"""
+        with self._lock:
+            conn = self._db()
+            pids = {pid for (pid,) in conn.execute("SELECT pid FROM slots UNION SELECT pid FROM metrics")}
+            dead = [pid for pid in pids if not _pid_alive(pid)]
+            for pid in dead:
+                conn.execute("DELETE FROM slots WHERE pid = ?", (pid,))
+                conn.execute("DELETE FROM metrics WHERE pid = ?", (pid,))
+        self.stats["pruned"] += len(dead)
+
+    def publish_metrics(self, data: dict):
+        with self._lock:
+            self._db().execute("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?)",
+                               (os.getpid(), json.dumps(data), time.time()))
+        self.stats["metrics_published"] += 1
+
+    def peer_metrics(self) -> list[dict]:
+        with self._lock:
+            rows = self._db().execute("SELECT data FROM metrics WHERE pid != ?", (os.getpid(),)).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM slots WHERE pid = ?", (os.getpid(),))
+                self._conn.execute("DELETE FROM metrics WHERE pid = ?", (os.getpid(),))
+                self._conn.close()
+                self._conn = None
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "db": SHARED_STATE_DB, "workers": WORKERS, "pid": os.getpid()}
+
+
+_shared_state = _SharedState()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+async def _acquire_shared_slot(name: str, capacity: int, deadline: float):
+    """공유 슬롯이 날 때까지 짧게 폴링. deadline을 넘기면 _QueueFull."""
+    waited = False
+    while not await asyncio.to_thread(_shared_state.try_slot, name, capacity):
+        if not waited:
+            waited = True
+            _shared_state.stats["slot_waits"] += 1
+            await asyncio.to_thread(_shared_state.prune)
+        if time.monotonic() >= deadline:
+            raise _QueueFull(f"{name} (all workers)")
+        await asyncio.sleep(SHARED_SLOT_POLL)
+
+
+async def _publish_metrics_loop():
+    """lifespan 동안 이 워커의 메트릭 스냅샷을 주기적으로 공유 DB에 올림"""
+    while True:
+        try:
+            await asyncio.to_thread(_shared_state.publish_metrics, _export_metrics())
+        except sqlite3.Error as e:
+            _shared_state.stats["errors"] += 1
+            _log("error", "shared_state", f"⚠️ Shared metrics publish error: {e}")
+        await asyncio.sleep(SHARED_METRICS_INTERVAL)
+
+
+# =====================================================================
+# 업스트림 호출: 재시도 (첫 바이트 전) / 헤지 요청 / 모델 fallback 통계
+# =====================================================================
+
+_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+_resilience_stats = {"retries": 0, "failovers": 0, "hedged": 0, "hedge_wins": 0}
+
+
+def _should_fail_over(response: Response) -> bool:
+    """업스트림이 돌려준 429/5xx만 fallback 대상 (래퍼 자체 거절은 부하를 더하지 않게 그대로 반환)"""
+    return response.status_code in FAILOVER_STATUSES and REJECTED_HEADER not in response.headers
+
+
+class _LatencyWindow:
+    """라우트별 최근 비스트리밍 응답 시간 (헤지 기준 percentile 계산용)"""
+
+    def __init__(self, size: int = 200):
+        self.size = size
+        self.samples = {}
+
+    def add(self, route: str, seconds: float):
+        self.samples.setdefault(route, deque(maxlen=self.size)).append(seconds)
+
+    def percentile(self, route: str, pct: float) -> float | None:
+        samples = self.samples.get(route)
+        if not samples or len(samples) < HEDGE["min_samples"]:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+_latency = _LatencyWindow()
+
+
+def _retry_delay(r: httpx.Response | None, attempt: int) -> float | None:
+    """다음 재시도까지 대기 시간. retry-after가 RETRY["max_after"]보다 길면 None (재시도 안 함)."""
+    after = r.headers.get("retry-after") if r is not None else None
+    if after:
+        try:
+            delay = float(after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return max(0.0, delay) if delay <= RETRY["max_after"] else None
+    backoff = min(RETRY["max_backoff"], RETRY["backoff"] * 2 ** (attempt - 1))
+    return random.uniform(backoff / 2, backoff)  # jitter
+
+
+async def _post_hedged(url: str, content: bytes, headers: dict, route: str) -> httpx.Response:
+    """비스트리밍 POST. 응답이 라우트 p{HEDGE percentile}보다 늦으면 같은 요청을 하나 더 보내 먼저 온 쪽 사용."""
+    client = _upstream()
+
+    def post():
+        return asyncio.ensure_future(client.post(
+            url, content=content, headers=headers, timeout=_timeout(route), extensions=_UPSTREAM_EXTENSIONS,
+        ))
+
+    threshold = None
+    if HEDGE["enabled"] and len(content) <= HEDGE["max_body"]:
+        threshold = _latency.percentile(route, HEDGE["percentile"])
+
+    started = time.monotonic()
+    first = post()
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=threshold)
+        if not done:
+            _resilience_stats["hedged"] += 1
+            tasks.append(post())
+            _log("info", "hedge", f"🪃 Hedge: {route} > {threshold:.2f}s → 2nd request", route=route, threshold=threshold)
+        while True:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            ok = [t for t in done if t.exception() is None]
+            if ok or len(done) == len(tasks):
+                winner = ok[0] if ok else done.pop()
+                break
+            tasks = [t for t in tasks if t not in done]
+        if winner is not first:
+            _resilience_stats["hedge_wins"] += 1
+        r = winner.result()
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+    _latency.add(route, time.monotonic() - started)
+    return r
+
+
+async def _send_upstream(url: str, content: bytes, headers: dict, route: str,
+                         stream: bool = False) -> httpx.Response:
+    """업스트림 POST + 429/5xx·연결 오류 재시도 (jitter backoff, retry-after 준수).
+
+    stream=True면 헤더까지만 받은 응답을 돌려준다 → 클라이언트에 첫 바이트를 보내기 전이라 재시도가 안전하다.
+    재시도를 다 써도 실패하면 마지막 에러 응답을 그대로 반환한다.
+    """
+    client = _upstream()
+    attempt = 0
+    while True:
+        attempt += 1
+        _ctx_mark("upstream_send")
+        sent = time.perf_counter()
+        try:
+            if stream:
+                request = client.build_request("POST", url, content=content, headers=headers,
+                                               timeout=_timeout(route, stream=True), extensions=_UPSTREAM_EXTENSIONS)
+                try:
+                    r = await asyncio.wait_for(client.send(request, stream=True), _route_timeouts(route)["first_byte"])
+                except asyncio.TimeoutError:
+                    raise httpx.ReadTimeout("upstream first byte timeout", request=request) from None
+            else:
+                r = await _post_hedged(url, content, headers, route)
+                _ctx_mark("upstream_first_byte")
+        except _RETRYABLE_ERRORS as e:
+            if attempt >= RETRY["attempts"]:
+                raise
+            delay = _retry_delay(None, attempt)
+            _log("warning", "retry", f"🔁 Retry {attempt}/{RETRY['attempts'] - 1} [{route}]: {e!r}, wait {delay:.1f}s",
+                 route=route, attempt=attempt, error=repr(e), delay=round(delay, 3))
+        else:
+            if r.status_code not in RETRY["statuses"] or attempt >= RETRY["attempts"]:
+                return _capture_upstream(url, content, r, stream, sent)
+            delay = _retry_delay(r, attempt)
+            if delay is None:
+                return _capture_upstream(url, content, r, stream, sent)
+            await r.aclose()
+            _log("warning", "retry", f"🔁 Retry {attempt}/{RETRY['attempts'] - 1} [{route}]: upstream {r.status_code}, wait {delay:.1f}s",
+                 route=route, attempt=attempt, status=r.status_code, delay=round(delay, 3))
+        _resilience_stats["retries"] += 1
+        await asyncio.sleep(delay)
+
+
+async def _error_response(r: httpx.Response, label: str) -> JSONResponse:
+    """업스트림 에러 응답(스트리밍 응답 포함)을 읽어 같은 상태 코드로 전달"""
+    raw = await r.aread()
+    await r.aclose()
+    text = raw.decode("utf-8", errors="replace")
+    _log_upstream_error(label, r.status_code, text)
+    try:
+        content = json.loads(raw)
+    except ValueError:
+        content = {"error": {"message": f"Upstream: {text}", "type": "proxy_error"}}
+    headers = {"retry-after": r.headers["retry-after"]} if "retry-after" in r.headers else None
+    return JSONResponse(content=content, status_code=r.status_code, headers=headers)
+
+
+def _log_upstream_error(label: str, status: int, text: str):
+    """업스트림 에러 상태는 warning, 본문 앞부분은 debug 레벨에서만"""
+    _log("warning", "upstream_error", f"⚠️ {label} upstream {status}", label=label, status=status)
+    if _logger.enabled("debug"):
+        _log("debug", "upstream_error_body", f"   {text[:200]}", label=label, status=status, body=text[:200])
+
+
+_cancel_stats = {"stream_disconnects": 0, "nonstream_disconnects": 0, "first_byte_timeouts": 0, "idle_aborts": 0}
+
+# idle/first-byte 타임아웃으로 스트림을 끊을 때 클라이언트에 보내는 마지막 이벤트 (형식별)
+_IDLE_ERROR = {
+    "anthropic": b'\ndata: {"type": "error", "error": {"type": "timeout_error", "message": "upstream idle timeout"}}\n',
+    "anthropic_raw": (b'event: error\ndata: {"type": "error", "error": {"type": "timeout_error", '
+                      b'"message": "upstream idle timeout"}}\n\n'),
+    "openai_raw": (b'data: {"error": {"message": "upstream idle timeout", "type": "timeout_error"}}\n\n'
+                   b'data: [DONE]\n\n'),
+}
+
+
+async def _wait_disconnect(receive):
+    """ASGI receive에서 http.disconnect가 올 때까지 대기 (본문은 이미 읽은 뒤라 다른 메시지는 없다)"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _cancel_on_disconnect(coro, label: str):
+    """비스트리밍 업스트림 호출을 클라이언트 연결과 경주시켜, 클라이언트가 먼저 끊으면 업스트림 호출을 취소.
+    끊긴 경우 None 반환."""
+    ctx = _request_ctx.get()
+    request = ctx.request if ctx is not None else None
+    if request is None:
+        return await coro
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(_wait_disconnect(request.receive))
+    try:
+        await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            _cancel_stats["nonstream_disconnects"] += 1
+            _log("info", "disconnect", f"✂️ Client disconnected: {label} upstream call cancelled", label=label)
+            return None
+    return task.result()
+
+
+def _client_closed() -> Response:
+    """클라이언트가 이미 떠났을 때의 응답 (전달되지 않음, 메트릭/trace용 상태 코드 499)"""
+    return Response(status_code=499)
+
+
+async def _idle_guard(chunks, route: str, on_timeout, on_first=None):
+    """업스트림 청크 사이 대기 제한: 첫 청크는 first_byte, 이후는 idle 초.
+    넘기면 on_timeout을 마지막으로 내보내고 끝낸다 (스트림을 닫으면 on_close가 업스트림 응답을 닫는다).
+    on_first: 첫 청크가 왔을 때 한 번 호출 (스케줄러 슬롯 반환).
+
+    청크마다 wait_for(태스크 생성)를 쓰지 않고 timeout 하나의 마감 시각만 옮긴다.
+    yield 중(클라이언트로 쓰는 동안)에는 마감을 걸지 않는다.
+    """
+    limits = _route_timeouts(route)
+    if not hasattr(asyncio, "timeout"):  # Python < 3.11
+        async for chunk in _idle_guard_compat(chunks, route, on_timeout, limits, on_first):
+            yield chunk
+        return
+    loop = asyncio.get_running_loop()
+    first = True
+    try:
+        async with asyncio.timeout(limits["first_byte"]) as deadline:
+            async for chunk in chunks:
+                deadline.reschedule(None)
+                if first and on_first is not None:
+                    on_first()
+                first = False
+                yield chunk
+                deadline.reschedule(loop.time() + limits["idle"])
+    except TimeoutError:
+        _idle_timed_out(route, limits, first)
+        yield on_timeout
+
+
+async def _idle_guard_compat(chunks, route: str, on_timeout, limits: dict, on_first=None):
+    it = chunks.__aiter__()
+    first = True
+    while True:
+        try:
+            chunk = await asyncio.wait_for(it.__anext__(), limits["first_byte"] if first else limits["idle"])
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            _idle_timed_out(route, limits, first)
+            yield on_timeout
+            return
+        if first and on_first is not None:
+            on_first()
+        first = False
+        yield chunk
+
+
+def _idle_timed_out(route: str, limits: dict, first: bool):
+    kind = "first_byte_timeouts" if first else "idle_aborts"
+    _cancel_stats[kind] += 1
+    limit = limits["first_byte"] if first else limits["idle"]
+    _log("warning", "idle_timeout", f"⏱️ Upstream {'first byte' if first else 'idle'} timeout [{route}]: {limit}s",
+         route=route, kind=kind)
+
+
+def _proxy_error(e: Exception, label: str) -> JSONResponse:
+    if isinstance(e, httpx.ReadTimeout):
+        _cancel_stats["first_byte_timeouts"] += 1  # 응답 헤더가 오기 전에 read 타임아웃
+    message = str(e) or type(e).__name__
+    _log("error", "proxy_error", f"⚠️ {label} error: {message}", label=label, error=message)
+    return JSONResponse(
+        content={"error": {"message": message, "type": "proxy_error"}},
+        status_code=502,
+    )
+
+
+# =====================================================================
+# 업스트림 동시 요청 스케줄러 (라우트/모델별 상한 + 우선순위 대기열)
+# =====================================================================
+
+class _Limiter:
+    """동시 실행 상한이 있는 우선순위 세마포어. 낮은 priority 값이 먼저 슬롯을 받는다."""
+
+    def __init__(self, name: str, capacity: int):
+        self.name = name
+        self.capacity = capacity
+        self.active = 0
+        self._waiters = []  # heap: (priority, seq, future)
+        self._seq = 0
+        self.stats = {"acquired": 0, "queued": 0, "rejected": 0, "timeouts": 0,
+                      "wait_total": 0.0, "wait_max": 0.0, "depth_max": 0}
+
+    def depth(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    async def acquire(self, priority: int):
+        if self.active < self.capacity and not self.depth():
+            self.active += 1
+            self.stats["acquired"] += 1
+            return
+        depth = self.depth()
+        if depth >= QUEUE_MAX_WAITERS:
+            self.stats["rejected"] += 1
+            raise _QueueFull(self.name)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, fut))
+        self.stats["queued"] += 1
+        self.stats["depth_max"] = max(self.stats["depth_max"], depth + 1)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), QUEUE_TIMEOUT)
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                self.release()  # 슬롯을 받았지만 포기 → 다음 대기자에게
+            else:
+                fut.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["timeouts"] += 1
+                raise _QueueFull(self.name) from None
+            raise
+        waited = time.monotonic() - started
+        self.stats["acquired"] += 1
+        self.stats["wait_total"] += waited
+        self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)  # 슬롯을 그대로 넘김 (active 유지)
+                return
+        self.active -= 1
+
+    def snapshot(self) -> dict:
+        return {"capacity": self.capacity, "active": self.active, "waiting": self.depth(), **{
+            k: round(v, 3) if isinstance(v, float) else v for k, v in self.stats.items()
+        }}
+
+
+class _QueueFull(Exception):
+    pass
+
+
+class _Scheduler:
+    """라우트(프로바이더) 리미터 + 모델 리미터. 모델 슬롯을 먼저 잡고 라우트 슬롯을 잡는다."""
+
+    def __init__(self):
+        self.limiters = {}
+
+    def _limiter(self, key: str, capacity: int) -> _Limiter:
+        if key not in self.limiters:
+            self.limiters[key] = _Limiter(key, capacity)
+        return self.limiters[key]
+
+    async def acquire(self, route: str, model: str, priority: int):
+        """(release, None) 또는 대기열이 가득 차면 (None, 429 응답)"""
+        chain = []
+        if model in MODEL_CONCURRENCY:
+            chain.append(self._limiter(f"model:{model}", MODEL_CONCURRENCY[model]))
+        if route in ROUTE_CONCURRENCY:
+            chain.append(self._limiter(f"route:{route}", ROUTE_CONCURRENCY[route]))
+
+        held, shared = [], []
+        try:
+            with _span("queue_wait"):
+                for limiter in chain:
+                    await limiter.acquire(priority)
+                    held.append(limiter)
+                if _shared_state.enabled:
+                    # 워커 로컬 우선순위 대기열을 통과한 뒤 전체 워커 합계 상한 확인
+                    deadline = time.monotonic() + QUEUE_TIMEOUT
+                    for limiter in chain:
+                        await _acquire_shared_slot(limiter.name, limiter.capacity, deadline)
+                        shared.append(limiter.name)
+        except _QueueFull as e:
+            _release_shared(shared)
+            for limiter in reversed(held):
+                limiter.release()
+            _log("warning", "queue_full", f"🚦 Queue full: {e} ({route} {model})", route=route, model=model, limiter=str(e))
+            return None, JSONResponse(
+                content={"error": {"message": f"Upstream queue full: {e}", "type": "proxy_error"}},
+                status_code=429,
+                headers={"retry-after": str(QUEUE_RETRY_AFTER), REJECTED_HEADER: "queue-full"},
+            )
+        except BaseException:
+            _release_shared(shared)
+            for limiter in reversed(held):
+                limiter.release()
+            raise
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                _release_shared(shared)
+                for limiter in reversed(held):
+                    limiter.release()
+
+        return release, None
+
+    def snapshot(self) -> dict:
+        return {key: limiter.snapshot() for key, limiter in self.limiters.items()}
+
+
+_scheduler = _Scheduler()
+
+
+def _stream_release(release):
+    """스트림 응답의 슬롯 반환 시점: 기본은 업스트림 첫 바이트 (QUEUE_HOLD_STREAM이면 스트림 끝, on_close).
+    release는 여러 번 불러도 한 번만 반환한다."""
+    return None if QUEUE_HOLD_STREAM else release
+
+
+def _release_shared(names: list[str]):
+    for name in reversed(names):
+        try:
+            _shared_state.release_slot(name)
+        except sqlite3.Error as e:
+            _shared_state.stats["errors"] += 1
+            _log("error", "shared_state", f"⚠️ Shared slot release error ({name}): {e}")
+
+
+def _request_priority(requested_model: str, is_stream: bool) -> int:
+    """스트리밍 대화는 interactive, Haiku 슬롯/비스트리밍 호출은 background"""
+    if not is_stream or "haiku" in requested_model:
+        return PRIORITY_BACKGROUND
+    return PRIORITY_INTERACTIVE
+
+
+_sse_write_stats = {"frames": 0, "writes": 0}
+
+
+class _FrameWriter:
+    """SSE 프레임을 모아 http.response.body 한 번으로 보낸다 (SSE_COALESCE).
+
+    직전 전송 후 interval이 지났으면 바로 보내고, 아니면 남은 시간 뒤에 타이머가 보낸다.
+    본 루프 flush와 타이머 flush가 겹치지 않게 lock으로 순서를 지킨다.
+    """
+
+    def __init__(self, send, interval: float, max_bytes: int):
+        self.send = send
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.buf = []
+        self.size = 0
+        self.last_send = float("-inf")
+        self.timer = None
+        self.pending = None  # 타이머가 띄운 flush task
+        self.lock = asyncio.Lock()
+        self.loop = asyncio.get_running_loop()
+
+    async def write(self, chunk: bytes):
+        if self.pending is not None and self.pending.done():
+            pending, self.pending = self.pending, None
+            pending.result()  # 타이머 flush가 실패했으면 (클라이언트 끊김 등) 여기서 올린다
+        self.buf.append(chunk)
+        self.size += len(chunk)
+        _sse_write_stats["frames"] += 1
+        wait = self.last_send + self.interval - self.loop.time()
+        if wait <= 0 or self.size >= self.max_bytes:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(wait, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        if self.buf and self.pending is None:
+            self.pending = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        async with self.lock:
+            while self.buf:
+                data = self.buf[0] if len(self.buf) == 1 else b"".join(self.buf)
+                self.buf.clear()
+                self.size = 0
+                _sse_write_stats["writes"] += 1
+                await self.send({"type": "http.response.body", "body": data, "more_body": True})
+                self.last_send = self.loop.time()
+
+    async def close(self):
+        if self.pending is not None:
+            await self.pending
+        await self.flush()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.pending is not None and not self.pending.done():
+            self.pending.cancel()
+
+
+class _SSEResponse(StreamingResponse):
+    """SSE 응답. 스트림이 끝나거나 클라이언트가 끊으면 on_close 콜백 실행 (업스트림 응답 닫기, 슬롯 반납 등)."""
+
+    def __init__(self, content, on_close=()):
+        super().__init__(content, media_type="text/event-stream", headers=SSE_HEADERS)
+        self.on_close = list(on_close)
+
+    async def stream_response(self, send):
+        interval = SSE_COALESCE["flush_interval"] if SSE_COALESCE["enabled"] else 0
+        if interval <= 0:
+            await super().stream_response(send)
+            return
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        writer = _FrameWriter(send, interval, SSE_COALESCE["max_bytes"])
+        try:
+            async for chunk in self.body_iterator:
+                if not isinstance(chunk, (bytes, memoryview)):
+                    chunk = chunk.encode(self.charset)
+                await writer.write(chunk)
+            await writer.close()
+        finally:
+            writer.cancel()
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def __call__(self, scope, receive, send):
+        ctx = _request_ctx.get()
+        route = ctx.route if ctx is not None else "unknown"
+        if ctx is not None:
+            ctx.streaming = True
+
+        completed = False
+
+        async def send_marked(message):
+            nonlocal completed
+            if message["type"] == "http.response.body":
+                if ctx is not None and message.get("body"):
+                    ctx.mark("first_byte")
+                completed = not message.get("more_body", False)
+            await send(message)
+
+        # 업스트림이 조용한 동안(긴 thinking 등)에도 클라이언트 끊김을 바로 알아채 스트림(=업스트림 요청)을 취소
+        stream = asyncio.ensure_future(super().__call__(scope, receive, send_marked))
+        watcher = asyncio.ensure_future(_wait_disconnect(receive))
+        status = self.status_code
+        _metrics["inflight"].inc((route,))
+        try:
+            await asyncio.wait((stream, watcher), return_when=asyncio.FIRST_COMPLETED)
+            if not stream.done():
+                stream.cancel()
+            await asyncio.gather(stream, return_exceptions=True)
+            if not completed and (stream.cancelled() or stream.exception() is None):
+                # 마지막 프레임 전에 끝남 = 클라이언트 끊김 (starlette가 먼저 알아채 취소한 경우 포함)
+                _cancel_stats["stream_disconnects"] += 1
+                status = 499
+                _log("info", "disconnect", f"✂️ Client disconnected: {route} stream cancelled", route=route)
+        finally:
+            watcher.cancel()
+            if not stream.done():
+                stream.cancel()
+            _metrics["inflight"].dec((route,))
+            for callback in self.on_close:
+                result = callback()
+                if inspect.isawaitable(result):
+                    await result
+            if ctx is not None:
+                _finish_request(ctx, status)
+        if stream.done() and not stream.cancelled() and stream.exception() is not None:
+            raise stream.exception()
+
+
+def _instrumented(endpoint: str, route: str = "unknown"):
+    """엔드포인트 데코레이터: 요청 컨텍스트(메트릭 구간) 생성. SSE 응답은 스트림이 끝날 때 집계된다."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            request = kwargs.get("request")
+            request_id = request.headers.get(REQUEST_ID_HEADER) if request is not None else None
+            if request_id and (len(request_id) > 128 or not request_id.isprintable()):
+                request_id = None
+            ctx = _RequestContext(endpoint, request_id)
+            ctx.route = route
+            ctx.request = request
+            _request_ctx.set(ctx)  # 요청마다 별도 task라 reset 불필요 (스트리밍 응답까지 유지)
+            if request is not None:
+                _maybe_profile(ctx)
+                if CAPTURE["path"] and endpoint in ("chat", "messages"):
+                    await _capture_begin(ctx, request)
+            try:
+                response = await func(*args, **kwargs)
+            except BaseException:
+                _finish_request(ctx, 500)
+                raise
+            response.headers[REQUEST_ID_HEADER] = ctx.request_id
+            if not isinstance(response, _SSEResponse):
+                _finish_request(ctx, response.status_code)
+            return response
+        return wrapper
+    return decorator
+
+
+# =====================================================================
+# 라우팅 테이블: 설정을 미리 컴파일하고 모델명별 결과를 memo (파일 변경/SIGHUP 시 통째로 교체)
+# =====================================================================
+
+_ROUTING_SECTIONS = ("aliases", "thinking", "effort_suffix", "upstreams", "max_tokens")
+
+
+class _Route:
+    """모델명 하나의 라우팅 결과. 테이블이 memo해 두고 여러 요청이 공유하므로 바꾸지 않는다."""
+
+    __slots__ = ("kind", "model", "effort", "config", "chat_url", "messages_url", "max_tokens")
+
+    def __init__(self, kind: str, model: str, effort: str | None, config: dict | None,
+                 chat_url: str, messages_url: str, max_tokens: int | None):
+        self.kind = kind              # thinking / codex-effort / passthrough
+        self.model = model            # 업스트림 모델명 (codex-effort는 접미사를 뗀 이름)
+        self.effort = effort
+        self.config = config          # thinking 설정 (ccs_model/effort/max_tokens)
+        self.chat_url = chat_url
+        self.messages_url = messages_url
+        self.max_tokens = max_tokens  # max_tokens 상한 (없으면 None)
+
+
+class _RoutingTable:
+    """라우팅 설정(별칭/thinking/effort 접미사/업스트림 경로/상한)을 컴파일한 조회 테이블.
+
+    만든 뒤에는 바꾸지 않는다. 리로드는 새 테이블을 만들어 전역 참조만 바꾸므로
+    처리 중인 요청은 이미 받은 _Route로 끝까지 가고, 새 요청부터 새 테이블을 본다.
+    resolve()는 모델명별 결과를 memo해서 첫 요청 이후에는 dict 조회 한 번으로 끝난다.
+    """
+
+    def __init__(self, config: dict, source: str = "builtin"):
+        self.source = source
+        self.loaded_at = time.time()
+        self.aliases = {str(k): str(v) for k, v in config["aliases"].items()}
+        self.thinking = {}
+        for name, entry in config["thinking"].items():
+            if not isinstance(entry, dict) or "effort" not in entry or "max_tokens" not in entry:
+                raise ValueError(f"thinking.{name}: effort and max_tokens are required")
+            self.thinking[name] = {"ccs_model": name, **entry, "max_tokens": int(entry["max_tokens"])}
+        self.effort_suffix = re.compile(config["effort_suffix"])
+        if self.effort_suffix.groups != 2:
+            raise ValueError("effort_suffix must have exactly 2 groups (model, effort)")
+        self.urls = {}
+        for kind, paths in UPSTREAM_PATHS.items():
+            merged = {**paths, **(config["upstreams"].get(kind) or {})}
+            self.urls[kind] = (CCS_BASE + merged["chat"], CCS_BASE + merged["messages"])
+        self.max_tokens = {str(k): int(v) for k, v in config["max_tokens"].items()}
+        self._memo = _LRU(ROUTING_MEMO_SIZE)
+
+    def alias(self, model: str) -> str:
+        return self.aliases.get(model, model)
+
+    def resolve(self, model: str) -> _Route:
+        route = self._memo.get(model)
+        if route is None:
+            route = self._compile(model)
+            self._memo.put(model, route)
+        return route
+
+    def _compile(self, model: str) -> _Route:
+        # 우선순위: thinking 모델 → effort 접미사 → passthrough (if 체인 시절과 같은 순서)
+        config = self.thinking.get(model)
+        if config is not None:
+            kind, target, effort, cap = "thinking", model, config["effort"], config["max_tokens"]
+        else:
+            match = self.effort_suffix.match(model)
+            if match:
+                kind, target, effort = "codex-effort", match.group(1), match.group(2)
+            else:
+                kind, target, effort = "passthrough", model, None
+            cap = self.max_tokens.get(model) or self.max_tokens.get(target)
+        chat_url, messages_url = self.urls[kind]
+        return _Route(kind, target, effort, config, chat_url, messages_url, cap)
+
+    def snapshot(self) -> dict:
+        return {
+            "source": self.source,
+            "loaded_at": datetime.fromtimestamp(self.loaded_at, timezone.utc).isoformat(timespec="seconds"),
+            "aliases": len(self.aliases),
+            "thinking": list(self.thinking),
+            "effort_suffix": self.effort_suffix.pattern,
+            "max_tokens": self.max_tokens,
+            "memo_entries": len(self._memo),
+        }
+
+
+def _builtin_routing() -> dict:
+    return {
+        "aliases": MODEL_ALIASES,
+        "thinking": THINKING_MODELS,
+        "effort_suffix": EFFORT_SUFFIXES.pattern,
+        "upstreams": UPSTREAM_PATHS,
+        "max_tokens": MODEL_MAX_TOKENS,
+    }
+
+
+_routing = _RoutingTable(_builtin_routing())
+_routing_stats = {"reloads": 0, "errors": 0, "last_error": None}
+_routing_mtime = None  # 마지막으로 읽은 설정 파일 mtime (없으면 None)
+
+
+def _routing_path() -> str | None:
+    return os.path.expanduser(ROUTING_CONFIG) if ROUTING_CONFIG else None
+
+
+def _stat_mtime(path: str | None) -> int | None:
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _load_routing(reason: str) -> bool:
+    """설정 파일을 읽어 새 테이블로 교체. 파일이 없으면 내장 기본값, 잘못된 설정이면 기존 테이블 유지."""
+    global _routing, _routing_mtime
+    path = _routing_path()
+    mtime = _stat_mtime(path)
+    _routing_mtime = mtime  # 실패해도 기록: 같은 파일을 주기마다 다시 읽지 않는다 (고쳐서 저장하면 다시 읽음)
+    config = _builtin_routing()
+    source = "builtin"
+    try:
+        if mtime is not None:
+            with open(path, "rb") as f:
+                loaded = _loads(f.read())
+            if not isinstance(loaded, dict):
+                raise ValueError("routing config must be a JSON object")
+            unknown = sorted(set(loaded) - set(_ROUTING_SECTIONS))
+            if unknown:
+                raise ValueError(f"unknown sections: {unknown}")
+            config.update(loaded)
+            source = path
+        table = _RoutingTable(config, source)
+    except (OSError, ValueError, TypeError, AttributeError, re.error) as e:
+        _routing_stats["errors"] += 1
+        _routing_stats["last_error"] = f"{type(e).__name__}: {e}"
+        _log("error", "routing", f"⚠️ Routing config rejected ({reason}), keeping previous table: {e}",
+             reason=reason, source=path)
+        return False
+    _routing = table
+    _routing_stats["reloads"] += 1
+    _routing_stats["last_error"] = None
+    _log("info", "routing", f"🗺️ Routing table loaded ({reason}): {source} — thinking={len(table.thinking)} "
+         f"aliases={len(table.aliases)} effort={table.effort_suffix.pattern}",
+         reason=reason, source=source)
+    return True
+
+
+async def _watch_routing_loop():
+    """설정 파일 mtime을 주기적으로 확인해서 바뀌면 리로드 (워커마다 따로 돌아 --workers에서도 반영)"""
+    while True:
+        await asyncio.sleep(ROUTING_POLL_INTERVAL)
+        if _stat_mtime(_routing_path()) != _routing_mtime:
+            await asyncio.to_thread(_load_routing, "file change")
+
+
+def _install_routing_signal() -> bool:
+    """SIGHUP → 즉시 리로드 (Windows 등 지원하지 않는 환경이면 파일 감시만)"""
+    try:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(
+            signal.SIGHUP, lambda: asyncio.ensure_future(asyncio.to_thread(_load_routing, "SIGHUP")),
+        )
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        return False
+    return True
+
+
+def _cap_max_tokens(body: _LazyBody, route: _Route, keys: tuple[str, ...]):
+    """라우팅 설정의 모델별 max_tokens 상한 적용 (thinking은 _fit_context가 처리)"""
+    if not route.max_tokens:
+        return
+    for key in keys:
+        value = body.get(key)
+        if isinstance(value, int) and value > route.max_tokens:
+            body[key] = route.max_tokens
+
+
+# =====================================================================
+# 적응형 다운그레이드 / 부하 차단: 별칭 대상 모델을 백엔드 상태에 따라 단계적으로 낮춤
+# =====================================================================
+
+# 별칭(MODEL_ALIASES)으로 들어온 /v1/messages 요청만 대상. 판단은 워커별로 한다.
+ADAPTIVE = {
+    "enabled": False,
+    "window": 60,            # 백엔드 상태를 보는 최근 구간 (초)
+    "min_samples": 5,        # 구간 안 요청이 이보다 적으면 지연/에러율로는 판단하지 않음
+    "ttfb": 30.0,            # 업스트림 첫 바이트 p90이 이 값(초)을 넘으면 압박
+    "error_rate": 0.25,      # 429/5xx 비율이 이 값을 넘으면 압박
+    "queue": 1.0,            # 스케줄러 슬롯 사용률이 이 값 이상이면서 대기자가 있으면 압박
+    "interval": 2.0,         # 슬롯별 재평가 간격 (초)
+    "hold": 10.0,            # 한 단계 내린 뒤 다음 단계로 더 내리기까지 최소 간격 (초)
+    "cooldown": 60.0,        # 압박 없는 상태가 이만큼 이어져야 한 단계 복귀 (초)
+    "shed": ("haiku",),      # 모든 백엔드가 압박일 때 즉시 429를 받는 요청 모델명 (background 우선순위만)
+    "shed_retry_after": 15,
+}
+
+# 별칭 대상 모델 → 압박이 이어지면 차례로 내려갈 모델 (effort를 낮추거나 다른 백엔드로)
+ADAPTIVE_LADDERS = {
+    "gpt-5.3-codex-xhigh": ["gpt-5.3-codex-high", "gpt-5.3-codex-medium"],
+}
+
+
+class _AdaptivePolicy:
+    """별칭 슬롯별 단계(level)를 백엔드 상태로 조절하는 히스테리시스 제어기.
+
+    백엔드 상태 = 최근 window초 동안 끝난 요청의 업스트림 첫 바이트 p90 / 429·5xx 비율 + 스케줄러 대기열.
+    현재 단계의 모델이 압박이면 hold 간격으로 한 단계씩 내리고, cooldown 동안 조용하면 한 단계씩 올린다.
+    """
+
+    def __init__(self):
+        self.samples = {}    # model → deque[(monotonic, ttfb | None, error)]
+        self.slots = {}      # 별칭 대상 모델 → {"level", "changed", "checked", "calm_since"}
+        self.decisions = deque(maxlen=100)
+        self.stats = {"downgrades": 0, "restores": 0, "shed": 0}
+        self.saturated = None  # 포화 사유 (아니면 None)
+        self._saturation_checked = 0.0
+        self._tracked = set()
+        self._tracked_for = None
+
+    def _is_tracked(self, model: str) -> bool:
+        table = _routing
+        if self._tracked_for is not table:
+            self._tracked_for = table
+            self._tracked = set(table.aliases.values()) | set(ADAPTIVE_LADDERS)
+            for ladder in ADAPTIVE_LADDERS.values():
+                self._tracked.update(ladder)
+        return model in self._tracked
+
+    def observe(self, model: str, ttfb: float | None, status: int):
+        """요청 하나가 끝날 때 (_finish_request). 클라이언트가 끊은 요청(499)은 백엔드 상태와 무관."""
+        if status == 499 or not self._is_tracked(model):
+            return
+        self.samples.setdefault(model, deque(maxlen=500)).append(
+            (time.monotonic(), ttfb, status in FAILOVER_STATUSES),
+        )
+
+    def pressure(self, model: str) -> str | None:
+        """model 백엔드가 압박 상태면 사유, 아니면 None"""
+        route = _routing.resolve(model)
+        for name in (f"model:{route.model}", f"route:{route.kind}"):
+            limiter = _scheduler.limiters.get(name)
+            if limiter is not None and limiter.active >= limiter.capacity * ADAPTIVE["queue"]:
+                waiting = limiter.depth()
+                if waiting:
+                    return f"{name} {limiter.active}/{limiter.capacity} +{waiting} waiting"
+        samples = self.samples.get(model)
+        if not samples:
+            return None
+        horizon = time.monotonic() - ADAPTIVE["window"]
+        while samples and samples[0][0] < horizon:
+            samples.popleft()
+        if len(samples) < ADAPTIVE["min_samples"]:
+            return None
+        errors = sum(1 for _, _, error in samples if error)
+        if errors / len(samples) > ADAPTIVE["error_rate"]:
+            return f"error rate {errors}/{len(samples)}"
+        ttfbs = sorted(t for _, t, _ in samples if t is not None)
+        if ttfbs:
+            p90 = ttfbs[min(len(ttfbs) - 1, int(len(ttfbs) * 0.9))]
+            if p90 > ADAPTIVE["ttfb"]:
+                return f"ttfb p90 {p90:.1f}s"
+        return None
+
+    def _decide(self, action: str, slot: str, before: str, after: str, reason: str):
+        self.decisions.append({
+            "ts": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "action": action, "slot": slot, "from": before, "to": after, "reason": reason,
+        })
+        icon = {"downgrade": "📉", "restore": "📈", "saturated": "🛑", "recovered": "✅"}[action]
+        _log("warning" if action in ("downgrade", "saturated") else "info", "adaptive",
+             f"{icon} Adaptive {action}: {slot} {before} → {after} ({reason})",
+             action=action, slot=slot, model=after, reason=reason)
+
+    def select(self, target: str) -> str:
+        """별칭 대상 모델 → 지금 보낼 모델 (슬롯 단계 반영)"""
+        ladder = ADAPTIVE_LADDERS.get(target)
+        if not ladder:
+            return target
+        now = time.monotonic()
+        slot = self.slots.get(target)
+        if slot is None:
+            slot = self.slots[target] = {"level": 0, "changed": 0.0, "checked": 0.0, "calm_since": now}
+        if now - slot["checked"] >= ADAPTIVE["interval"]:
+            slot["checked"] = now
+            steps = [target, *ladder]
+            current = steps[slot["level"]]
+            reason = self.pressure(current)
+            if reason:
+                slot["calm_since"] = now
+                if slot["level"] < len(ladder) and now - slot["changed"] >= ADAPTIVE["hold"]:
+                    slot["level"] += 1
+                    slot["changed"] = now
+                    self.stats["downgrades"] += 1
+                    self._decide("downgrade", target, current, steps[slot["level"]], reason)
+            elif slot["level"] and now - max(slot["calm_since"], slot["changed"]) >= ADAPTIVE["cooldown"]:
+                slot["level"] -= 1
+                slot["changed"] = slot["calm_since"] = now
+                self.stats["restores"] += 1
+                self._decide("restore", target, current, steps[slot["level"]], f"calm for {ADAPTIVE['cooldown']:.0f}s")
+        return ladder[slot["level"] - 1] if slot["level"] else target
+
+    def _check_saturation(self) -> str | None:
+        """최근 트래픽이 있는 백엔드와 차단 대상 슬롯의 백엔드가 전부 압박이면 포화 (interval마다 한 번만 계산)"""
+        now = time.monotonic()
+        if now - self._saturation_checked < ADAPTIVE["interval"]:
+            return self.saturated
+        self._saturation_checked = now
+        # 차단 대상 슬롯의 별칭 대상은 트래픽이 없어도 포함: 차단 중 샘플이 없어지면 압박 아님 → 다시 흘려 보며 확인
+        shed_targets = {target for alias, target in _routing.aliases.items()
+                        if any(p in alias for p in ADAPTIVE["shed"])}
+        reasons = {}
+        for model in sorted(set(self.samples) | shed_targets):
+            reason = self.pressure(model)
+            if not self.samples.get(model) and model not in shed_targets:
+                continue  # window 밖으로 다 빠짐 = 최근 트래픽 없음
+            if reason is None:
+                reasons = None
+                break
+            reasons[model] = reason
+        saturated = "; ".join(f"{m}: {r}" for m, r in reasons.items()) if reasons else None
+        if bool(saturated) != bool(self.saturated):
+            self._decide("saturated" if saturated else "recovered", "*", "-", "-", saturated or "backend pressure cleared")
+        self.saturated = saturated
+        return saturated
+
+    def shed(self, requested: str, priority: int) -> JSONResponse | None:
+        """포화 상태에서 background 우선순위의 shed 대상 슬롯(Haiku 등)이면 업스트림 없이 바로 429"""
+        if priority != PRIORITY_BACKGROUND or not any(p in requested for p in ADAPTIVE["shed"]):
+            return None
+        if not self._check_saturation():
+            return None
+        self.stats["shed"] += 1
+        _log("info", "adaptive", f"🛑 Shed: {requested} (all backends under pressure)", model=requested)
+        return JSONResponse(
+            content={"error": {"message": "Backends saturated, low-priority request shed", "type": "overloaded_error"}},
+            status_code=429,
+            headers={"retry-after": str(ADAPTIVE["shed_retry_after"]), REJECTED_HEADER: "shed"},
+        )
+
+    def snapshot(self) -> dict:
+        backends = {}
+        for model, samples in self.samples.items():
+            ttfbs = sorted(t for _, t, _ in samples if t is not None)
+            backends[model] = {
+                "samples": len(samples),
+                "errors": sum(1 for _, _, error in samples if error),
+                "ttfb_p90": round(ttfbs[min(len(ttfbs) - 1, int(len(ttfbs) * 0.9))], 3) if ttfbs else None,
+                "pressure": self.pressure(model),
+            }
+        slots = {}
+        for target, slot in self.slots.items():
+            steps = [target, *ADAPTIVE_LADDERS.get(target, [])]
+            slots[target] = {"level": slot["level"], "model": steps[min(slot["level"], len(steps) - 1)], "ladder": steps}
+        return {"enabled": ADAPTIVE["enabled"], **self.stats, "saturated": self.saturated,
+                "slots": slots, "backends": backends}
+
+
+_adaptive = _AdaptivePolicy()
+
+
+# Antigravity thinking 없는 Claude 모델 필터링 (단속 회피)
+# 이 패턴에 매칭되면서 -thinking 으로 끝나지 않는 모델을 제거
+_CLAUDE_MODEL_RE = re.compile(r"^(gemini-)?claude-")
+
+
+def _should_hide_model(model_id: str) -> bool:
+    """Antigravity의 non-thinking Claude 모델을 숨긴다."""
+    if not _CLAUDE_MODEL_RE.match(model_id):
+        return False
+    # thinking 접미사가 있으면 유지
+    if model_id.endswith("-thinking"):
+        return False
+    return True
+
+
+class _ModelCatalog:
+    """CCS /v1/models 캐시.
+
+    - TTL 안: 캐시된 (필터링·직렬화 완료) 응답 그대로 반환
+    - TTL ~ STALE_TTL: 캐시 응답 반환 + 백그라운드 갱신 (stale-while-revalidate)
+    - 그 이후/최초: 업스트림 호출. 동시에 들어온 요청은 하나의 호출을 같이 기다린다 (single-flight)
+    """
+
+    def __init__(self):
+        self.body = None        # 필터링 후 직렬화된 응답 바이트
+        self.ids = frozenset()  # 업스트림이 알려준 전체 모델 ID (숨김 포함)
+        self.fetched_at = 0.0
+        self.refreshes = 0
+        self.errors = 0
+        self._inflight = None
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at if self.body is not None else float("inf")
+
+    async def _fetch(self):
+        if _shared_state.enabled:
+            shared = await asyncio.to_thread(_shared_state.get, "models")
+            if shared is not None and time.time() - shared[1] < MODELS_TTL:
+                # 다른 워커가 TTL 안에 받아온 목록
+                value, updated = shared
+                self.body, self.ids = value["body"].encode(), frozenset(value["ids"])
+                self.fetched_at = time.monotonic() - (time.time() - updated)
+                _shared_state.stats["catalog_hits"] += 1
+                return 200, self.body
+        r = await _upstream().get(
+            f"{CCS_BASE}/v1/models",
+            headers={"Authorization": f"Bearer {CCS_API_KEY}"},
+            timeout=_timeout("models"),
+        )
+        data = r.json()
+        if r.status_code != 200 or "data" not in data:
+            # 에러 응답은 캐시하지 않고 그대로 전달
+            self.errors += 1
+            return r.status_code, _dumps(data)
+        ids = frozenset(m.get("id", "") for m in data["data"])
+        original_count = len(data["data"])
+        data["data"] = [
+            m for m in data["data"]
+            if not _should_hide_model(m.get("id", ""))
+        ]
+        hidden = original_count - len(data["data"])
+        if hidden and ids != self.ids:
+            _log("info", "models", f"🚫 Models: {hidden}개 non-thinking Claude 모델 숨김", hidden=hidden)
+        self.body, self.ids = _dumps(data), ids
+        self.fetched_at = time.monotonic()
+        self.refreshes += 1
+        if _shared_state.enabled:
+            await asyncio.to_thread(_shared_state.put, "models", {"body": self.body.decode(), "ids": sorted(ids)})
+        return 200, self.body
+
+    def _refresh(self) -> asyncio.Task:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._fetch())
+            self._inflight.add_done_callback(self._on_done)
+        return self._inflight
+
+    def _on_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+            _log("error", "models", f"⚠️ Models refresh error: {task.exception()}")
+
+    async def get(self) -> tuple[int, bytes]:
+        age = self.age()
+        if age < MODELS_TTL:
+            return 200, self.body
+        if age < MODELS_STALE_TTL:
+            self._refresh()
+            return 200, self.body
+        try:
+            return await asyncio.shield(self._refresh())
+        except Exception:
+            if self.body is None:
+                raise
+            return 200, self.body
+
+    def known(self, model: str) -> bool | None:
+        """카탈로그 기준 모델 존재 여부. 카탈로그가 없거나 너무 오래됐으면 None (판단 보류)."""
+        age = self.age()
+        if age >= MODELS_TTL:
+            self._refresh()
+        if age >= MODELS_STALE_TTL:
+            return None
+        return model in self.ids
+
+
+_model_catalog = _ModelCatalog()
+
+
+def _unknown_model_response(model: str) -> JSONResponse | None:
+    """VALIDATE_MODELS가 켜져 있고 카탈로그에 없는 모델이면 업스트림 호출 없이 404"""
+    if not VALIDATE_MODELS or _model_catalog.known(model) is not False:
+        return None
+    _log("info", "unknown_model", f"🚫 Unknown model: {model}", model=model)
+    return JSONResponse(
+        content={"error": {"message": f"Unknown model: {model}", "type": "proxy_error"}},
+        status_code=404,
+    )
+
+
+@app.get("/v1/models")
+@_instrumented("models", route="models")
+async def list_models():
+    """CCS 모델 목록에서 non-thinking Claude 모델 필터링 후 전달 (TTL 캐시)"""
+    status, content = await _model_catalog.get()
+    return Response(content=content, status_code=status, media_type="application/json")
+
+
+@app.post("/v1/chat/completions")
+@_instrumented("chat")
+async def chat_completions(request: Request):
+    with _span("body_read"):
+        raw = await request.body()
+    with _span("parse"):
+        body = _LazyBody(raw)
+        model = body.get("model", "")
+        is_stream = body.get("stream", False)
+    _ctx_requested(model)
+
+    _log("info", "request", f"📨 {model} stream={is_stream} msgs={body.size('messages')} tools={body.size('tools')}",
+         endpoint="chat", model=model, stream=is_stream)
+    priority = _request_priority(model, is_stream)
+
+    cache_key = _response_cache_key("chat", request, body, model)
+    if cache_key is not None:
+        cached = await _response_cache.get(cache_key)
+        if cached is not None:
+            return _cached_response("chat", cached, is_stream, model)
+
+    return await _coalesce(
+        _coalesce_key("chat", request, raw, body), model,
+        lambda: _chat_with_fallback(raw, body, model, is_stream, priority, cache_key),
+    )
+
+
+async def _chat_with_fallback(raw: bytes, body: _LazyBody, model: str, is_stream: bool, priority: int,
+                              cache_key: str | None):
+    response = await _route_chat(body, model, is_stream, priority)
+    # 업스트림 429/5xx로 끝났으면 fallback 체인의 다음 모델로 (첫 바이트 전 에러만 해당)
+    for fallback in FALLBACK_CHAINS.get(model, []):
+        if not _should_fail_over(response):
+            break
+        _log("warning", "fallback", f"🔀 Fallback: {model} → {fallback} (upstream {response.status_code})",
+             model=model, fallback=fallback, status=response.status_code)
+        _resilience_stats["failovers"] += 1
+        body = _LazyBody(raw)
+        body["model"] = fallback
+        response = await _route_chat(body, fallback, is_stream, priority)
+    _store_response(cache_key, model, response)
+    return response
+
+
+async def _route_chat(body: _LazyBody, model: str, is_stream: bool, priority: int):
+    route = _routing.resolve(model)
+    _ctx_route(route.kind, model)
+
+    # --- Route 1: Claude Thinking 모델 ---
+    if route.kind == "thinking":
+        return await _handle_thinking(body, model, is_stream, priority, route)
+
+    unknown = _unknown_model_response(route.model)
+    if unknown:
+        return unknown
+    _cap_max_tokens(body, route, ("max_tokens", "max_completion_tokens"))
+
+    # --- Route 2: Codex Effort 접미사 모델 ---
+    if route.kind == "codex-effort":
+        return await _handle_codex_effort(body, route, priority)
+
+    # --- Route 3: 일반 모델 passthrough (SSE stream) ---
+    return await _stream_passthrough(route.chat_url, body, priority=priority)
+
+
+async def _stream_passthrough(url: str, body: _LazyBody, route: str = "passthrough",
+                              priority: int = PRIORITY_INTERACTIVE):
+    """CCS의 SSE 스트리밍 응답을 그대로 Copilot에 전달"""
+    body["stream"] = True  # CCS에 스트리밍 강제
+
+    release, rejected = await _scheduler.acquire(route, body.get("model", ""), priority)
+    if rejected:
+        return rejected
+
+    try:
+        r = await _cancel_on_disconnect(
+            _send_upstream(url, body.encode(), {**CCS_HEADERS, **SSE_RELAY_HEADERS}, route, stream=True), "Passthrough",
+        )
+    except Exception as e:
+        release()
+        return _proxy_error(e, "Passthrough")
+    if r is None:
+        release()
+        return _client_closed()
+    if r.status_code != 200:
+        release()
+        return await _error_response(r, "Passthrough")
+
+    return _SSEResponse(_relay_sse(r, route, body.get("model", ""), _IDLE_ERROR["openai_raw"],
+                                   _stream_release(release)),
+                        on_close=[r.aclose, release])
+
+
+async def _handle_codex_effort(body: _LazyBody, route: _Route, priority: int):
+    """Codex effort 모델: 접미사 파싱 → reasoning_effort 삽입 → SSE passthrough"""
+    base_model, effort = route.model, route.effort
+    body["model"] = base_model
+    body["reasoning_effort"] = effort
+
+    # VS Code Copilot이 보내는 불필요한 필드 제거
+    for key in ["n", "logprobs", "top_logprobs", "response_format"]:
+        body.pop(key, None)
+
+    _log("info", "route", f"🔧 Codex effort: {base_model} + {effort}", route="codex-effort", model=base_model, effort=effort)
+    return await _stream_passthrough(route.chat_url, body, route="codex-effort", priority=priority)
+
+
+async def _handle_thinking(body: _LazyBody, model: str, is_stream: bool, priority: int, route: _Route):
+    """Claude thinking 모델: Anthropic Messages → OpenAI SSE 변환"""
+    config = route.config
+
+    reasoning_effort = body.get("reasoning_effort", None)
+    effort = EFFORT_MAP.get(reasoning_effort, config["effort"])
+
+    items = body.items("messages")  # 변환과 컨텍스트 추정이 같은 원소(해시/값)를 쓴다
+    with _span("convert_messages"):
+        anthropic_messages, system_content = _convert_messages(items)
+    if not anthropic_messages:
+        anthropic_messages = [{"role": "user", "content": "Hello"}]
+
+    requested = body.get("max_tokens") or body.get("max_completion_tokens")
+    # 컨텍스트 윈도우 안에서 가능한 최대 max_tokens (넘치면 오래된 히스토리 축소)
+    with _span("context_budget"):
+        max_tokens, trimmed, prompt = _fit_context(
+            body, model, requested, config["max_tokens"], anthropic_messages, items)
+    if not max_tokens:
+        return _context_overflow(model, prompt, anthropic=False)
+    if trimmed is not None:
+        anthropic_messages = trimmed
 
     anthropic_body = {
         "model": model,
@@ -273,39 +3262,52 @@ async def _handle_thinking(body: dict, model: str, is_stream: bool):
     openai_tools = body.get("tools", [])
     if openai_tools:
         anthropic_tools = []
-        for t in openai_tools:
-            if t.get("type") == "function":
-                func = t.get("function", {})
-                anthropic_tools.append({
-                    "name": func.get("name", ""),
-                    "description": func.get("description", "")[:1024],
-                    "input_schema": func.get("parameters", {"type": "object", "properties": {}}),
-                })
+        with _span("convert_tools"):
+            for t in openai_tools:
+                if t.get("type") == "function":
+                    func = t.get("function", {})
+                    anthropic_tools.append({
+                        "name": func.get("name", ""),
+                        "description": func.get("description", "")[:1024],
+                        "input_schema": func.get("parameters", {"type": "object", "properties": {}}),
+                    })
         if anthropic_tools:
             anthropic_body["tools"] = anthropic_tools
-            print(f"   🔧 Tools: {len(anthropic_tools)} forwarded")
+            _log("debug", "tools", f"   🔧 Tools: {len(anthropic_tools)} forwarded", tools=len(anthropic_tools))
+
+    with _span("cache_breakpoints"):
+        breakpoints = _plan_cache_breakpoints(anthropic_body)
+    if breakpoints:
+        _log("debug", "cache_breakpoints", f"   📌 Cache breakpoints: {breakpoints}", breakpoints=breakpoints)
+
+    _log("info", "route", f"🔍 Thinking: model={model}, effort={effort}, msgs={len(anthropic_messages)}, stream={is_stream}",
+         route="thinking", model=model, effort=effort)
+
+    headers = {
+        **CCS_HEADERS,
+        "anthropic-version": "2023-06-01",
+    }
+
+    release, rejected = await _scheduler.acquire("thinking", model, priority)
+    if rejected:
+        return rejected
 
-    print(f"🔍 Thinking: model={model}, effort={effort}, msgs={len(anthropic_messages)}, stream={is_stream}")
+    if is_stream:
+        return await _stream_thinking(anthropic_body, model, headers, release, route.chat_url)
 
     try:
-        async with httpx.AsyncClient(timeout=300) as client:
-            r = await client.post(
-                f"{CCS_BASE}/v1/messages",
-                json=anthropic_body,
-                headers={
-                    **CCS_HEADERS,
-                    "anthropic-version": "2023-06-01",
-                },
-            )
-    except Exception as e:
-        print(f"⚠️ Thinking error: {e}")
-        return JSONResponse(
-            content={"error": {"message": str(e), "type": "proxy_error"}},
-            status_code=502,
+        r = await _cancel_on_disconnect(
+            _send_upstream(route.chat_url, _dumps(anthropic_body), headers, "thinking"), "Thinking",
         )
+    except Exception as e:
+        return _proxy_error(e, "Thinking")
+    finally:
+        release()
+    if r is None:
+        return _client_closed()
 
     if r.status_code != 200:
-        print(f"⚠️ Thinking upstream {r.status_code}: {r.text[:200]}")
+        _log_upstream_error("Thinking", r.status_code, r.text)
         return JSONResponse(
             content={"error": {"message": f"Upstream: {r.text}", "type": "proxy_error"}},
             status_code=r.status_code,
@@ -319,7 +3321,9 @@ async def _handle_thinking(body: dict, model: str, is_stream: bool):
     output_tokens = usage.get("output_tokens", 0)
     cache_read = usage.get("cache_read_input_tokens", 0)
     cache_creation = usage.get("cache_creation_input_tokens", 0)
-    print(f"💰 Usage: in={input_tokens} out={output_tokens} cache_read={cache_read} cache_create={cache_creation} total={input_tokens + output_tokens}")
+    _log("info", "usage", f"💰 Usage: in={input_tokens} out={output_tokens} cache_read={cache_read} cache_create={cache_creation} total={input_tokens + output_tokens}",
+         route="thinking", model=model, usage=usage)
+    _record_usage("thinking", model, usage)
 
     # Anthropic response → thinking + text + tool_use 분리
     reasoning_content = None
@@ -355,53 +3359,155 @@ async def _handle_thinking(body: dict, model: str, is_stream: bool):
 
     completion_id = result.get("id", f"chatcmpl-{int(time.time())}")
 
-    if is_stream:
-        # SSE 스트리밍 포맷으로 응답
-        return StreamingResponse(
-            _thinking_to_sse(completion_id, model, text_content, reasoning_content, tool_calls, finish_reason),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",
-            },
+    # 일반 JSON 응답
+    msg = {"role": "assistant", "content": text_content}
+    if reasoning_content:
+        msg["reasoning_content"] = reasoning_content
+    if tool_calls:
+        msg["tool_calls"] = tool_calls
+
+    return JSONResponse(content={
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": msg,
+            "finish_reason": finish_reason,
+        }],
+        "usage": {
+            "prompt_tokens": result.get("usage", {}).get("input_tokens", 0),
+            "completion_tokens": result.get("usage", {}).get("output_tokens", 0),
+            "total_tokens": (
+                result.get("usage", {}).get("input_tokens", 0)
+                + result.get("usage", {}).get("output_tokens", 0)
+            ),
+        },
+    })
+
+
+# Anthropic stop_reason → OpenAI finish_reason
+STOP_REASON_MAP = {
+    "end_turn": "stop",
+    "stop_sequence": "stop",
+    "max_tokens": "length",
+    "tool_use": "tool_calls",
+}
+
+
+async def _stream_thinking(anthropic_body: dict, model: str, headers: dict, release, url: str):
+    """Claude thinking 스트리밍: 업스트림 SSE를 받는 즉시 OpenAI chunk로 변환해 전달"""
+    anthropic_body["stream"] = True
+
+    # 첫 바이트 전에 업스트림 상태를 확인해야 에러를 JSON으로 돌려줄 수 있다 (재시도/fallback도 이 시점까지만)
+    try:
+        r = await _cancel_on_disconnect(
+            _send_upstream(url, _dumps(anthropic_body), headers, "thinking", stream=True),
+            "Thinking",
         )
-    else:
-        # 일반 JSON 응답
-        msg = {"role": "assistant", "content": text_content}
-        if reasoning_content:
-            msg["reasoning_content"] = reasoning_content
-        if tool_calls:
-            msg["tool_calls"] = tool_calls
-
-        return JSONResponse(content={
-            "id": completion_id,
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [{
-                "index": 0,
-                "message": msg,
-                "finish_reason": finish_reason,
-            }],
-            "usage": {
-                "prompt_tokens": result.get("usage", {}).get("input_tokens", 0),
-                "completion_tokens": result.get("usage", {}).get("output_tokens", 0),
-                "total_tokens": (
-                    result.get("usage", {}).get("input_tokens", 0)
-                    + result.get("usage", {}).get("output_tokens", 0)
-                ),
-            },
-        })
+    except Exception as e:
+        release()
+        return _proxy_error(e, "Thinking")
+    if r is None:
+        release()
+        return _client_closed()
+
+    if r.status_code != 200:
+        text = (await r.aread()).decode("utf-8", errors="replace")
+        await r.aclose()
+        release()
+        _log_upstream_error("Thinking", r.status_code, text)
+        return JSONResponse(
+            content={"error": {"message": f"Upstream: {text}", "type": "proxy_error"}},
+            status_code=r.status_code,
+        )
+
+    # idle 가드는 줄 단위가 아니라 업스트림 읽기 단위로 (줄마다 타이머를 옮기지 않는다)
+    lines = _sse_lines(_idle_guard(r.aiter_bytes(), "thinking", _IDLE_ERROR["anthropic"], _stream_release(release)))
+    return _SSEResponse(_anthropic_sse_to_openai(lines, model), on_close=[r.aclose, release])
+
+
+class _ThinkingTagSplitter:
+    """text_delta 안의 <thinking>...</thinking> 구간을 reasoning으로 분리 (태그가 chunk 경계에 걸려도 처리)"""
+
+    OPEN, CLOSE = "<thinking>", "</thinking>"
+
+    def __init__(self):
+        self.buf = ""
+        self.inside = False
+        self.strip_next = False
+
+    def feed(self, text: str) -> list[tuple[str, str]]:
+        """(kind, text) 목록 반환. kind는 "reasoning" 또는 "content"."""
+        self.buf += text
+        out = []
+        while self.buf:
+            if self.strip_next:
+                # </thinking> 뒤 공백 제거 (비스트리밍 경로와 동일한 결과)
+                self.buf = self.buf.lstrip()
+                if not self.buf:
+                    break
+                self.strip_next = False
+            tag = self.CLOSE if self.inside else self.OPEN
+            kind = "reasoning" if self.inside else "content"
+            pos = self.buf.find(tag)
+            if pos >= 0:
+                if pos:
+                    out.append((kind, self.buf[:pos]))
+                self.buf = self.buf[pos + len(tag):]
+                self.strip_next = self.inside
+                self.inside = not self.inside
+                continue
+            # 태그 앞부분이 끝에 걸려 있으면 다음 delta까지 보류
+            keep = 0
+            for k in range(min(len(tag) - 1, len(self.buf)), 0, -1):
+                if tag.startswith(self.buf[-k:]):
+                    keep = k
+                    break
+            emit = self.buf[:len(self.buf) - keep]
+            if emit:
+                out.append((kind, emit))
+            self.buf = self.buf[len(self.buf) - keep:]
+            break
+        return out
+
+    def flush(self) -> list[tuple[str, str]]:
+        rest, self.buf = self.buf, ""
+        if not rest:
+            return []
+        return [("reasoning" if self.inside else "content", rest)]
 
 
-async def _thinking_to_sse(completion_id: str, model: str, text: str, reasoning: str | None,
-                           tool_calls: list | None = None, finish_reason: str = "stop"):
-    """Anthropic 응답을 OpenAI SSE chat.completion.chunk 포맷으로 변환"""
+async def _sse_lines(chunks):
+    """바이트 청크 → 줄 (str). 줄이 청크 경계에 걸리면 다음 청크와 합친다."""
+    pending = b""
+    async for chunk in chunks:
+        lines = (pending + chunk).split(b"\n") if pending else chunk.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8", errors="replace")
+    if pending:
+        yield pending.decode("utf-8", errors="replace")
+
+
+async def _anthropic_sse_to_openai(lines, model: str):
+    """Anthropic SSE 이벤트 스트림 → OpenAI SSE chat.completion.chunk 스트림"""
     created = int(time.time())
+    completion_id = f"chatcmpl-{created}"
+
+    def envelope() -> bytes:
+        # id/object/created/model은 스트림 내내 같다 → delta 앞부분까지 미리 직렬화해 두고 delta만 붙인다
+        head = _dumps({"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model})
+        return b"data: " + head[:-1] + b',"choices":[{"index":0,"delta":'
+
+    prefix = envelope()
+    tail = b',"finish_reason":null}]}\n\n'
 
-    def chunk(delta: dict, fr=None):
-        return "data: " + json.dumps({
+    def chunk(delta: dict, fr=None, usage: dict | None = None):
+        if fr is None and usage is None:
+            return prefix + _dumps(delta) + tail
+        payload = {
             "id": completion_id,
             "object": "chat.completion.chunk",
             "created": created,
@@ -411,94 +3517,1038 @@ async def _thinking_to_sse(completion_id: str, model: str, text: str, reasoning:
                 "delta": delta,
                 "finish_reason": fr,
             }],
-        }, ensure_ascii=False) + "\n\n"
+        }
+        if usage is not None:
+            payload["usage"] = usage
+        return b"data: " + _dumps(payload) + b"\n\n"
 
-    # 1. role chunk
-    yield chunk({"role": "assistant", "content": ""})
+    def text_chunk(key: bytes, text: str):
+        # 토큰마다 나오는 {"content": ...} / {"reasoning_content": ...}는 문자열만 직렬화
+        return prefix + key + _dumps(text) + b"}" + tail
 
-    # 2. content를 작은 조각으로 스트리밍
-    if text:
-        chunk_size = 20
-        for i in range(0, len(text), chunk_size):
-            yield chunk({"content": text[i:i + chunk_size]})
+    def deltas(parts):
+        for kind, text in parts:
+            yield text_chunk(b'{"reasoning_content":' if kind == "reasoning" else b'{"content":', text)
 
-    # 3. tool_calls 스트리밍 (있을 경우)
-    if tool_calls:
-        for idx, tc in enumerate(tool_calls):
-            # 첫 chunk: tool call 시작
-            yield chunk({"tool_calls": [{
-                "index": idx,
-                "id": tc["id"],
-                "type": "function",
-                "function": {"name": tc["function"]["name"], "arguments": ""},
-            }]})
-            # arguments를 조각으로 전송
-            args = tc["function"]["arguments"]
-            args_chunk_size = 50
-            for i in range(0, len(args), args_chunk_size):
+    splitter = _ThinkingTagSplitter()
+    tool_index = {}  # Anthropic content block index → OpenAI tool_calls index
+    usage = {}
+    stop_reason = None
+    started = False
+    emitted = False
+    ctx = _request_ctx.get()
+
+    async for line in lines:
+        if ctx is not None:
+            ctx.mark("upstream_first_byte")
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if not data or data == "[DONE]":
+            continue
+        try:
+            event = _loads(data)
+        except ValueError:
+            continue
+        etype = event.get("type")
+
+        if etype == "message_start":
+            message = event.get("message", {})
+            completion_id = message.get("id", completion_id)
+            prefix = envelope()
+            usage.update(message.get("usage") or {})
+
+        if not started and etype != "ping":
+            # 1. role chunk
+            started = True
+            yield chunk({"role": "assistant", "content": ""})
+
+        if etype == "content_block_start":
+            block = event.get("content_block", {})
+            if block.get("type") == "tool_use":
+                idx = len(tool_index)
+                tool_index[event.get("index")] = idx
+                emitted = True
                 yield chunk({"tool_calls": [{
                     "index": idx,
-                    "function": {"arguments": args[i:i + args_chunk_size]},
+                    "id": block.get("id", f"call_{int(time.time())}"),
+                    "type": "function",
+                    "function": {"name": block.get("name", ""), "arguments": ""},
                 }]})
 
-    # 4. finish with usage
-    yield chunk({}, fr=finish_reason)
+        elif etype == "content_block_delta":
+            delta = event.get("delta", {})
+            dtype = delta.get("type")
+            if dtype == "thinking_delta" and delta.get("thinking"):
+                emitted = True
+                yield text_chunk(b'{"reasoning_content":', delta["thinking"])
+            elif dtype == "text_delta" and delta.get("text"):
+                parts = splitter.feed(delta["text"])
+                if parts:
+                    emitted = True
+                for frame in deltas(parts):
+                    yield frame
+            elif dtype == "input_json_delta" and event.get("index") in tool_index:
+                partial = delta.get("partial_json", "")
+                if partial:
+                    yield chunk({"tool_calls": [{
+                        "index": tool_index[event["index"]],
+                        "function": {"arguments": partial},
+                    }]})
+
+        elif etype == "content_block_stop":
+            parts = splitter.flush()
+            if parts:
+                emitted = True
+            for frame in deltas(parts):
+                yield frame
+
+        elif etype == "message_delta":
+            stop_reason = event.get("delta", {}).get("stop_reason") or stop_reason
+            usage.update(event.get("usage") or {})
+
+        elif etype == "error":
+            err = event.get("error", {})
+            _log("error", "stream_error", f"⚠️ Thinking stream error: {err}", error=err)
+            yield b"data: " + _dumps({"error": {
+                "message": err.get("message", "upstream stream error"),
+                "type": err.get("type", "proxy_error"),
+            }}) + b"\n\n"
+            yield b"data: [DONE]\n\n"
+            return
+
+        elif etype == "message_stop":
+            break
+
+    if not started:
+        yield chunk({"role": "assistant", "content": ""})
+    for frame in deltas(splitter.flush()):
+        emitted = True
+        yield frame
+    if not emitted:
+        yield chunk({"content": "(No content returned)"})
 
-    # 5. done
+    # 💰 Token usage logging
+    input_tokens = usage.get("input_tokens", 0)
+    output_tokens = usage.get("output_tokens", 0)
+    cache_read = usage.get("cache_read_input_tokens", 0)
+    cache_creation = usage.get("cache_creation_input_tokens", 0)
+    _log("info", "usage", f"💰 Usage: in={input_tokens} out={output_tokens} cache_read={cache_read} cache_create={cache_creation} total={input_tokens + output_tokens}",
+         route="thinking", model=model, usage=usage)
+    _record_usage("thinking", model, usage)
+
+    # finish_reason: tool call이 있으면 tool_calls
+    finish_reason = "tool_calls" if tool_index else STOP_REASON_MAP.get(stop_reason, "stop")
+    yield chunk({}, fr=finish_reason, usage={
+        "prompt_tokens": input_tokens,
+        "completion_tokens": output_tokens,
+        "total_tokens": input_tokens + output_tokens,
+    })
+
+    yield b"data: [DONE]\n\n"
+
+
+def _sse_usage(frame: bytes) -> dict | None:
+    """SSE 프레임 하나에서 usage 추출 (Anthropic message_start/message_delta, OpenAI 최종 chunk)"""
+    for line in frame.split(b"\n"):
+        if not line.startswith(b"data:"):
+            continue
+        try:
+            data = json.loads(line[5:])
+        except ValueError:
+            continue
+        if not isinstance(data, dict):
+            continue
+        usage = data.get("usage") or (data.get("message") or {}).get("usage")
+        if usage:
+            return usage
+    return None
+
+
+def _sse_frames_end(buf) -> int:
+    """버퍼에서 마지막으로 완성된 SSE 프레임이 끝나는 위치 (없으면 0). 줄바꿈은 LF/CRLF 모두."""
+    lf, crlf = buf.rfind(b"\n\n"), buf.rfind(b"\n\r\n")  # \r\n\r\n, \n\r\n 둘 다 \n\r\n을 포함
+    return max(lf + 2 if lf >= 0 else 0, crlf + 3 if crlf >= 0 else 0)
+
+
+async def _relay_sse(response: httpx.Response, route: str, model: str, on_timeout: bytes, on_first=None):
+    """업스트림 SSE 바이트를 디코딩/줄 분리 없이 그대로 전달.
+
+    usage가 들어 있는 프레임만 골라 파싱한다 (완성된 프레임에 b'"usage"'가 있을 때만).
+    청크 간격이 라우트 idle 타임아웃을 넘기면 on_timeout(에러 이벤트)을 보내고 끝낸다.
+    on_first는 첫 청크에서 한 번 호출된다 (_stream_release).
+    """
+    pending = bytearray()  # 아직 안 끝난 프레임 (청크마다 bytes를 새로 만들지 않게)
+    usage = {}
+    ctx = _request_ctx.get()
+    async for chunk in _idle_guard(response.aiter_raw(), route, on_timeout, on_first):
+        if chunk is on_timeout and pending:
+            chunk = b"\n\n" + chunk  # 끊긴 프레임을 닫고 에러 이벤트를 따로 보낸다
+        if ctx is not None:
+            ctx.mark("upstream_first_byte")
+        yield chunk
+        pending += chunk
+        end = _sse_frames_end(pending)
+        if not end:
+            continue
+        complete = bytes(pending[:end])
+        del pending[:end]
+        if b'"usage"' not in complete:
+            continue
+        for frame in complete.replace(b"\r\n", b"\n").split(b"\n\n"):
+            if b'"usage"' in frame:
+                usage.update(_sse_usage(frame) or {})
+
+    if usage:
+        # 💰 Token usage logging (OpenAI 형식이면 prompt/completion 키)
+        input_tokens = usage.get("input_tokens", usage.get("prompt_tokens", 0))
+        output_tokens = usage.get("output_tokens", usage.get("completion_tokens", 0))
+        _log("info", "usage", f"💰 Usage [{route}] {model}: in={input_tokens} out={output_tokens} cache_read={usage.get('cache_read_input_tokens', 0)}",
+             route=route, model=model, usage=usage)
+        _record_usage(route, model, usage)
+
+
+# =====================================================================
+# 응답 캐시: 정규화한 요청 본문 해시 → 비스트리밍 응답 (메모리 LRU + 디스크)
+# =====================================================================
+
+# 같은 요청(바이트가 달라도 JSON이 같으면)에 저장된 응답을 돌려준다. 스트리밍 요청은 저장된 응답을 SSE로 재생.
+RESPONSE_CACHE = {
+    "enabled": False,
+    "max_entries": 1024,
+    "max_bytes": 64 * 1024 * 1024,        # 메모리 tier 한도
+    "disk_dir": None,                     # 예: "~/.ccs-wrapper/response-cache" (None이면 메모리만)
+    "disk_max_bytes": 512 * 1024 * 1024,
+    "ttl": 300,                           # 기본 TTL (초)
+    "max_temperature": 0.0,               # 이보다 높은 temperature(미지정은 1.0)는 캐시 안 함
+}
+# 모델별 TTL / force(temperature와 무관하게 캐시). 모델명은 별칭 치환 후 이름
+RESPONSE_CACHE_MODELS = {
+    "gpt-5-mini": {"ttl": 600, "force": True},   # Haiku 슬롯 (분류/제목 생성 등 반복 호출)
+}
+RESPONSE_CACHE_HEADER = "X-CCS-Cache"   # 요청 헤더: "bypass" / "force"
+# 키에서 뺄 필드 (응답 내용과 무관)
+_CACHE_IGNORED_FIELDS = ("stream", "stream_options", "metadata", "user")
+
+
+class _ResponseCache:
+    def __init__(self):
+        self.memory = OrderedDict()  # key → (expires_at, body)
+        self.memory_bytes = 0
+        self.disk_index = None       # key → 크기 (오래된 순), 첫 디스크 쓰기 때 디렉터리를 훑어 만든다
+        self.disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        self._writes = set()
+        self.stats = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "bypass": 0, "stores": 0, "evictions": 0}
+
+    def _put_memory(self, key: str, expires: float, body: bytes):
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_bytes -= len(old[1])
+        self.memory[key] = (expires, body)
+        self.memory_bytes += len(body)
+        while self.memory and (len(self.memory) > RESPONSE_CACHE["max_entries"]
+                               or self.memory_bytes > RESPONSE_CACHE["max_bytes"]):
+            _, (_, evicted) = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def _disk_dir(self) -> str | None:
+        path = RESPONSE_CACHE["disk_dir"]
+        return os.path.expanduser(path) if path else None
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self._disk_dir(), key[:2], key)
+
+    def _disk_get(self, key: str, now: float) -> tuple[float, bytes] | None:
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                expires = float(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if expires <= now:
+            self._disk_remove(key)
+            return None
+        return expires, body
+
+    def _disk_load_index(self):
+        entries = []
+        root = self._disk_dir()
+        os.makedirs(root, exist_ok=True)
+        for sub in os.scandir(root):
+            if sub.is_dir():
+                for entry in os.scandir(sub.path):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name, st.st_size))
+        self.disk_index = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.disk_bytes = sum(self.disk_index.values())
+
+    def _disk_remove(self, key: str):
+        with self._disk_lock:
+            if self.disk_index is not None:
+                self.disk_bytes -= self.disk_index.pop(key, 0)
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _disk_put(self, key: str, expires: float, body: bytes):
+        data = f"{expires}\n".encode() + body
+        path = self._disk_path(key)
+        try:
+            with self._disk_lock:
+                if self.disk_index is None:
+                    self._disk_load_index()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            _log("warning", "response_cache", f"⚠️ Response cache disk write error: {e}")
+            return
+        evict = []
+        with self._disk_lock:
+            self.disk_bytes += len(data) - self.disk_index.pop(key, 0)
+            self.disk_index[key] = len(data)
+            while self.disk_bytes > RESPONSE_CACHE["disk_max_bytes"] and len(self.disk_index) > 1:
+                old, size = self.disk_index.popitem(last=False)
+                self.disk_bytes -= size
+                evict.append(old)
+        for old in evict:
+            try:
+                os.remove(self._disk_path(old))
+            except OSError:
+                pass
+
+    async def get(self, key: str) -> bytes | None:
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.memory.move_to_end(key)
+                self.stats["hits_memory"] += 1
+                return entry[1]
+            self.memory_bytes -= len(self.memory.pop(key)[1])
+        if self._disk_dir():
+            found = await asyncio.to_thread(self._disk_get, key, now)
+            if found is not None:
+                self.stats["hits_disk"] += 1
+                self._put_memory(key, *found)
+                return found[1]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key: str, ttl: float, body: bytes):
+        expires = time.time() + ttl
+        self._put_memory(key, expires, body)
+        self.stats["stores"] += 1
+        if self._disk_dir():
+            task = asyncio.ensure_future(asyncio.to_thread(self._disk_put, key, expires, body))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    def snapshot(self) -> dict:
+        hits = self.stats["hits_memory"] + self.stats["hits_disk"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self.memory),
+            "bytes": self.memory_bytes,
+            "disk_bytes": self.disk_bytes if self.disk_index is not None else None,
+        }
+
+
+_response_cache = _ResponseCache()
+
+
+def _response_cache_key(endpoint: str, request: Request, body: _LazyBody, model: str) -> str | None:
+    """캐시 대상이면 본문 해시, 아니면 None (temperature > max_temperature 등).
+
+    본문 전체를 파싱하지 않고 최상위 멤버를 키 순으로 원본 JSON 텍스트 그대로 해시한다
+    (_CACHE_IGNORED_FIELDS는 빼고, 바뀐 멤버만 직렬화). 같은 클라이언트는 같은 바이트를 보내므로
+    값 안쪽의 공백/키 순서까지 정규화하지는 않는다.
+    """
+    if not RESPONSE_CACHE["enabled"]:
+        return None
+    mode = request.headers.get(RESPONSE_CACHE_HEADER, "").lower()
+    config = RESPONSE_CACHE_MODELS.get(model, {})
+    temperature = body.get("temperature")
+    if mode == "bypass" or (
+        mode != "force" and not config.get("force")
+        and (1.0 if temperature is None else temperature) > RESPONSE_CACHE["max_temperature"]
+    ):
+        _response_cache.stats["bypass"] += 1
+        return None
+    digest = hashlib.blake2b(endpoint.encode("utf-8"), digest_size=20)
+    for key in sorted(body.keys()):
+        if key in _CACHE_IGNORED_FIELDS:
+            continue
+        text = body.raw_value(key)
+        if text is not None:
+            data = text.encode("utf-8")
+        elif orjson:  # orjson으로 파싱한 본문은 원본 텍스트가 없으니 정렬 직렬화로 대신
+            data = orjson.dumps(body.get(key), option=orjson.OPT_SORT_KEYS)
+        else:
+            data = json.dumps(body.get(key), sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        digest.update(f"\n{json.dumps(key)}:".encode("utf-8"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _response_cache_ttl(model: str) -> float:
+    return RESPONSE_CACHE_MODELS.get(model, {}).get("ttl", RESPONSE_CACHE["ttl"])
+
+
+def _replay_openai_sse(result: dict):
+    """저장된 chat.completion → chat.completion.chunk SSE"""
+    base = {k: result.get(k) for k in ("id", "created", "model")}
+    base["object"] = "chat.completion.chunk"
+    choice = (result.get("choices") or [{}])[0]
+    message = choice.get("message") or {}
+
+    def chunk(delta: dict, finish_reason=None, **extra):
+        payload = {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra}
+        return "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    if message.get("reasoning_content"):
+        yield chunk({"reasoning_content": message["reasoning_content"]})
+    if message.get("content"):
+        yield chunk({"content": message["content"]})
+    if message.get("tool_calls"):
+        yield chunk({"tool_calls": [{**call, "index": i} for i, call in enumerate(message["tool_calls"])]})
+    yield chunk({}, choice.get("finish_reason", "stop"), usage=result.get("usage"))
     yield "data: [DONE]\n\n"
 
 
+def _replay_anthropic_sse(result: dict):
+    """저장된 Anthropic message → Messages SSE 이벤트"""
+    def event(name: str, data: dict):
+        return f"event: {name}\ndata: " + json.dumps(data, ensure_ascii=False) + "\n\n"
+
+    usage = result.get("usage") or {}
+    yield event("message_start", {"type": "message_start", "message": {
+        **result, "content": [], "stop_reason": None, "stop_sequence": None,
+        "usage": {**usage, "output_tokens": 0},
+    }})
+    for i, block in enumerate(result.get("content") or []):
+        btype = block.get("type")
+        if btype == "text":
+            yield event("content_block_start", {"type": "content_block_start", "index": i,
+                                                "content_block": {"type": "text", "text": ""}})
+            yield event("content_block_delta", {"type": "content_block_delta", "index": i,
+                                                "delta": {"type": "text_delta", "text": block.get("text", "")}})
+        elif btype == "thinking":
+            yield event("content_block_start", {"type": "content_block_start", "index": i,
+                                                "content_block": {"type": "thinking", "thinking": ""}})
+            yield event("content_block_delta", {"type": "content_block_delta", "index": i,
+                                                "delta": {"type": "thinking_delta", "thinking": block.get("thinking", "")}})
+            if block.get("signature"):
+                yield event("content_block_delta", {"type": "content_block_delta", "index": i,
+                                                    "delta": {"type": "signature_delta", "signature": block["signature"]}})
+        elif btype == "tool_use":
+            yield event("content_block_start", {"type": "content_block_start", "index": i,
+                                                "content_block": {**block, "input": {}}})
+            yield event("content_block_delta", {"type": "content_block_delta", "index": i, "delta": {
+                "type": "input_json_delta", "partial_json": json.dumps(block.get("input", {}), ensure_ascii=False)}})
+        else:
+            yield event("content_block_start", {"type": "content_block_start", "index": i, "content_block": block})
+        yield event("content_block_stop", {"type": "content_block_stop", "index": i})
+    yield event("message_delta", {"type": "message_delta", "delta": {
+        "stop_reason": result.get("stop_reason"), "stop_sequence": result.get("stop_sequence"),
+    }, "usage": {"output_tokens": usage.get("output_tokens", 0)}})
+    yield event("message_stop", {"type": "message_stop"})
+
+
+def _cached_response(endpoint: str, cached: bytes, is_stream: bool, model: str):
+    _ctx_route("cache", model)
+    _log("info", "response_cache", f"💾 Response cache hit: {model} stream={is_stream}", model=model)
+    if not is_stream:
+        return Response(content=cached, media_type="application/json")
+    result = _loads(cached)
+    replay = _replay_openai_sse(result) if endpoint == "chat" else _replay_anthropic_sse(result)
+    return _SSEResponse(_aiter(replay))
+
+
+async def _aiter(iterable):
+    """동기 제너레이터 → async (StreamingResponse가 스레드풀로 돌리지 않게)"""
+    for item in iterable:
+        yield item
+
+
+def _store_response(key: str | None, model: str, response):
+    """비스트리밍 200 JSON 응답만 저장 (fallback 모델로 받은 응답 포함)"""
+    if key is None or response.status_code != 200 or isinstance(response, StreamingResponse):
+        return
+    _response_cache.put(key, _response_cache_ttl(model), bytes(response.body))
+
+
+# =====================================================================
+# 동일 요청 합치기 (single-flight): 동시에 들어온 같은 요청은 업스트림 호출 하나를 공유
+# =====================================================================
+
+COALESCE = {
+    "enabled": False,         # --coalesce로 켠다
+    "max_body": 256 * 1024,   # 이보다 큰 요청은 해시하지 않음 (긴 대화가 겹칠 일은 드물다)
+    "max_temperature": 0.0,   # 이보다 높은 temperature(미지정은 1.0)는 샘플링 결과가 달라야 하므로 합치지 않음
+}
+
+_flights = {}  # key → Future[(Response | _Broadcast) | None]
+_coalesce_stats = {"leaders": 0, "followers": 0, "stream_followers": 0, "late_joiners": 0, "sampled": 0}
+
+
+class _Broadcast:
+    """SSE 응답 하나를 여러 구독자에게. 업스트림은 pump task 하나가 읽어 버퍼에 쌓고,
+    구독자는 join() 때 받은 위치(처음)부터 따라 읽는다. 버퍼는 가장 느린 구독자가 읽은 데까지 버리고,
+    한 번 버린 뒤에는 새 구독자를 받지 않는다 (늦게 온 요청은 직접 업스트림 호출).
+    구독자가 모두 떠나면 업스트림을 끊는다."""
+
+    def __init__(self, response: _SSEResponse, on_detach):
+        self.chunks = []
+        self.base = 0          # chunks[0]의 스트림 내 위치
+        self.done = False
+        self._positions = {}   # 구독자 id → 다음에 읽을 위치
+        self._next_id = 0
+        self._source = response
+        self._on_detach = on_detach  # 더 이상 새 구독자를 받지 않을 때 (버퍼를 버렸거나 스트림 끝)
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._pump())
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _pump(self):
+        try:
+            async for chunk in self._source.body_iterator:
+                self.chunks.append(chunk)
+                self._wake()
+        except Exception as e:
+            _log("error", "coalesce", f"⚠️ Coalesced stream error: {e!r}")
+        finally:
+            self.done = True
+            self._wake()
+            self._on_detach()
+            for callback in self._source.on_close:
+                result = callback()
+                if inspect.isawaitable(result):
+                    await result
+
+    def join(self):
+        """새 구독자의 SSE 제너레이터. 버퍼 앞부분을 이미 버렸으면 None."""
+        if self.base:
+            return None
+        sid = self._next_id
+        self._next_id += 1
+        self._positions[sid] = 0
+        return self._follow(sid)
+
+    def _trim(self):
+        low = min(self._positions.values(), default=self.base + len(self.chunks))
+        if low > self.base:
+            del self.chunks[:low - self.base]
+            if not self.base:
+                self._on_detach()
+            self.base = low
+
+    async def _follow(self, sid: int):
+        positions = self._positions
+        try:
+            while True:
+                changed = self._changed
+                while positions[sid] < self.base + len(self.chunks):
+                    chunk = self.chunks[positions[sid] - self.base]
+                    positions[sid] += 1
+                    self._trim()
+                    yield chunk
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            del positions[sid]
+            self._trim()
+            if not positions and not self.done:
+                self._task.cancel()
+
+
+def _coalesce_key(endpoint: str, request: Request, raw: bytes, body: _LazyBody | None = None) -> str | None:
+    """합칠 대상이면 본문 해시. body가 있으면(chat/messages) 결정적 요청(temperature ≤ max_temperature)만."""
+    if not COALESCE["enabled"] or len(raw) > COALESCE["max_body"]:
+        return None
+    if request.headers.get(RESPONSE_CACHE_HEADER, "").lower() == "bypass":
+        return None
+    if body is not None:
+        temperature = body.get("temperature")
+        if (1.0 if temperature is None else temperature) > COALESCE["max_temperature"]:
+            _coalesce_stats["sampled"] += 1
+            return None
+    return endpoint + ":" + hashlib.blake2b(raw, digest_size=20).hexdigest()
+
+
+def _shared_response(shared):
+    """리더의 결과로 팔로워 응답 생성 (같은 Response 객체는 공유하지 않는다).
+    스트림 버퍼 앞부분이 이미 버려졌으면 None."""
+    if isinstance(shared, _Broadcast):
+        stream = shared.join()
+        if stream is None:
+            _coalesce_stats["late_joiners"] += 1
+            return None
+        _coalesce_stats["stream_followers"] += 1
+        return _SSEResponse(stream)
+    headers = {k: v for k, v in shared.headers.items()
+               if k.lower() not in ("content-length", REQUEST_ID_HEADER.lower())}
+    return Response(content=shared.body, status_code=shared.status_code, headers=headers)
+
+
+async def _coalesce(key: str | None, model: str, produce):
+    """key가 같은 요청이 진행 중이면 그 결과를 기다려 공유, 아니면 produce()로 업스트림 호출 (리더)"""
+    if key is None:
+        return await produce()
+    flight = _flights.get(key)
+    if flight is not None:
+        _coalesce_stats["followers"] += 1
+        shared = await asyncio.shield(flight)
+        response = _shared_response(shared) if shared is not None else None
+        if response is not None:
+            _ctx_route("coalesced", model)
+            _log("info", "coalesce", f"🔗 Coalesced: {model} (followers={_coalesce_stats['followers']})", model=model)
+            return response
+        return await produce()  # 리더가 실패/취소됨, 또는 스트림에 늦게 합류 → 직접 호출
+
+    flight = asyncio.get_running_loop().create_future()
+    _flights[key] = flight
+    _coalesce_stats["leaders"] += 1
+    try:
+        response = await produce()
+    except BaseException:
+        _flights.pop(key, None)
+        flight.set_result(None)
+        raise
+    if response.status_code == 499:
+        # 리더 클라이언트가 끊겨 업스트림 호출이 취소됨 → 팔로워는 각자 호출
+        _flights.pop(key, None)
+        flight.set_result(None)
+        return response
+    if isinstance(response, _SSEResponse):
+        def detach():
+            if _flights.get(key) is flight:
+                del _flights[key]
+
+        shared = _Broadcast(response, on_detach=detach)
+        stream = shared.join()
+        flight.set_result(shared)
+        return _SSEResponse(stream)
+    _flights.pop(key, None)
+    flight.set_result(response)
+    return response
+
+
+# =====================================================================
+# count_tokens: 로컬 추정 (메시지별 해시 캐시) / CCS 전달
+# =====================================================================
+
+# /v1/messages/count_tokens 처리 방식
+#   "upstream": CCS로 전달
+#   "local":    로컬 추정만 사용
+#   "fallback": CCS로 전달하되 실패하면 로컬 추정 (non-Claude 모델은 바로 로컬)
+COUNT_TOKENS_MODE = "fallback"
+COUNT_TOKENS_CACHE_SIZE = 4096
+
+# 모델 계열별 토큰당 ASCII 글자 수 (CJK 등 멀티바이트 문자는 글자당 1토큰으로 계산)
+TOKEN_CHAR_RATIOS = {
+    "claude": 3.5,
+    "gpt": 4.0,
+    "gemini": 4.0,
+    "default": 3.8,
+}
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_IMAGE = 1600
+
+_token_cache = _LRU(COUNT_TOKENS_CACHE_SIZE)
+_count_tokens_stats = {"local": 0, "upstream": 0, "fallback": 0, "cache_hits": 0, "cache_misses": 0}
+
+
+def _token_family(model: str) -> str:
+    for family in TOKEN_CHAR_RATIOS:
+        if family != "default" and family in model:
+            return family
+    return "default"
+
+
+def _estimate_text(text: str, ratio: float) -> float:
+    # 3바이트 UTF-8 문자(한글/CJK) 하나당 추가 바이트 2개 → 대략적인 멀티바이트 글자 수
+    multibyte = (len(text.encode("utf-8")) - len(text)) // 2
+    return (len(text) - multibyte) / ratio + multibyte
+
+
+def _estimate_content(content, ratio: float) -> float:
+    if isinstance(content, str):
+        return _estimate_text(content, ratio)
+    if not isinstance(content, list):
+        return 0
+    total = 0
+    for block in content:
+        if isinstance(block, str):
+            total += _estimate_text(block, ratio)
+            continue
+        if not isinstance(block, dict):
+            continue
+        btype = block.get("type")
+        if btype in ("image", "image_url", "document"):
+            total += TOKENS_PER_IMAGE
+        elif btype == "tool_use":
+            total += _estimate_text(block.get("name", ""), ratio)
+            total += _estimate_text(json.dumps(block.get("input", {}), ensure_ascii=False), ratio)
+        elif btype == "tool_result":
+            total += TOKENS_PER_MESSAGE + _estimate_content(block.get("content", ""), ratio)
+        else:
+            total += _estimate_text(block.get("text") or block.get("thinking") or "", ratio)
+    return total
+
+
+def _cached_estimate(family: str, lazy: _LazyValue, estimate) -> float:
+    """원소 해시(_LazyValue.digest) 기준으로 추정값 캐시 (같은 히스토리는 한 번만 계산, 놓칠 때만 디코딩)"""
+    key = (family, lazy.digest())
+    cached = _token_cache.get(key)
+    if cached is not None:
+        _count_tokens_stats["cache_hits"] += 1
+        return cached
+    _count_tokens_stats["cache_misses"] += 1
+    tokens = estimate(lazy())
+    _token_cache.put(key, tokens)
+    return tokens
+
+
+def _estimate_message(msg: dict, ratio: float) -> float:
+    """메시지 하나 (Anthropic/OpenAI 형식 모두)"""
+    total = TOKENS_PER_MESSAGE + _estimate_content(msg.get("content", ""), ratio)
+    for call in msg.get("tool_calls") or ():  # OpenAI assistant tool_calls
+        total += _estimate_text(json.dumps(call.get("function", {}), ensure_ascii=False), ratio)
+    return total
+
+
+def _prompt_estimate(body: _LazyBody, model: str, items: list | None = None) -> float:
+    """요청 본문의 입력 토큰 수 추정 (messages/system/tools, 원소별 캐시). items: 공유할 body.items("messages")"""
+    family = _token_family(model)
+    ratio = TOKEN_CHAR_RATIOS[family]
+    total = 0.0
+    for _, lazy in items if items is not None else body.items("messages"):
+        total += _cached_estimate(family, lazy, lambda m: _estimate_message(m, ratio))
+    if "system" in body:
+        total += _cached_estimate(family, body.lazy("system"), lambda s: _estimate_content(s, ratio))
+    for _, lazy in body.items("tools"):
+        total += _cached_estimate(
+            family, lazy,
+            lambda t: _estimate_text(json.dumps(t, ensure_ascii=False), ratio),
+        )
+    return total
+
+
+def _count_tokens_local(body: _LazyBody, model: str) -> int:
+    """Anthropic count_tokens 요청 본문의 입력 토큰 수 추정"""
+    return max(1, round(_prompt_estimate(body, model)))
+
+
+async def _count_tokens(request: Request, url: str):
+    """count_tokens: COUNT_TOKENS_MODE에 따라 로컬 추정 또는 CCS 전달"""
+    raw = await request.body()
+    body = _LazyBody(raw)
+    model = body.get("model", "")
+    model = _routing.alias(model)
+
+    mode = COUNT_TOKENS_MODE
+    if mode == "fallback" and _token_family(model) != "claude":
+        # 리맵된 non-Claude 백엔드는 카운팅을 지원하지 않을 수 있음 → 바로 로컬
+        mode = "local"
+
+    if mode != "local":
+        headers = {**CCS_HEADERS, "anthropic-version": "2023-06-01"}
+        try:
+            r = await _upstream().post(url, content=raw, headers=headers, timeout=_timeout("count_tokens"))
+            if r.status_code == 200 or mode == "upstream":
+                _count_tokens_stats["upstream"] += 1
+                return JSONResponse(content=r.json(), status_code=r.status_code)
+            _log("warning", "count_tokens", f"⚠️ count_tokens upstream {r.status_code} → local estimate", status=r.status_code)
+        except Exception as e:
+            if mode == "upstream":
+                raise
+            _log("warning", "count_tokens", f"⚠️ count_tokens error: {e} → local estimate", error=str(e))
+        _count_tokens_stats["fallback"] += 1
+    else:
+        _count_tokens_stats["local"] += 1
+
+    return JSONResponse(content={"input_tokens": _count_tokens_local(body, model)})
+
+
+# =====================================================================
+# 컨텍스트 예산: 프롬프트 추정 → 안전한 max_tokens 계산, 넘치면 오래된 히스토리 축소
+# =====================================================================
+
+# 모델별 컨텍스트 윈도우 (입력 + 출력). 모델명에 키가 포함되면 적용, 없으면 "default"
+CONTEXT_WINDOWS = {
+    "default": 200000,  # Antigravity 200K context cap
+}
+CONTEXT_BUDGET = {
+    "margin": 0.08,        # 추정 오차 여유 (윈도우 대비 비율)
+    "min_output": 4096,    # 출력 여유가 이보다 적으면 히스토리를 줄인다
+    "trim": True,          # False면 줄이지 않고 바로 400 (업스트림 왕복 없이)
+    "keep_recent": 8,      # 축소 대상에서 빼는 최근 메시지 수
+}
+TRIMMED_TOOL_RESULT = "[tool result trimmed to fit the context window]"
+THINKING_MIN_BUDGET = 1024  # Anthropic budget_tokens 최소값 (budget_tokens < max_tokens 여야 한다)
+
+_context_stats = {"clamped": 0, "trimmed": 0, "tool_results_trimmed": 0, "messages_dropped": 0, "rejected": 0,
+                  "thinking_clamped": 0, "thinking_disabled": 0}
+
+
+def _context_window(model: str) -> int:
+    for key, window in CONTEXT_WINDOWS.items():
+        if key != "default" and key in model:
+            return window
+    return CONTEXT_WINDOWS["default"]
+
+
+def _is_turn_start(msg: dict) -> bool:
+    """tool_result가 없는 user 메시지 = 새 턴의 시작 (여기서 자르면 tool_use/tool_result 짝이 깨지지 않는다)"""
+    if msg.get("role") != "user":
+        return False
+    content = msg.get("content")
+    return not (isinstance(content, list)
+                and any(isinstance(b, dict) and b.get("type") == "tool_result" for b in content))
+
+
+def _trim_history(messages: list, need: float, ratio: float) -> float:
+    """Anthropic messages를 제자리에서 줄여 need 토큰 이상 확보 시도 → 확보한 추정 토큰 수.
+
+    1) 최근 keep_recent개 이전 메시지의 tool_result 본문을 짧은 표시로 대체 (오래된 것부터)
+    2) 그래도 부족하면 첫 메시지(작업 지시)와 최근 메시지는 두고 중간 턴을 통째로 삭제.
+       새 턴이 시작하는 user 메시지에서만 자르므로 tool_use와 tool_result는 같이 남거나 같이 빠지고,
+       이어 붙인 자리에서 같은 role이 연속되면 _append_merged로 합쳐 user/assistant 교대를 지킨다.
+    메시지 dict는 변환 캐시와 공유될 수 있어 바꿀 때는 복사본으로 교체한다.
+    """
+    old_end = max(1, len(messages) - CONTEXT_BUDGET["keep_recent"])
+    stub_cost = _estimate_text(TRIMMED_TOOL_RESULT, ratio)
+    saved = 0.0
+
+    for i in range(old_end):
+        if saved >= need:
+            break
+        content = messages[i].get("content")
+        if not isinstance(content, list):
+            continue
+        blocks = list(content)
+        changed = False
+        for j, block in enumerate(blocks):
+            if not isinstance(block, dict) or block.get("type") != "tool_result":
+                continue
+            cost = _estimate_content(block.get("content", ""), ratio)
+            if cost > stub_cost:
+                blocks[j] = {**block, "content": TRIMMED_TOOL_RESULT}
+                saved += cost - stub_cost
+                changed = True
+                _context_stats["tool_results_trimmed"] += 1
+        if changed:
+            messages[i] = {**messages[i], "content": blocks}
+
+    cut = 1
+    for i in range(2, min(old_end + 1, len(messages))):
+        if saved >= need:
+            break
+        if _is_turn_start(messages[i]):
+            saved += sum(_estimate_message(m, ratio) for m in messages[cut:i])
+            cut = i
+    if cut > 1:
+        _context_stats["messages_dropped"] += cut - 1
+        kept = messages[cut:]
+        del messages[1:]
+        for msg in kept:
+            if msg.get("role") == messages[-1].get("role"):
+                _append_merged(messages, msg["role"], msg.get("content", ""))
+            else:
+                messages.append(msg)
+    return saved
+
+
+def _fit_context(body: _LazyBody, model: str, requested: int | None, cap: int,
+                 messages: list | None = None, items: list | None = None) -> tuple[int, list | None, int]:
+    """입력 토큰 추정으로 안전한 max_tokens 계산 → (max_tokens, 줄인 messages 또는 None, 추정 입력 토큰).
+
+    messages: 줄일 대상 (Anthropic 형식). None이면 body의 messages (이미 Anthropic 형식).
+    items: 이미 만든 body.items("messages") (메시지 변환과 공유해서 원소를 한 번만 꺼내고 해싱).
+    줄여도 최소 출력 여유가 안 나오면 max_tokens=0.
+    """
+    prompt = _prompt_estimate(body, model, items)
+    window = _context_window(model)
+    available = window * (1 - CONTEXT_BUDGET["margin"])
+    want = min(requested or cap, cap)
+    target = min(want, CONTEXT_BUDGET["min_output"])
+    room = available - prompt
+
+    trimmed = None
+    if room < target and CONTEXT_BUDGET["trim"]:
+        trimmed = list(messages if messages is not None else body.get("messages") or [])
+        saved = _trim_history(trimmed, target - room, TOKEN_CHAR_RATIOS[_token_family(model)])
+        if saved:
+            room += saved
+            prompt -= saved
+            _context_stats["trimmed"] += 1
+            _log("info", "context_budget",
+                 f"✂️ Context trimmed: {model} ~{round(saved)} tokens (window={window}, prompt≈{round(prompt)})",
+                 model=model, saved=round(saved), window=window, prompt=round(prompt))
+        else:
+            trimmed = None
+    if room < target:
+        _context_stats["rejected"] += 1
+        _log("warning", "context_budget", f"⚠️ Context overflow: {model} prompt≈{round(prompt)} > window={window}",
+             model=model, prompt=round(prompt), window=window)
+        return 0, trimmed, round(prompt)
+
+    max_tokens = int(min(want, room))
+    if max_tokens < want:
+        _context_stats["clamped"] += 1
+        _log("debug", "context_budget", f"   📏 max_tokens {want} → {max_tokens} (prompt≈{round(prompt)})",
+             model=model, requested=want, max_tokens=max_tokens, prompt=round(prompt))
+    return max_tokens, trimmed, round(prompt)
+
+
+def _fit_thinking_budget(body: _LazyBody, model: str, max_tokens: int):
+    """thinking.budget_tokens를 맞춘 max_tokens 아래로. 최소 budget(1024)도 안 들어가면 thinking을 끈다."""
+    thinking = body.get("thinking")
+    if not isinstance(thinking, dict) or thinking.get("budget_tokens", 0) < max_tokens:
+        return
+    if max_tokens > THINKING_MIN_BUDGET:
+        body["thinking"] = {**thinking, "budget_tokens": max_tokens - 1}
+        _context_stats["thinking_clamped"] += 1
+        return
+    body.pop("thinking")
+    _context_stats["thinking_disabled"] += 1
+    _log("info", "context_budget",
+         f"🧠 Thinking disabled: {model} max_tokens={max_tokens} ≤ minimum budget {THINKING_MIN_BUDGET}",
+         model=model, max_tokens=max_tokens)
+
+
+def _context_overflow(model: str, prompt: int, anthropic: bool) -> JSONResponse:
+    """줄여도 안 들어가는 요청 → 업스트림에 보내지 않고 400 (Claude Code는 이 메시지로 자동 compact)"""
+    limit = int(_context_window(model) * (1 - CONTEXT_BUDGET["margin"])) - CONTEXT_BUDGET["min_output"]
+    message = f"prompt is too long: {prompt} tokens > {limit} maximum (estimated by wrapper)"
+    if anthropic:
+        content = {"type": "error", "error": {"type": "invalid_request_error", "message": message}}
+    else:
+        content = {"error": {"message": message, "type": "invalid_request_error", "code": "context_length_exceeded"}}
+    return JSONResponse(content=content, status_code=400)
+
+
 # =====================================================================
 # /v1/messages — Anthropic Messages API (Claude Code CLI 등)
 # =====================================================================
 
 @app.post("/v1/messages")
 @app.post("/v1/messages/{path:path}")
+@_instrumented("messages")
 async def messages(request: Request, path: str = ""):
     """Anthropic Messages API — Claude Code CLI에서 직접 사용"""
-    # count_tokens 등 서브경로 → CCS로 그대로 전달
+    # count_tokens 등 서브경로 → CCS로 그대로 전달 (count_tokens는 로컬 추정 가능)
     if path:
-        body = await request.json()
         url = f"{CCS_BASE}/v1/messages/{path}"
         qs = str(request.query_params)
         if qs:
             url += f"?{qs}"
+        _ctx_route("count_tokens" if path == "count_tokens" else "passthrough", "")
+        if path == "count_tokens":
+            key = _coalesce_key("count_tokens", request, await request.body())
+            return await _coalesce(key, "", lambda: _count_tokens(request, url))
         headers = {**CCS_HEADERS, "anthropic-version": "2023-06-01"}
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post(url, json=body, headers=headers)
+        r = await _upstream().post(
+            url, content=await request.body(), headers=headers, timeout=_timeout("count_tokens"),
+        )
         return JSONResponse(content=r.json(), status_code=r.status_code)
 
-    body = await request.json()
-    model = body.get("model", "")
-    is_stream = body.get("stream", False)
+    with _span("body_read"):
+        raw = await request.body()
+    with _span("parse"):
+        body = _LazyBody(raw)
+        model = body.get("model", "")
+        is_stream = body.get("stream", False)
+    _ctx_requested(model)
+    priority = _request_priority(model, is_stream)
 
     # 모델 별칭 치환 (haiku → sonnet 4.6 등)
-    if model in MODEL_ALIASES:
+    with _span("alias"):
         original = model
-        model = MODEL_ALIASES[model]
-        body["model"] = model
-        print(f"📨 [messages] {original} → {model} stream={is_stream} msgs={len(body.get('messages',[]))}")
-    else:
-        print(f"📨 [messages] {model} stream={is_stream} msgs={len(body.get('messages',[]))}")
+        model = _routing.alias(model)
+        if model != original and ADAPTIVE["enabled"]:
+            # 부하에 따라 별칭 대상을 낮추거나, 전부 포화면 낮은 우선순위 슬롯은 바로 429
+            shed = _adaptive.shed(original, priority)
+            if shed is not None:
+                return shed
+            model = _adaptive.select(model)
+        if model != original:
+            body["model"] = model
+            _log("info", "request", f"📨 [messages] {original} → {model} stream={is_stream} msgs={body.size('messages')}",
+                 endpoint="messages", model=model, alias=original, stream=is_stream)
+        else:
+            _log("info", "request", f"📨 [messages] {model} stream={is_stream} msgs={body.size('messages')}",
+                 endpoint="messages", model=model, stream=is_stream)
+
+    cache_key = _response_cache_key("messages", request, body, model)
+    if cache_key is not None:
+        cached = await _response_cache.get(cache_key)
+        if cached is not None:
+            return _cached_response("messages", cached, is_stream, model)
+
+    return await _coalesce(
+        _coalesce_key("messages", request, raw, body), model,
+        lambda: _messages_with_fallback(raw, body, model, is_stream, priority, cache_key),
+    )
+
+
+async def _messages_with_fallback(raw: bytes, body: _LazyBody, model: str, is_stream: bool, priority: int,
+                                  cache_key: str | None):
+    response = await _route_messages(body, model, is_stream, priority)
+    # 업스트림 429/5xx로 끝났으면 fallback 체인의 다음 모델로 (첫 바이트 전 에러만 해당)
+    for fallback in FALLBACK_CHAINS.get(model, []):
+        if not _should_fail_over(response):
+            break
+        _log("warning", "fallback", f"🔀 [messages] Fallback: {model} → {fallback} (upstream {response.status_code})",
+             model=model, fallback=fallback, status=response.status_code)
+        _resilience_stats["failovers"] += 1
+        body = _LazyBody(raw)
+        body["model"] = fallback
+        response = await _route_messages(body, fallback, is_stream, priority)
+    _store_response(cache_key, model, response)
+    return response
+
+
+async def _route_messages(body: _LazyBody, model: str, is_stream: bool, priority: int):
+    route = _routing.resolve(model)
+    _ctx_route(route.kind, model)
 
     # --- Route 1: Claude Thinking 모델 ---
-    if model in THINKING_MODELS:
-        return await _handle_thinking_messages(body, model, is_stream)
+    if route.kind == "thinking":
+        return await _handle_thinking_messages(body, model, is_stream, priority, route)
+
+    unknown = _unknown_model_response(route.model)
+    if unknown:
+        return unknown
+    _cap_max_tokens(body, route, ("max_tokens",))
 
     # --- Route 2: Codex Effort 접미사 모델 ---
-    match = EFFORT_SUFFIXES.match(model)
-    if match:
-        base_model = match.group(1)
-        effort = match.group(2)
-        return await _handle_codex_effort_messages(body, base_model, effort, is_stream)
+    if route.kind == "codex-effort":
+        return await _handle_codex_effort_messages(body, route, is_stream, priority)
 
     # --- Route 3: 일반 모델 passthrough ---
-    return await _messages_passthrough(f"{CCS_BASE}/v1/messages", body, is_stream)
+    if "claude" in route.model:  # Anthropic 이외 모델(CCS가 변환)에는 cache_control을 보내지 않는다
+        _apply_cache_breakpoints(body)
+    return await _messages_passthrough(route.messages_url, body, is_stream, priority=priority)
 
 
-async def _handle_thinking_messages(body: dict, model: str, is_stream: bool):
+async def _handle_thinking_messages(body: _LazyBody, model: str, is_stream: bool, priority: int, route: _Route):
     """Claude thinking: thinking 파라미터 삽입 → CCS /v1/messages"""
-    config = THINKING_MODELS[model]
+    config = route.config
     effort = body.get("thinking", {}).get("effort", config["effort"])
 
     # CCS 실제 모델명으로 치환 (e.g. claude-sonnet-4-6-thinking → claude-sonnet-4-6)
@@ -509,77 +4559,191 @@ async def _handle_thinking_messages(body: dict, model: str, is_stream: bool):
     if "thinking" not in body:
         body["thinking"] = {"type": "adaptive", "effort": effort}
 
-    # max_tokens cap: Antigravity 200K context 제한
-    if body.get("max_tokens", 0) > 16000:
-        body["max_tokens"] = 16000
+    # 컨텍스트 윈도우 안에서 가능한 최대 max_tokens (넘치면 오래된 히스토리 축소)
+    requested = body.get("max_tokens")
+    with _span("context_budget"):
+        max_tokens, trimmed, prompt = _fit_context(body, model, requested, config["max_tokens"])
+    if not max_tokens:
+        return _context_overflow(model, prompt, anthropic=True)
+    if trimmed is not None:
+        body["messages"] = trimmed
+    if max_tokens != requested:
+        body["max_tokens"] = max_tokens
+    _fit_thinking_budget(body, model, max_tokens)
+
+    # prompt cache breakpoint: 클라이언트가 직접 넣지 않은 경우에만 (표시할 원소만 바꿔 끼움)
+    _apply_cache_breakpoints(body)
 
-    print(f"🔍 [messages] Thinking: {model} → {ccs_model}, effort={effort}, stream={is_stream}")
-    return await _messages_passthrough(f"{CCS_BASE}/v1/messages", body, is_stream)
+    _log("info", "route", f"🔍 [messages] Thinking: {model} → {ccs_model}, effort={effort}, stream={is_stream}",
+         route="thinking", model=ccs_model, effort=effort)
+    return await _messages_passthrough(
+        route.messages_url, body, is_stream, route="thinking", priority=priority,
+    )
 
 
-async def _handle_codex_effort_messages(body: dict, base_model: str, effort: str, is_stream: bool):
+async def _handle_codex_effort_messages(body: _LazyBody, route: _Route, is_stream: bool, priority: int):
     """Codex effort: 접미사 파싱 → reasoning_effort 삽입 → Codex provider"""
+    base_model, effort = route.model, route.effort
     body["model"] = base_model
     body["reasoning_effort"] = effort
 
-    print(f"🔧 [messages] Codex effort: {base_model} + {effort}, stream={is_stream}")
+    _log("info", "route", f"🔧 [messages] Codex effort: {base_model} + {effort}, stream={is_stream}",
+         route="codex-effort", model=base_model, effort=effort)
     return await _messages_passthrough(
-        f"{CCS_BASE}/api/provider/codex/v1/messages", body, is_stream
+        route.messages_url, body, is_stream, route="codex-effort", priority=priority,
     )
 
 
-async def _messages_passthrough(url: str, body: dict, is_stream: bool):
+async def _messages_passthrough(url: str, body: _LazyBody, is_stream: bool, route: str = "passthrough",
+                                priority: int = PRIORITY_INTERACTIVE):
     """Anthropic Messages 형식 요청을 CCS로 전달 (스트리밍/비스트리밍)"""
     headers = {
         **CCS_HEADERS,
         "anthropic-version": "2023-06-01",
     }
 
+    release, rejected = await _scheduler.acquire(route, body.get("model", ""), priority)
+    if rejected:
+        return rejected
+
     if is_stream:
         # SSE 스트리밍: CCS의 Anthropic SSE를 그대로 전달
         body["stream"] = True
-        async def generate():
-            async with httpx.AsyncClient(timeout=300) as client:
-                async with client.stream(
-                    "POST", url, json=body, headers=headers,
-                ) as response:
-                    async for line in response.aiter_lines():
-                        if line:
-                            yield line + "\n"
-                        else:
-                            yield "\n"
-        return StreamingResponse(
-            generate(),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",
-            },
-        )
+        try:
+            r = await _cancel_on_disconnect(
+                _send_upstream(url, body.encode(), {**headers, **SSE_RELAY_HEADERS}, route, stream=True), "[messages]",
+            )
+        except Exception as e:
+            release()
+            return _proxy_error(e, "[messages]")
+        if r is None:
+            release()
+            return _client_closed()
+        if r.status_code != 200:
+            release()
+            return await _error_response(r, "[messages]")
+        return _SSEResponse(_relay_sse(r, route, body.get("model", ""), _IDLE_ERROR["anthropic_raw"],
+                                       _stream_release(release)),
+                            on_close=[r.aclose, release])
     else:
         # 비스트리밍: JSON 응답 그대로 전달
-        async with httpx.AsyncClient(timeout=300) as client:
-            r = await client.post(url, json=body, headers=headers)
+        try:
+            r = await _cancel_on_disconnect(_send_upstream(url, body.encode(), headers, route), "[messages]")
+        except Exception as e:
+            return _proxy_error(e, "[messages]")
+        finally:
+            release()
+        if r is None:
+            return _client_closed()
 
         if r.status_code != 200:
-            print(f"⚠️ [messages] upstream {r.status_code}: {r.text[:200]}")
-            return JSONResponse(content=r.json(), status_code=r.status_code)
+            return await _error_response(r, "[messages]")
 
         result = r.json()
 
         # 💰 Token usage logging
         usage = result.get("usage", {})
-        print(f"💰 Usage: in={usage.get('input_tokens',0)} out={usage.get('output_tokens',0)}")
+        _log("info", "usage", f"💰 Usage: in={usage.get('input_tokens',0)} out={usage.get('output_tokens',0)}",
+             route=route, model=body.get("model", ""), usage=usage)
+        _record_usage(route, body.get("model", ""), usage)
 
         return JSONResponse(content=result, status_code=200)
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text format (라우트/모델별 구간 히스토그램, 토큰 카운터, 진행 중 스트림 수)"""
+    peers = await asyncio.to_thread(_shared_state.peer_metrics) if _shared_state.enabled else []
+    return Response(content=_render_metrics(peers), media_type="text/plain; version=0.0.4")
+
+
+def _is_local_client(request: Request) -> bool:
+    return request.client is None or request.client.host in ("127.0.0.1", "::1", "localhost")
+
+
+@app.post("/admin/profile")
+async def arm_profile(request: Request, count: int = 1):
+    """다음 요청 count개를 cProfile로 프로파일 (로컬 클라이언트만)"""
+    if not _is_local_client(request):
+        return JSONResponse(content={"error": {"message": "forbidden", "type": "proxy_error"}}, status_code=403)
+    _profile_state["armed"] = max(0, count)
+    _log("info", "profile", f"🔬 Profiling armed for next {count} request(s)")
+    return {"armed": _profile_state["armed"], "dir": PROFILE_DIR}
+
+
+@app.get("/admin/profile")
+async def profile_status(request: Request, limit: int = 30):
+    """최근 프로파일 목록 + 마지막 프로파일의 이 파일 함수 요약"""
+    if not _is_local_client(request):
+        return JSONResponse(content={"error": {"message": "forbidden", "type": "proxy_error"}}, status_code=403)
+    dumps = list(_profile_state["dumps"])
+    summary = _profile_summary(dumps[-1], limit) if dumps and os.path.exists(dumps[-1]) else None
+    return {
+        "armed": _profile_state["armed"],
+        "every": PROFILE_EVERY,
+        "active": _profile_state["active"],
+        "dumps": dumps,
+        "latest": summary,
+    }
+
+
+@app.get("/usage")
+async def usage(group_by: str = "model", bucket: str | None = None, hours: float | None = None):
+    """사용량 원장 집계. 예: /usage?group_by=alias,model&bucket=day&hours=168
+
+    group_by: model, alias(클라이언트가 보낸 모델명 = 별칭 슬롯), route, endpoint (쉼표로 여러 개)
+    bucket: minute / hour / day (UTC), hours: 최근 N시간만
+    """
+    if not USAGE_DB:
+        return JSONResponse(content={"error": {"message": "usage ledger disabled", "type": "proxy_error"}},
+                            status_code=404)
+    groups = [g.strip() for g in group_by.split(",") if g.strip()]
+    unknown = [g for g in groups if g not in _USAGE_GROUPS]
+    if unknown or (bucket and bucket not in _USAGE_BUCKETS):
+        return JSONResponse(content={"error": {
+            "message": f"group_by: {list(_USAGE_GROUPS)}, bucket: {list(_USAGE_BUCKETS)}",
+            "type": "invalid_request_error",
+        }}, status_code=400)
+    since = time.time() - hours * 3600 if hours else None
+    try:
+        rows = await asyncio.to_thread(_usage_ledger.query, groups, bucket, since, None)
+    except sqlite3.Error as e:
+        return _proxy_error(e, "Usage")
+    return {
+        "group_by": groups,
+        "bucket": bucket,
+        "hours": hours,
+        "pending": _usage_ledger.queue.qsize(),  # 아직 기록 전인 행 (USAGE_FLUSH_INTERVAL 안에 반영)
+        "rows": rows,
+    }
+
+
 @app.get("/health")
 async def health():
     return {
         "status": "ok",
         "backend": CCS_BASE,
+        "conversion_cache": {**_conversion_stats, "entries": len(_conversion_cache)},
+        "prompt_cache": _cache_hit_ratios(),
+        "scheduler": _scheduler.snapshot(),
+        "resilience": _resilience_stats,
+        "logging": _logger.snapshot(),
+        "usage_ledger": _usage_ledger.snapshot(),
+        "capture": _capture.snapshot(),
+        "response_cache": {**_response_cache.snapshot(), "enabled": RESPONSE_CACHE["enabled"]},
+        "coalesce": {**_coalesce_stats, "in_flight": len(_flights)},
+        "sse_writes": {**_sse_write_stats, **SSE_COALESCE},
+        "cancellation": _cancel_stats,
+        "workers": _shared_state.snapshot(),
+        "context_budget": {**_context_stats, "windows": CONTEXT_WINDOWS},
+        "routing": {**_routing.snapshot(), **_routing_stats},
+        "adaptive": {"enabled": ADAPTIVE["enabled"], **_adaptive.stats, "saturated": _adaptive.saturated},
+        "count_tokens": {**_count_tokens_stats, "mode": COUNT_TOKENS_MODE, "entries": len(_token_cache)},
+        "models_cache": {
+            "age": round(_model_catalog.age(), 1) if _model_catalog.body is not None else None,
+            "refreshes": _model_catalog.refreshes,
+            "errors": _model_catalog.errors,
+        },
         "endpoints": {
             "/v1/chat/completions": ["thinking+sse", "codex-effort+sse", "passthrough+sse"],
             "/v1/messages": ["thinking", "codex-effort", "passthrough"],
@@ -587,15 +4751,132 @@ async def health():
     }
 
 
+@app.get("/adaptive")
+async def adaptive():
+    """적응형 다운그레이드 상태: 슬롯별 현재 단계, 백엔드별 상태, 최근 결정"""
+    return {**_adaptive.snapshot(), "config": ADAPTIVE, "ladders": ADAPTIVE_LADDERS,
+            "decisions": list(_adaptive.decisions)}
+
+
+def _apply_options(options: dict):
+    """CLI 옵션을 모듈 설정에 반영 (__main__과 워커 프로세스의 create_app 공통)"""
+    global CCS_BASE, CCS_UDS, CCS_HTTP2, UPSTREAM_MAX_CONNECTIONS, TRACE_LOG, PROFILE_EVERY, LOG_LEVEL, LOG_FORMAT
+    global USAGE_DB, WORKERS, SHARED_STATE_DB, ROUTING_CONFIG
+    CCS_BASE = options["ccs_base"]
+    CCS_UDS = options["uds"]
+    CCS_HTTP2 = options["http2"]
+    UPSTREAM_MAX_CONNECTIONS = options["max_connections"]
+    TRACE_LOG = options["trace_log"]
+    PROFILE_EVERY = options["profile_every"]
+    LOG_LEVEL = options["log_level"]
+    LOG_FORMAT = options["log_format"]
+    USAGE_DB = os.path.expanduser(options["usage_db"]) if options["usage_db"] else None
+    RESPONSE_CACHE["enabled"] = options["response_cache"]
+    RESPONSE_CACHE["disk_dir"] = options["response_cache_dir"]
+    COALESCE["enabled"] = options["coalesce"]
+    WORKERS = options["workers"]
+    SHARED_STATE_DB = options["shared_state"]
+    ROUTING_CONFIG = options["routing_config"]
+    ROUTE_CONCURRENCY.update(options["route_concurrency"])
+    MODEL_CONCURRENCY.update(options["model_concurrency"])
+    ADAPTIVE["enabled"] = options["adaptive"]
+    CAPTURE["path"] = options["capture"]
+    CAPTURE["anonymize"] = not options["capture_raw"]
+
+
+def _parse_limits(value: str) -> dict:
+    """"thinking=4,passthrough=16" → {"thinking": 4, "passthrough": 16}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, sep, limit = item.rpartition("=")
+        if not sep or not name or not limit.isdigit() or int(limit) < 1:
+            raise argparse.ArgumentTypeError(f"expected name=N (N >= 1): {item!r}")
+        limits[name] = int(limit)
+    return limits
+
+
+def _remove_shared_state(path: str):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def create_app() -> FastAPI:
+    """앱 팩토리: uvicorn "thinking-wrapper:create_app" --factory (--workers N이면 워커마다 호출).
+    __main__이 환경변수로 넘긴 CLI 옵션이 있으면 이 프로세스에 반영한다."""
+    options = os.environ.get(_OPTIONS_ENV)
+    if options:
+        _apply_options(json.loads(options))
+    return app
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="CCS Wrapper (SSE + Messages)")
     parser.add_argument("--port", type=int, default=8318)
     parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--ccs-base", default=CCS_BASE, help="CCS 주소 (벤치마크 mock 등)")
+    parser.add_argument("--uds", default=CCS_UDS, help="CCS Unix 도메인 소켓 경로 (TCP 대신)")
+    parser.add_argument("--http2", action="store_true", default=CCS_HTTP2, help="CCS와 HTTP/2 사용 (h2 필요)")
+    parser.add_argument("--max-connections", type=int, default=UPSTREAM_MAX_CONNECTIONS)
+    parser.add_argument("--trace-log", default=TRACE_LOG, help="요청별 구간 trace JSONL 파일")
+    parser.add_argument("--profile-every", type=int, default=PROFILE_EVERY, help="N번째 요청마다 cProfile 저장 (0=끔)")
+    parser.add_argument("--log-level", default=LOG_LEVEL, choices=list(_LOG_LEVELS))
+    parser.add_argument("--usage-db", default=USAGE_DB,
+                        help="사용량 원장 SQLite 파일, 예: ~/.ccs-wrapper/usage.db (기본: 끔)")
+    parser.add_argument("--response-cache", action="store_true", default=RESPONSE_CACHE["enabled"],
+                        help="결정적 비스트리밍 요청 응답 캐시 사용")
+    parser.add_argument("--response-cache-dir", default=RESPONSE_CACHE["disk_dir"], help="응답 캐시 디스크 tier 경로")
+    parser.add_argument("--coalesce", action="store_true", default=COALESCE["enabled"],
+                        help="동시에 들어온 같은 결정적 요청(temperature 0, count_tokens)을 업스트림 호출 하나로 합침")
+    parser.add_argument("--log-format", default=LOG_FORMAT, choices=["text", "json"])
+    parser.add_argument("--workers", type=int, default=WORKERS, help="워커 프로세스 수 (2 이상이면 공유 상태 사용)")
+    parser.add_argument("--shared-state", default=SHARED_STATE_DB,
+                        help="워커 간 공유 상태 SQLite 파일 (기본: 실행마다 임시 파일)")
+    parser.add_argument("--route-concurrency", type=_parse_limits, default={},
+                        help="라우트별 업스트림 동시 요청 상한, 예: thinking=4,codex-effort=4 (기본: 제한 없음)")
+    parser.add_argument("--model-concurrency", type=_parse_limits, default={},
+                        help="모델별 업스트림 동시 요청 상한, 예: gpt-5.3-codex=2")
+    parser.add_argument("--routing-config", default=ROUTING_CONFIG,
+                        help="라우팅 설정 JSON (별칭/thinking/effort/업스트림 경로/상한, 빈 문자열이면 내장 기본값만)")
+    parser.add_argument("--adaptive", action="store_true", default=ADAPTIVE["enabled"],
+                        help="부하에 따라 별칭 대상 모델을 낮추고 포화 시 Haiku 슬롯 차단")
+    parser.add_argument("--capture", default=CAPTURE["path"],
+                        help="트래픽 캡처 파일 (gzip JSONL, bench/replay-capture.py로 재생)")
+    parser.add_argument("--capture-raw", action="store_true", default=not CAPTURE["anonymize"],
+                        help="캡처 본문을 익명화하지 않음")
     args = parser.parse_args()
+    if args.workers > 1 and not args.shared_state:
+        args.shared_state = os.path.join(tempfile.gettempdir(), f"ccs-wrapper-{os.getpid()}.db")
+        atexit.register(_remove_shared_state, args.shared_state)
+    if args.shared_state:
+        _remove_shared_state(args.shared_state)  # 이전 실행의 슬롯/메트릭이 남지 않도록 새로 시작
+    _apply_options(vars(args))
 
     print(f"🧠 CCS Wrapper Proxy starting on {args.host}:{args.port}")
-    print(f"   Backend: {CCS_BASE}")
+    print(f"   Backend: {CCS_BASE}" + (f" (uds={CCS_UDS})" if CCS_UDS else "") + (" [http2]" if CCS_HTTP2 else ""))
     print(f"   Endpoints: /v1/chat/completions, /v1/messages")
-    print(f"   Claude thinking: {list(THINKING_MODELS.keys())}")
-    print(f"   Codex effort: regex {EFFORT_SUFFIXES.pattern}")
-    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
+    routing_path = _routing_path()
+    if routing_path and os.path.exists(routing_path):
+        print(f"   Routing: {routing_path} (변경 시 자동 리로드, SIGHUP으로 즉시)")
+    else:
+        print(f"   Claude thinking: {list(THINKING_MODELS.keys())}")
+        print(f"   Codex effort: regex {EFFORT_SUFFIXES.pattern}")
+    if USAGE_DB:
+        print(f"   Usage ledger: {USAGE_DB}")
+    if TRACE_LOG:
+        print(f"   Trace log: {TRACE_LOG}")
+    if CAPTURE["path"]:
+        print(f"   Capture: {CAPTURE['path']}" + ("" if CAPTURE["anonymize"] else " (raw)"))
+    if WORKERS > 1:
+        print(f"   Workers: {WORKERS} (shared state: {SHARED_STATE_DB})")
+        # 워커는 모듈을 새로 import하므로 옵션은 환경변수로 넘긴다
+        os.environ[_OPTIONS_ENV] = json.dumps(vars(args))
+        uvicorn.run(
+            f"{os.path.splitext(os.path.basename(__file__))[0]}:create_app", factory=True,
+            app_dir=os.path.dirname(os.path.abspath(__file__)),
+            host=args.host, port=args.port, workers=WORKERS, log_level="info",
+        )
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, log_level="info")